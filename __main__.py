@@ -1,14 +1,24 @@
 import threading
+import time
 from abc import ABCMeta
+from contextlib import ExitStack
 from time import sleep
 from argparse import ArgumentParser
 
 import newsbot  # you must import your bot file here, even if you don't use it
 import eventbot
 import ticketbot
+import cassette
 import config
+import control
+import tracing
 from config import praw_config, bot_config
-from bots import InvalidBotClassName, BotSignature, RedditBot
+from bots import InvalidBotClassName, BotSignature, RedditBot, interruptible_requests
+from clock import SYSTEM_CLOCK
+from leases import LeaseCoordinator, get_lease_backend
+from supervisor import Supervisor
+from outbox import OutboxSender
+from tokencache import get_token_cache, get_token_refresher
 
 
 # If you declare your own RedditBot subclass in its own file,
@@ -16,9 +26,17 @@ from bots import InvalidBotClassName, BotSignature, RedditBot
 BOT_CLASSES = {cls.__name__: cls for cls in RedditBot.get_subclasses()}
 
 logger = config.getLogger()
+STARTUP_TIMEOUT = bot_config.get_dispatch_setting('startup_timeout')
+SHUTDOWN_TIMEOUT = bot_config.get_dispatch_setting('shutdown_timeout')
 parser = ArgumentParser(description="FAUbot options")
 parser.add_argument("-a", "--account", dest='account', choices=praw_config.get_all_site_names(),
                     help="Specify which Reddit account configured in praw.ini will be used to launch bots.")
+parser.add_argument("-r", "--record", dest='record', metavar="CASSETTE",
+                    help="Record every HTTP request and response to a cassette file, which scripts/replay.py can "
+                         "replay later.")
+parser.add_argument("-t", "--trace", dest='trace', metavar="FILE", nargs='?', const=tracing.TRACE_PATH,
+                    help="Write tracing spans of the bots' work cycles to a file in Chrome's trace event format. "
+                         "Tracing is also turned on by the use_tracing flag in config/bot_config.yaml.")
 
 
 # region DISPATCH
@@ -26,26 +44,241 @@ class Dispatch(threading.Thread, metaclass=ABCMeta):
     """
     An object used to create, launch, and terminate bots.
     """
-    def __init__(self, bot_signatures, stop_event=None):
+    def __init__(self, bot_signatures, stop_event=None, clock=None):
         """
         Initializes a Dispatch object, and creates a pool of bots.
         :param bot_signatures: A list of BotSignatures used to create the new bots
         :param stop_event: A threading.Event used to keep the Dispatch alive and tell it when to close.
+        :param clock: The Clock given to every bot, e.g. a VirtualClock for simulations. Defaults to the system clock.
         """
         super(Dispatch, self).__init__()
         self.stop = stop_event or threading.Event()
-        self.bots = {}
+        self.clock = clock
+        self.ready = threading.Event()  # set once every bot has started its first work cycle
+        self.drain_status = None  # what join() reported, see _stop_bots()
+        self.control_lock = threading.RLock()  # changes made while running, e.g. by control.py, happen one at a time
+        self.bots = {}  # username -> list of the account's bots
+        self.account_settings = {}  # username -> the account's praw.ini entry when its bots were created
 
         for signature in bot_signatures:
-            if type(signature.classname) is str:
-                self.bots[signature.classname] = [BOT_CLASSES[name](user_name=signature.username)
-                                                  for name in signature.classname.split(",")]
-            elif type(signature.classname) is list and all(type(name) is str for name in signature.classname):
-                self.bots[signature.classname] = [BOT_CLASSES[name](user_name=signature.username)
-                                                  for name in signature.classname]
-            else:
-                raise InvalidBotClassName
-        pass
+            self.bots[signature.username] = self._create_bots(signature)
+            self.account_settings[signature.username] = _get_account_settings(signature.username)
+        self.supervisor = Supervisor(self.bots, self.stop)
+
+    @staticmethod
+    def _get_class_names(signature):
+        """
+        :param signature: A BotSignature
+        :return: The list of bot class names in the signature
+        """
+        if type(signature.classname) is str:
+            return signature.classname.split(",")
+        elif type(signature.classname) is list and all(type(name) is str for name in signature.classname):
+            return signature.classname
+        raise InvalidBotClassName
+
+    def _create_bot(self, username, classname):
+        if classname not in BOT_CLASSES:
+            raise InvalidBotClassName("Unknown bot class: {}".format(classname))
+        return BOT_CLASSES[classname](user_name=username, clock=self.clock)
+
+    def _create_bots(self, signature):
+        """
+        :param signature: A BotSignature
+        :return: A list of new bots, one for each class name in the signature
+        """
+        return [self._create_bot(signature.username, name) for name in self._get_class_names(signature)]
+
+    def add_account(self, signature):
+        """
+        Creates and starts the bots of an account while the Dispatch is running.
+        :param signature: A BotSignature
+        """
+        bots = self._create_bots(signature)
+        with self.control_lock:
+            with self.supervisor.lock:
+                self.bots[signature.username] = bots
+            self.account_settings[signature.username] = _get_account_settings(signature.username)
+            for bot in bots:
+                bot.start()
+        logger.info("Account started: username=[%s], bots=[%s]", signature.username, len(bots))
+
+    def remove_account(self, username, timeout=None):
+        """
+        Stops the bots of an account, and removes them from the Dispatch. The account's outbox sender is stopped and
+        its access token is no longer refreshed, so nothing is done for the account here once this returns.
+        :param username: The account's Reddit user name
+        :param timeout: Time to wait for each bot to stop (wait forever if None).
+        """
+        with self.control_lock:
+            with self.supervisor.lock:
+                bots = self.bots.pop(username, [])
+                self.supervisor.forget(username)
+            self.account_settings.pop(username, None)
+            deadline = _get_deadline(timeout)
+            _stop_bots(bots, timeout)
+            get_token_refresher().unregister(username)
+            if not OutboxSender.stop_for_account(username, _get_remaining(deadline)):
+                logger.warning("Outbox sender did not stop in time: username=[%s]", username)
+        logger.info("Account stopped: username=[%s]", username)
+
+    def start_account(self, username):
+        """
+        Starts an account from its entry in praw.ini, e.g. one that was added after the program started.
+        :param username: The account's Reddit user name
+        """
+        with self.control_lock:
+            if username in self.bots:
+                raise ValueError("Account is already running: {}".format(username))
+            praw_config.reload_praw_settings()
+            get_token_cache().delete(username)  # the entry may have been saved with settings that changed since
+            self.add_account(_generate_bot_signature(username))
+
+    def start_bot(self, username, classname):
+        """
+        Adds one bot to an account. The account's other bots keep running.
+        :param username: The account's Reddit user name
+        :param classname: The name of a RedditBot subclass
+        :return: The new bot
+        """
+        with self.control_lock:
+            if classname in self.get_class_names(username):
+                raise ValueError("Bot is already running: {} {}".format(username, classname))
+            bot = self._create_bot(username, classname)
+            with self.supervisor.lock:
+                # restart history is kept by position in the account's list, so it is dropped when the list changes
+                self.supervisor.forget(username)
+                self.bots.setdefault(username, []).append(bot)
+            self.account_settings.setdefault(username, _get_account_settings(username))
+            bot.start()
+        logger.info("Bot started: username=[%s], bot=[%s]", username, bot.name)
+        return bot
+
+    def stop_bot(self, username, classname, timeout=None):
+        """
+        Stops one of an account's bots, and removes it from the Dispatch. The account's other bots keep running.
+        The account is removed when its last bot is stopped.
+        :param timeout: Time to wait for the bot to stop (wait forever if None).
+        """
+        with self.control_lock:
+            with self.supervisor.lock:
+                bot_list = self.bots.get(username, [])
+                stopped = [bot for bot in bot_list if bot.__class__.__name__ == classname]
+                if not stopped:
+                    raise ValueError("Bot is not running: {} {}".format(username, classname))
+                bot_list[:] = [bot for bot in bot_list if bot not in stopped]
+                self.supervisor.forget(username)
+                if not bot_list:
+                    del self.bots[username]
+                    self.account_settings.pop(username, None)
+            _stop_bots(stopped, timeout)
+        logger.info("Bot stopped: username=[%s], class=[%s]", username, classname)
+
+    def restart_bots(self, username, classname=None, timeout=None):
+        """
+        Replaces an account's bots with fresh copies, which reuse the old bots' Reddit sessions.
+        The old bots are stopped together, before their replacements start. A bot that does not stop in time is
+        left in place, so it is never running next to its replacement.
+        :param classname: Only the bot of this class is restarted. If None, every bot of the account is restarted.
+        :param timeout: Time to wait for the old bots to stop (wait forever if None).
+        :return: The number of bots that were restarted
+        :raises ValueError: If no bot matches, or if any bot did not stop in time. The bots that stopped are
+                            restarted either way.
+        """
+        with self.control_lock:
+            with self.supervisor.lock:
+                old_bots = [bot for bot in self.bots.get(username, [])
+                            if classname is None or bot.__class__.__name__ == classname]
+            if not old_bots:
+                raise ValueError("Bot is not running: {} {}".format(username, classname or ""))
+            # the supervisor keeps checking the other accounts while these bots stop
+            result = _stop_bots(old_bots, timeout)
+            stopped = [bot for bot in old_bots if not bot.is_alive()]
+            with self.supervisor.lock:
+                bot_list = self.bots.get(username, [])
+                for index, bot in enumerate(bot_list):
+                    if any(bot is old_bot for old_bot in stopped):
+                        bot_list[index] = Supervisor.restart(bot)
+                self.supervisor.forget(username)
+        if result['running']:
+            raise ValueError("Bots did not stop in time, so they were not restarted: {}"
+                             .format(", ".join(result['running'])))
+        return len(stopped)
+
+    def reload_accounts(self, timeout=None):
+        """
+        Re-reads praw.ini, and changes only the accounts whose entries changed since their bots started.
+        New accounts are started, and removed accounts are stopped. If only an account's bot_class_name changed,
+        bots are added to or removed from it. If any other value changed, e.g. its refresh token, its bots are
+        started again with new Reddit sessions. The bots of every other account keep running undisturbed.
+        :param timeout: Time to wait for each stopped bot (wait forever if None).
+        :return: A dict mapping the username of each changed account to a description of the change
+        """
+        changes = {}
+        with self.control_lock:
+            praw_config.reload_praw_settings()
+            site_names = praw_config.get_all_site_names()
+            for username in self.get_managed_accounts():
+                if username not in site_names:
+                    if username in self.bots:
+                        self.remove_account(username, timeout)
+                        changes[username] = "stopped"
+                    continue
+                if username not in self.bots:
+                    self.add_account(_generate_bot_signature(username))
+                    changes[username] = "started"
+                    continue
+                change = self._reload_account(username, timeout)
+                if change:
+                    changes[username] = change
+        logger.info("Accounts reloaded: changes=[%s]", changes)
+        return changes
+
+    def _reload_account(self, username, timeout):
+        old_settings = dict(self.account_settings.get(username, {}))
+        new_settings = _get_account_settings(username)
+        old_settings.pop('bot_class_name', None)
+        new_classes = self._get_class_names(_generate_bot_signature(username))
+        if old_settings != {key: value for key, value in new_settings.items() if key != 'bot_class_name'}:
+            self.remove_account(username, timeout)
+            get_token_cache().delete(username)  # otherwise the new bots would log in with the old settings' token
+            self.add_account(_generate_bot_signature(username))
+            return "restarted"
+        running_classes = self.get_class_names(username)
+        added = [name for name in new_classes if name not in running_classes]
+        removed = [name for name in running_classes if name not in new_classes]
+        for name in removed:
+            self.stop_bot(username, name, timeout)
+        for name in added:
+            self.start_bot(username, name)
+        self.account_settings[username] = new_settings
+        if added or removed:
+            return "added {}, removed {}".format(added, removed)
+        return None
+
+    def get_managed_accounts(self):
+        """
+        :return: The accounts that reload_accounts() may start, change, or stop.
+                 A Dispatch only manages the accounts it is running.
+        """
+        return list(self.bots)
+
+    def get_class_names(self, username):
+        """
+        :return: The class names of an account's running bots
+        """
+        with self.supervisor.lock:
+            return [bot.__class__.__name__ for bot in self.bots.get(username, [])]
+
+    def get_status(self):
+        """
+        :return: A list with a dict for every bot, with its account, class, thread name, health, and cycle count.
+        """
+        with self.supervisor.lock:
+            return [{'account': username, 'bot': bot.__class__.__name__, 'name': bot.name, 'alive': bot.is_alive(),
+                     'ready': bot.ready.is_set(), 'stalled': bot.is_stalled(), 'cycles': bot.cycles,
+                     'last_error': repr(bot.last_error) if bot.last_error else None}
+                    for username, bot_list in sorted(self.bots.items()) for bot in bot_list]
 
     def __enter__(self):
         """
@@ -59,35 +292,92 @@ class Dispatch(threading.Thread, metaclass=ABCMeta):
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """
-        Safely closes a Dispatch using a context manager,
+        Safely closes a Dispatch using a context manager, waiting at most dispatch.shutdown_timeout seconds,
         e.g. with Dispatch():
                  # do something
         """
-        self.join()
+        self.join(SHUTDOWN_TIMEOUT)
+
+    def get_bot_list(self):
+        """
+        :return: A list of every bot
+        """
+        with self.supervisor.lock:
+            return [bot for bot_list in self.bots.values() for bot in bot_list]
+
+    def get_readiness(self):
+        """
+        :return: A dict with the names of the bots that are 'ready' (have started working),
+                 'starting' (e.g. still logging in), and 'failed' (stopped before they were ready).
+        """
+        readiness = {'ready': [], 'starting': [], 'failed': []}
+        for bot in self.get_bot_list():
+            state = 'ready' if bot.ready.is_set() else 'starting' if bot.is_alive() or bot.ident is None else 'failed'
+            readiness[state].append(bot.name)
+        return readiness
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Waits until every bot is ready, no bot is still starting, or the Dispatch is told to stop.
+        :param timeout: Time to wait (wait forever if None)
+        :return: The readiness of the bots, see get_readiness()
+        """
+        deadline = _get_deadline(timeout)
+        readiness = self.get_readiness()
+        while readiness['starting'] and not self.stop.is_set():
+            remaining = _get_remaining(deadline)
+            if remaining == 0:
+                break
+            self.stop.wait(0.1 if remaining is None else min(remaining, 0.1))
+            readiness = self.get_readiness()
+        if not readiness['starting'] and not readiness['failed']:
+            self.ready.set()
+        return readiness
 
     def run(self):
         """
         Override of Thread.run().
-        Starts the bots, and waits for a stop event.
+        Starts the bots and their supervisor, reports when the bots are ready, and waits for a stop event.
+        The bots log in at the same time, each in its own thread.
         :return:
         """
-        for bot_list in self.bots.values():
-            for bot in bot_list:
+        started = time.monotonic()
+        clock = self.clock or SYSTEM_CLOCK
+        clock.register()  # a VirtualClock must not move until every bot has started
+        try:
+            for bot in self.get_bot_list():
                 bot.start()
+        finally:
+            clock.unregister()
+        self.supervisor.start()
+        readiness = self.wait_until_ready(STARTUP_TIMEOUT)
+        if readiness['starting'] or readiness['failed']:
+            logger.warning("Bots not ready: ready=[%s], starting=[%s], failed=[%s], seconds=[%.1f]",
+                           len(readiness['ready']), readiness['starting'], readiness['failed'],
+                           time.monotonic() - started)
+        else:
+            logger.info("Bots ready: ready=[%s], seconds=[%.1f]", len(readiness['ready']), time.monotonic() - started)
         self.stop.wait()
 
     def join(self, timeout=None):
         """
         Override of Thread.join().
-        Stops all the bots, sets the stop event, and stops itself.
-        :param timeout: Time to wait before forcefully stopping itself (wait forever if None).
+        Sets the stop event, stops the supervisor so no bots are restarted, stops all the bots at the same time,
+        and stops itself. The result of stopping the bots is saved in self.drain_status.
+        :param timeout: Time to wait for all of it together before giving up (wait forever if None).
+                        Bots that are still running then are abandoned; they are daemon threads.
         :return: Original return value of Thread.join()
         """
-        for bot_list in self.bots.values():
-            for bot in bot_list:
-                bot.join(timeout)
+        deadline = _get_deadline(timeout)
         self.stop.set()
-        return super(Dispatch, self).join(timeout)
+        if self.supervisor.is_alive():
+            self.supervisor.join(_get_remaining(deadline))
+        self.drain_status = _stop_bots(self.get_bot_list(), _get_remaining(deadline))
+        logger.info("Bots drained: stopped=[%s], running=[%s], seconds=[%.1f]", self.drain_status['stopped'],
+                    self.drain_status['running'], self.drain_status['seconds'])
+        if self.ident is None:
+            return None
+        return super(Dispatch, self).join(_get_remaining(deadline))
 
 
 class GlobalDispatch(Dispatch):
@@ -95,16 +385,143 @@ class GlobalDispatch(Dispatch):
     A Dispatch that creates Bots with every entry in praw.ini.
     It assumes every entry is meant to be used for a Bot.
     """
-    def __init__(self, stop_event=None):
+    def __init__(self, stop_event=None, clock=None):
         """
         Creates BotSignatures for every account in praw.ini, and initializes a Dispatch.
         :param stop_event: A threading.Event used to stop the Dispatch.
+        :param clock: The Clock given to every bot. Defaults to the system clock.
         """
         signatures = [_generate_bot_signature(name) for name in praw_config.get_all_site_names()]
-        super(GlobalDispatch, self).__init__(signatures, stop_event)
+        super(GlobalDispatch, self).__init__(signatures, stop_event, clock)
+
+    def get_managed_accounts(self):
+        """
+        An override of Dispatch.get_managed_accounts(). Every account in praw.ini is used.
+        """
+        return sorted(set(praw_config.get_all_site_names()) | set(self.bots))
+
+
+class ShardedDispatch(Dispatch):
+    """
+    A Dispatch that shares the accounts in praw.ini with the Dispatches of other nodes, so that each account's
+    bots run on exactly one node. It starts with no bots, and starts or stops an account's bots as the
+    account's lease moves to or away from this node (see leases.py).
+    """
+    def __init__(self, stop_event=None, backend=None, node_id=None):
+        """
+        :param stop_event: A threading.Event used to stop the Dispatch.
+        :param backend: The LeaseBackend shared by every node. Defaults to the configured backend.
+        :param node_id: A name that is unique to this node. Defaults to the host name and process id.
+        """
+        super(ShardedDispatch, self).__init__([], stop_event)
+        self.coordinator = LeaseCoordinator(backend or get_lease_backend(), praw_config.get_all_site_names(),
+                                            on_acquire=self._start_account, on_release=self._stop_account,
+                                            node_id=node_id)
+
+    def _start_account(self, username):
+        self.add_account(_generate_bot_signature(username))
+
+    def _stop_account(self, username):
+        self.remove_account(username, timeout=self.coordinator.stop_timeout)
+
+    def start_account(self, username):
+        """
+        An override of Dispatch.start_account(). Only an account whose lease this node holds can be started,
+        since its bots must not run on two nodes at once.
+        """
+        self._check_owned(username)
+        super(ShardedDispatch, self).start_account(username)
+
+    def start_bot(self, username, classname):
+        """
+        An override of Dispatch.start_bot(). Only an account whose lease this node holds can get a bot.
+        """
+        self._check_owned(username)
+        return super(ShardedDispatch, self).start_bot(username, classname)
+
+    def _check_owned(self, username):
+        if not self.coordinator.is_owned(username):
+            raise ValueError("This node does not hold the account's lease: {}".format(username))
+
+    def get_managed_accounts(self):
+        """
+        An override of Dispatch.get_managed_accounts(). Only the accounts whose leases this node holds are used.
+        """
+        return self.coordinator.get_owned_accounts()
+
+    def reload_accounts(self, timeout=None):
+        """
+        An override of Dispatch.reload_accounts().
+        The coordinator is given the new list of accounts, and the leases of removed accounts are released.
+        New accounts are started by the nodes they belong to on their next heartbeat.
+        """
+        with self.control_lock:
+            site_names = praw_config.get_all_site_names()
+            self.coordinator.accounts = site_names
+            released = [username for username in self.coordinator.get_owned_accounts() if username not in site_names]
+            for username in released:
+                self.coordinator.release(username)
+            changes = super(ShardedDispatch, self).reload_accounts(timeout)
+        changes.update((username, "released") for username in released)
+        return changes
+
+    def run(self):
+        """
+        An override of Dispatch.run().
+        Starts taking part in lease coordination, then waits for a stop event like a normal Dispatch.
+        """
+        self.coordinator.start()
+        super(ShardedDispatch, self).run()
+
+    def join(self, timeout=None):
+        """
+        An override of Dispatch.join().
+        Stops the heartbeats and the bots, and then releases every lease so other nodes can take over right away.
+        """
+        deadline = _get_deadline(timeout)
+        if self.coordinator.is_alive():
+            self.coordinator.join(_get_remaining(deadline))
+        result = super(ShardedDispatch, self).join(_get_remaining(deadline))
+        self.coordinator.release_all()
+        return result
 # endregion
 
 
+def _get_deadline(timeout):
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def _get_remaining(deadline):
+    return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+
+def _stop_bots(bots, timeout):
+    """
+    Tells every bot to stop at once, so they all stop at the same time, then waits for them under one deadline.
+    :param timeout: Time to wait for all the bots together (wait forever if None)
+    :return: A dict with the number of bots that 'stopped', the names of the bots still 'running',
+             and the 'seconds' it took
+    """
+    started = time.monotonic()
+    deadline = _get_deadline(timeout)
+    for bot in bots:
+        bot.stop_event.set()
+    for bot in bots:
+        if bot.ident is not None:
+            bot.join(_get_remaining(deadline))
+    running = [bot.name for bot in bots if bot.is_alive()]
+    for name in running:
+        logger.warning("Bot did not stop in time: bot=[%s]", name)
+    return {'stopped': len(bots) - len(running), 'running': running, 'seconds': time.monotonic() - started}
+
+
+def _get_account_settings(name):
+    try:
+        return praw_config.get_site_settings(name)
+    except praw_config.InvalidSiteName:
+        return {}
+
+
 def _generate_bot_signature(name):
     return BotSignature(classname=praw_config.get_bot_class_name(name), username=name,
                         permissions=praw_config.get_reddit_oauth_scope(name))
@@ -113,6 +530,8 @@ def _generate_bot_signature(name):
 def _get_dispatch(cli_args):
     if cli_args.account:
         return Dispatch, [_generate_bot_signature(cli_args.account)]
+    elif bot_config.should_use_sharding():
+        return ShardedDispatch, None
     else:
         return GlobalDispatch, None
 
@@ -122,12 +541,20 @@ def main(args=None):
     dispatch, params = _get_dispatch(cli_args)
 
     logger.info("Starting bots")
-    with dispatch(params):
-        try:
-            while True:
-                sleep(1)
-        except KeyboardInterrupt:
-            logger.info("Terminating bots")
+    with ExitStack() as stack:
+        stack.enter_context(interruptible_requests())
+        if cli_args.record:
+            stack.enter_context(cassette.recording(cli_args.record))
+        if cli_args.trace or bot_config.should_use_tracing():
+            stack.enter_context(tracing.exporting(cli_args.trace or tracing.TRACE_PATH))
+        with dispatch(params) as running, ExitStack() as services:
+            if bot_config.should_use_control_socket():
+                services.enter_context(control.serving(running))
+            try:
+                while True:
+                    sleep(1)
+            except KeyboardInterrupt:
+                logger.info("Terminating bots")
     logger.info("Program closed")
 
 
@@ -1,17 +1,31 @@
+import random
 import threading
 import praw
+import requests
+import tracing
 from abc import ABCMeta, abstractmethod
 from collections import namedtuple
+from contextlib import contextmanager
 
+from clock import SYSTEM_CLOCK
 from config import bot_config
 from config import getLogger
+from outbox import get_outbox, OutboxSender, SUBMIT, EDIT, MESSAGE
+from ratelimit import RateLimiter
+from tokencache import get_token_cache, get_token_refresher
 
 
 logger = getLogger()  # you will need this to use logger functions
 BotSignature = namedtuple('BotSignature', 'classname username permissions')
+SubredditResult = namedtuple('SubredditResult', 'subreddit result error')
 
 DEFAULT_SLEEP_INTERVAL = bot_config.get_sleep_interval('default')
 RUN_BOTS_ONCE = bot_config.should_run_once()
+WORK_TIMEOUT = bot_config.get_supervisor_setting('work_timeout')
+HEARTBEAT_GRACE = bot_config.get_supervisor_setting('heartbeat_grace')
+OPERATION_RATE = bot_config.get_rate_limit_setting('operations_per_second')
+LOGIN_JITTER = bot_config.get_auth_setting('login_jitter')
+HTTP_TIMEOUT = bot_config.get_dispatch_setting('http_timeout')
 
 
 # region EXCEPTIONS
@@ -21,6 +35,70 @@ class MissingRefreshTokenError(ValueError):
 
 class InvalidBotClassName(ValueError):
     pass
+
+
+class BotStopped(requests.RequestException):
+    """
+    Raised by an HTTP request made for a bot that has been told to stop. It is a RequestException,
+    so code that handles failed requests handles it too.
+    """
+    pass
+# endregion
+
+
+# region HTTP
+_http_context = threading.local()  # the stop event of the bot the current thread works for
+_session_send = None  # the requests.Session.send that interruptible_requests() replaced
+
+
+def _send_unless_stopped(session, request, **kwargs):
+    """
+    While interruptible_requests() is active, every HTTP request made through requests, by the praw.Reddit instances
+    as well as the scrapers, comes through here. A request made for a bot that has been told to stop fails at once,
+    and a bot's request without a timeout gets one, so a stopping bot never waits long for a request.
+    Requests made outside of a bot are sent unchanged.
+    """
+    stop_event = getattr(_http_context, 'stop_event', None)
+    if stop_event is not None:
+        if stop_event.is_set():
+            raise BotStopped("Bot is stopping: url=[{}]".format(request.url))
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = HTTP_TIMEOUT
+    return _session_send(session, request, **kwargs)
+
+
+@contextmanager
+def interruptible_requests():
+    """
+    Makes the HTTP requests of stopping bots fail while the context is active, by wrapping requests.Session.send.
+    e.g. with interruptible_requests():
+             # run bots
+    """
+    global _session_send
+    if requests.Session.send is _send_unless_stopped:  # already active
+        yield
+        return
+    previous = requests.Session.send
+    _session_send = previous
+    requests.Session.send = _send_unless_stopped
+    try:
+        yield
+    finally:
+        requests.Session.send = previous
+
+
+@contextmanager
+def stopped_by(stop_event):
+    """
+    Makes the HTTP requests of the current thread fail once stop_event is set, e.g. in a bot's helper thread.
+    Requests are only checked while interruptible_requests() is active.
+    """
+    previous = getattr(_http_context, 'stop_event', None)
+    _http_context.stop_event = stop_event
+    try:
+        yield
+    finally:
+        _http_context.stop_event = previous
 # endregion
 
 
@@ -30,20 +108,27 @@ class Bot(threading.Thread, metaclass=ABCMeta):
     Base class for all bots.
     It is a Thread that will continue to do work until it is told to stop.
     """
-    def __init__(self, reset_sleep_interval=True, run_once=False, *args, **kwargs):
+    def __init__(self, reset_sleep_interval=True, run_once=False, clock=None, *args, **kwargs):
         """
         :param reset_sleep_interval: If True, the sleep interval will reset to the default value at the beginning of
                                      every loop (you can modify the sleep interval with self.sleep_interval).
                                      It is recommended you leave this True.
         :param run_once: If True, the bot will not repeat its work function and will terminate after running once.
+        :param clock: The Clock the bot reads time from and sleeps on. Defaults to the system clock.
         :param args: Needed so that arbitrary arguments may be passed without raising an exception
         :param kwargs: Needed so that arbitrary keyword arguments may be passed without raising an exception
         """
         super(Bot, self).__init__(daemon=True)
         self.stop_event = threading.Event()
+        self.ready = threading.Event()  # set when the bot is about to start its first work cycle
+        self.clock = clock or SYSTEM_CLOCK
+        self._clock_registered = False
         self.sleep_interval = bot_config.get_sleep_interval(self.__class__.__name__)
         self._reset_sleep_interval = reset_sleep_interval
         self._run_once = RUN_BOTS_ONCE or run_once
+        self.heartbeat_deadline = None  # monotonic time by which the bot must check in again
+        self.cycles = 0  # number of work cycles completed without an exception
+        self.last_error = None
 
     @abstractmethod
     def work(self):
@@ -51,24 +136,118 @@ class Bot(threading.Thread, metaclass=ABCMeta):
         The method that is called repeatedly in the bot's run loop.
         This is an abstract method, meaning all subclasses of Bot
         must implement their own versions of this method.
+        :return: Optionally, the time (seconds since the epoch) when work() should be called next.
+                 If None is returned, the bot sleeps for self.sleep_interval.
         """
         pass
 
+    def before_work(self):
+        """
+        Called in the bot's thread before every call to work(). Does nothing by default.
+        """
+        pass
+
+    def get_sleep_time(self, next_due):
+        """
+        Decides how long the bot sleeps after calling work().
+        :param next_due: The value returned by work()
+        :return: Number of seconds to sleep
+        """
+        if next_due is None:
+            return self.sleep_interval
+        return max(next_due - self.clock.time(), 0)
+
+    def start(self):
+        """
+        An override of Thread.start() that registers the bot with its clock, so a VirtualClock does not move
+        while the bot is working. The bot unregisters when its thread ends.
+        """
+        self.clock.register()
+        self._clock_registered = True
+        try:
+            super(Bot, self).start()
+        except BaseException:
+            self._unregister_clock()
+            raise
+
+    def _unregister_clock(self):
+        if self._clock_registered:
+            self._clock_registered = False
+            self.clock.unregister()
+
     def run(self):
         """
         An override of Thread.run().
         This is called automatically when the thread's start()
         method is invoked. This function repeatedly calls self.work()
         until something tells it to stop.
+        Between calls, the bot sleeps until the time returned by work(),
+        or for self.sleep_interval if work() returned None.
+        If work() raises an exception, the exception is logged and the thread ends,
+        so that a Supervisor can replace the bot.
+        Once the bot is told to stop, its sleep ends and its HTTP requests fail, so it stops within a few seconds.
         """
+        self.ready.set()
+        try:
+            with stopped_by(self.stop_event):
+                self._run_loop()
+        finally:
+            self._unregister_clock()
+
+    def _run_loop(self):
         while not self.stop_event.is_set():
             if self._reset_sleep_interval:
                 self.sleep_interval = bot_config.get_sleep_interval(self.__class__.__name__)
-            self.work()
+            self.heartbeat(WORK_TIMEOUT)
+            try:
+                with tracing.start_trace("{}.work".format(self.__class__.__name__), bot=self.name,
+                                         cycle=self.cycles):
+                    self.before_work()
+                    next_due = self.work()
+            except Exception as e:
+                if self.stop_event.is_set():
+                    logger.info("Bot stopped during work: bot=[%s], error=[%r]", self.name, e)
+                    return
+                logger.exception("Bot crashed: bot=[%s]", self.name)
+                self.last_error = e
+                return
+            self.cycles += 1
             if self._run_once:
                 self.stop_event.set()
             else:
-                self.stop_event.wait(self.sleep_interval)
+                sleep_time = self.get_sleep_time(next_due)
+                self.heartbeat(sleep_time + HEARTBEAT_GRACE)
+                self.clock.wait(self.stop_event, sleep_time)
+
+    def heartbeat(self, timeout):
+        """
+        Tells a Supervisor that the bot is healthy.
+        If the bot does not call heartbeat() again within the timeout, it is considered stalled.
+        :param timeout: Number of seconds until the bot's next heartbeat is due.
+        """
+        self.heartbeat_deadline = self.clock.monotonic() + timeout
+
+    def is_stalled(self):
+        """
+        :return: True if the bot is running but has missed its heartbeat deadline.
+        """
+        return self.is_alive() and self.heartbeat_deadline is not None and \
+            self.clock.monotonic() > self.heartbeat_deadline
+
+    def has_died(self):
+        """
+        :return: True if the bot was started and has stopped without being told to stop.
+        """
+        return self.ident is not None and not self.is_alive() and not self.stop_event.is_set()
+
+    def respawn(self):
+        """
+        Creates a new, unstarted copy of this bot. Threads can only be started once,
+        so a Supervisor uses this to replace a bot that has died or stalled.
+        :return: A new Bot of the same class
+        """
+        return self.__class__(reset_sleep_interval=self._reset_sleep_interval, run_once=self._run_once,
+                              clock=self.clock)
 
     def join(self, timeout=None):
         """
@@ -101,6 +280,22 @@ class RedditBot(Bot):
         self.USER_AGENT = bot_config.get_user_agent(self.__class__.__name__).format(username=self.USER_NAME)
         self.subreddits = bot_config.get_subreddits()
         self.r = None  # the praw.Reddit instance
+        self.rate_limiter = RateLimiter.for_account(self.USER_NAME, OPERATION_RATE)
+        self._outbox = None
+
+    @property
+    def outbox(self):
+        """
+        The Outbox that queue_submit, queue_edit, and queue_message add to. It is opened when it is first used,
+        so creating a bot does not create the outbox database.
+        """
+        if self._outbox is None:
+            self._outbox = get_outbox()
+        return self._outbox
+
+    @outbox.setter
+    def outbox(self, outbox):
+        self._outbox = outbox
 
     @abstractmethod
     def work(self):
@@ -128,16 +323,107 @@ class RedditBot(Bot):
         before entering the run loop.
         :return: value of Bot.run()
         """
-        self.login()
-        return super(RedditBot, self).run()
+        self.heartbeat(WORK_TIMEOUT)
+        try:
+            with stopped_by(self.stop_event):
+                if not self.r and get_token_cache().is_expiring(self.USER_NAME):
+                    # spread out the logins of bots that need a new access token, so they do not all hit Reddit at once
+                    if self.clock.wait(self.stop_event, random.uniform(0, LOGIN_JITTER)):
+                        return
+                self.login()
+            return super(RedditBot, self).run()
+        except BotStopped:
+            logger.info("Bot stopped while logging in: bot=[%s]", self.name)
+        finally:
+            self._unregister_clock()
+
+    def before_work(self):
+        """
+        An override of Bot.before_work().
+        Switches the praw.Reddit instance to the newest access token, which the TokenRefresher saves in the
+        token cache shortly before the old one expires.
+        """
+        get_token_cache().apply(self.USER_NAME, self.r)
+
+    def respawn(self):
+        """
+        An override of Bot.respawn().
+        The new bot reuses this bot's praw.Reddit instance, so it does not have to log in again. If this bot's
+        thread is still running, e.g. it stalled inside a praw call, the new bot logs in with its own instance,
+        since a praw.Reddit instance must not be used by two threads at once.
+        :return: A new RedditBot of the same class
+        """
+        new_bot = self.__class__(user_name=self.USER_NAME, reset_sleep_interval=self._reset_sleep_interval,
+                                 run_once=self._run_once, clock=self.clock)
+        if not self.is_alive():
+            new_bot.r = self.r
+        return new_bot
+
+    def for_each_subreddit(self, operation, subreddits=None):
+        """
+        Calls operation(subreddit) for each subreddit in turn, in the bot's thread.
+        Calls are started no faster than the account's rate limiter allows, and an exception raised for
+        one subreddit is logged and collected without affecting the others.
+        The operations are not run in parallel: praw.Reddit instances must not be used by two threads at once,
+        and praw waits between requests to the same domain anyway. Once the bot is told to stop, the remaining
+        subreddits are skipped.
+        :param operation: A function that takes a subreddit name.
+        :param subreddits: The subreddits to run the operation for. Defaults to self.subreddits.
+        :return: A dict mapping each subreddit to a SubredditResult with either a result or an error.
+        """
+        subreddits = self.subreddits if subreddits is None else subreddits
+        results = {}
+        for subreddit in subreddits:
+            if self.stop_event.is_set():
+                break
+            try:
+                with tracing.span("subreddit_operation", subreddit=subreddit):
+                    with tracing.span("rate_limiter.acquire"):
+                        self.rate_limiter.acquire()
+                    result = operation(subreddit)
+            except Exception as e:
+                logger.error("Operation failed: subreddit=[/r/%s], error=[%r]", subreddit, e)
+                results[subreddit] = SubredditResult(subreddit=subreddit, result=None, error=e)
+            else:
+                results[subreddit] = SubredditResult(subreddit=subreddit, result=result, error=None)
+        return results
 
     def login(self):
         """
         Logs into Reddit by generating a new praw.Reddit instance.
         If one already exists, the existing instance will be used.
+        Also starts the account's outbox sender, which sends the writes queued by queue_submit, queue_edit,
+        and queue_message. The sender logs in with its own praw.Reddit instance.
         """
         if not self.r:
             self.r = self.get_reddit_instance()
+        OutboxSender.start_for_account(self.outbox, self.USER_NAME, self.get_reddit_instance, self.rate_limiter)
+
+    def queue_submit(self, subreddit, title, text=None, url=None, coalesce_key=None):
+        """
+        Queues a new post to be submitted by the outbox sender. Only one of text and url should be given.
+        :param coalesce_key: If given, a pending submission with the same key is replaced by this one.
+        :return: The id of the queued write
+        """
+        payload = {'subreddit': subreddit, 'title': title, 'text': text, 'url': url}
+        return self.outbox.enqueue(self.USER_NAME, SUBMIT, payload, coalesce_key)
+
+    def queue_edit(self, post_id, text):
+        """
+        Queues an edit of a self post. A pending edit of the same post is replaced, so only the newest text is sent.
+        :return: The id of the queued write
+        """
+        payload = {'post_id': post_id, 'text': text}
+        return self.outbox.enqueue(self.USER_NAME, EDIT, payload, coalesce_key="edit:{}".format(post_id))
+
+    def queue_message(self, recipient, subject, text, coalesce_key=None):
+        """
+        Queues a private message.
+        :param coalesce_key: If given, a pending message with the same key is replaced by this one.
+        :return: The id of the queued write
+        """
+        payload = {'recipient': recipient, 'subject': subject, 'text': text}
+        return self.outbox.enqueue(self.USER_NAME, MESSAGE, payload, coalesce_key)
 
     def get_reddit_instance(self):
         """
@@ -146,16 +432,40 @@ class RedditBot(Bot):
         saved in praw.ini. If a refresh token is not saved for a
         particular account, account_register.py must be run before
         that account can be used for a RedditBot.
+        A cached access token is reused if it has not expired and Reddit
+        still accepts it, and the token is refreshed in the background
+        before it expires.
         :return: A Reddit instance with an authenticated user.
         """
-        logger.info("Logging into Reddit: username=[{}], useragent=[{}]".format(self.USER_NAME, self.USER_AGENT))
-        r = praw.Reddit(user_agent=self.USER_AGENT, site_name=self.USER_NAME)
-        try:
-            current_access_info = r.refresh_access_information()
-        except praw.errors.HTTPException:
-            raise MissingRefreshTokenError("No oauth refresh token saved. Please run account_register.py.")
-        r.set_access_credentials(**current_access_info)
+        logger.info("Logging into Reddit: username=[%s], useragent=[%s]", self.USER_NAME, self.USER_AGENT)
+        r = self._create_reddit_instance()
+        refresh_token = r.refresh_token
+        token_cache = get_token_cache()
+        cached_access_info = token_cache.get(self.USER_NAME, refresh_token)
+        if cached_access_info:
+            logger.info("Using cached access token: username=[%s]", self.USER_NAME)
+            try:
+                # without a refresh token, praw raises for a rejected access token instead of refreshing it
+                r.set_access_credentials(**cached_access_info)
+            except (praw.errors.OAuthException, praw.errors.HTTPException) as e:
+                logger.warning("Cached access token was rejected: username=[%s], error=[%r]", self.USER_NAME, e)
+                token_cache.delete(self.USER_NAME)
+                cached_access_info = None
+            r.refresh_token = refresh_token
+        if not cached_access_info:
+            try:
+                current_access_info = r.refresh_access_information()
+            except praw.errors.HTTPException:
+                raise MissingRefreshTokenError("No oauth refresh token saved. Please run account_register.py.")
+            token_cache.put(self.USER_NAME, current_access_info)
+        get_token_refresher().register(self.USER_NAME, self._create_reddit_instance)
         return r
+
+    def _create_reddit_instance(self):
+        """
+        :return: A praw.Reddit instance for the account that has not logged in yet.
+        """
+        return praw.Reddit(user_agent=self.USER_AGENT, site_name=self.USER_NAME)
 # endregion
 
 
@@ -165,14 +475,14 @@ class ExampleBot1(RedditBot):
     An example RedditBot to show how simple it is to create new bots.
     Only a constructor and a work function are needed.
     """
-    def __init__(self, user_name):
-        super(ExampleBot1, self).__init__(user_name)
+    def __init__(self, user_name, *args, **kwargs):
+        super(ExampleBot1, self).__init__(user_name, *args, **kwargs)
 
     def work(self):
         me = self.r.get_me()
 
         # use logger.info for general messages
-        logger.info("ExampleBot1 working...Username: {}  Link karma: {}".format(me.name, me.link_karma))
+        logger.info("ExampleBot1 working...Username: %s  Link karma: %s", me.name, me.link_karma)
 
         # use logger.warning for warning messages
         logger.warning("Something weird happened or might happen.")
@@ -193,10 +503,10 @@ class ExampleBot2(RedditBot):
     An example RedditBot to show how simple it is to create new bots.
     Only a constructor and a work function are needed.
     """
-    def __init__(self, user_name):
-        super(ExampleBot2, self).__init__(user_name)
+    def __init__(self, user_name, *args, **kwargs):
+        super(ExampleBot2, self).__init__(user_name, *args, **kwargs)
 
     def work(self):
         me = self.r.get_me()
-        logger.info("ExampleBot2 working...Username: {}  Link karma: {}".format(me.name, me.link_karma))
+        logger.info("ExampleBot2 working...Username: %s  Link karma: %s", me.name, me.link_karma)
 #endregion
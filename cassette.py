@@ -0,0 +1,261 @@
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from config import getLogger
+
+logger = getLogger()
+
+SECRET_FIELDS = {'access_token', 'refresh_token', 'code', 'password', 'client_secret'}
+REDACTED = "REDACTED"
+HEADER = 'cassette'  # the key of the header line
+RECORDED_HEADERS = {'content-type', 'etag', 'last-modified', 'location', 'x-ratelimit-remaining',
+                    'x-ratelimit-reset', 'x-ratelimit-used'}
+
+
+class CassetteMiss(requests.ConnectionError):
+    """
+    Raised during replay when a request has no recorded response.
+    It is a ConnectionError, so bots handle it the same way as a network failure.
+    """
+    pass
+
+
+def _redact_json(text):
+    """
+    Replaces the values of secret fields (e.g. tokens) in a JSON object.
+    :return: The redacted JSON, or the text unchanged if it is not a JSON object with secret fields
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return text
+    if isinstance(data, dict) and SECRET_FIELDS.intersection(data):
+        return json.dumps({key: REDACTED if key in SECRET_FIELDS else value for key, value in data.items()})
+    return text
+
+
+def _redact_body(body):
+    """
+    Replaces the values of secret fields (e.g. tokens and passwords) in a form encoded or JSON request body.
+    :param body: A str, bytes, or None
+    :return: The redacted body as a str, or None
+    """
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', errors='replace')
+    if body.lstrip().startswith(('{', '[')):
+        return _redact_json(body)
+    return urlencode([(key, REDACTED if key in SECRET_FIELDS else value)
+                      for key, value in parse_qsl(body, keep_blank_values=True)])
+
+
+def _get_key(method, url, body):
+    return "{} {} {}".format(method, url, body or "")
+
+
+def _get_loose_key(method, url):
+    """
+    The key used when no interaction matches a request exactly, e.g. because the query contains today's date.
+    """
+    parts = urlsplit(url)
+    return "{} {}{}".format(method, parts.netloc, parts.path)
+
+
+class CassetteRecorder(object):
+    """
+    Writes every HTTP request and its response, with timing, to a gzipped JSON lines file.
+    Interactions are written as they finish, so a cassette is usable even if the program is killed.
+    The first line of a cassette is a header with the time the recording started, so a replay can run the bots
+    at the time they saw the responses, e.g. to filter today's articles the same way.
+    """
+    def __init__(self, path):
+        self.path = path
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        if is_new:
+            self._file.write(json.dumps({HEADER: {'started_at': time.time()}}) + "\n")
+            self._file.flush()
+
+    def record(self, request, response, elapsed):
+        """
+        :param request: The requests.PreparedRequest that was sent
+        :param response: Its requests.Response. The content is read if it was streamed.
+        :param elapsed: Seconds from sending the request until the whole response was read
+        """
+        content = response.content or b""
+        try:
+            text, encoding = _redact_json(content.decode('utf-8')), 'text'
+        except UnicodeDecodeError:
+            text, encoding = base64.b64encode(content).decode('ascii'), 'base64'
+        interaction = {'method': request.method,
+                       'url': request.url,
+                       'body': _redact_body(request.body),
+                       'status': response.status_code,
+                       'reason': response.reason,
+                       'headers': {key: value for key, value in response.headers.items()
+                                   if key.lower() in RECORDED_HEADERS},
+                       'content': text,
+                       'encoding': encoding,
+                       'offset': round(time.monotonic() - self._started - elapsed, 4),
+                       'elapsed': round(elapsed, 4)}
+        with self._lock:
+            self._file.write(json.dumps(interaction, separators=(',', ':')) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class CassettePlayer(object):
+    """
+    Answers HTTP requests with the responses saved in a cassette, without using the network.
+    A request is matched to a recorded interaction with the same method, URL, and body. If there is none,
+    the oldest unused interaction with the same method, host, and path is used instead.
+    Each recorded interaction is played once.
+    """
+    def __init__(self, path, realtime=False):
+        """
+        :param path: Path of a cassette written by CassetteRecorder
+        :param realtime: If True, every response is delayed by its recorded latency.
+                         Otherwise responses are returned immediately.
+        """
+        self.path = path
+        self.realtime = realtime
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+        headers = [line[HEADER] for line in lines if HEADER in line]
+        self.started_at = headers[0]['started_at'] if headers else None  # seconds since the epoch
+        self.interactions = [line for line in lines if HEADER not in line]
+        self._latest_offset = 0
+        self._used = [False] * len(self.interactions)
+        self._lock = threading.Lock()
+        self._exact = defaultdict(deque)
+        self._loose = defaultdict(deque)
+        for index, interaction in enumerate(self.interactions):
+            self._exact[_get_key(interaction['method'], interaction['url'], interaction['body'])].append(index)
+            self._loose[_get_loose_key(interaction['method'], interaction['url'])].append(index)
+
+    def remaining(self):
+        """
+        :return: Number of recorded interactions that have not been played yet.
+        """
+        with self._lock:
+            return self._used.count(False)
+
+    def get_recorded_time(self):
+        """
+        :return: The time when the latest interaction played so far was recorded, in seconds since the epoch,
+                 or None if the cassette has no start time
+        """
+        if self.started_at is None:
+            return None
+        with self._lock:
+            return self.started_at + self._latest_offset
+
+    def _take(self, queue):
+        while queue:
+            index = queue.popleft()
+            if not self._used[index]:
+                self._used[index] = True
+                self._latest_offset = max(self._latest_offset, self.interactions[index]['offset'])
+                return self.interactions[index]
+        return None
+
+    def play(self, request):
+        """
+        :param request: A requests.PreparedRequest
+        :raises CassetteMiss if the cassette has no response left for the request
+        :return: A requests.Response built from the recorded interaction
+        """
+        with self._lock:
+            interaction = self._take(self._exact[_get_key(request.method, request.url, _redact_body(request.body))]) \
+                or self._take(self._loose[_get_loose_key(request.method, request.url)])
+        if interaction is None:
+            raise CassetteMiss("No recorded response: method=[{}], url=[{}]".format(request.method, request.url),
+                               request=request)
+        if self.realtime:
+            time.sleep(interaction['elapsed'])
+        return self._build_response(request, interaction)
+
+    @staticmethod
+    def _build_response(request, interaction):
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        if interaction['encoding'] == 'base64':
+            response._content = base64.b64decode(interaction['content'])
+        else:
+            response._content = interaction['content'].encode('utf-8')
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        return response
+
+
+_original_send = HTTPAdapter.send
+
+
+@contextmanager
+def recording(path):
+    """
+    Records every HTTP request made in the process, by the bots' praw.Reddit instances as well as the scrapers,
+    while the context is active.
+    e.g. with recording("data/cassette.jsonl.gz"):
+             # run bots
+    :param path: Path of the cassette. Interactions are appended if it already exists.
+    """
+    recorder = CassetteRecorder(path)
+
+    def send(adapter, request, *args, **kwargs):
+        started = time.monotonic()
+        response = _original_send(adapter, request, *args, **kwargs)
+        response.content  # streamed responses are read completely, so they can be saved
+        recorder.record(request, response, time.monotonic() - started)
+        return response
+
+    HTTPAdapter.send = send
+    logger.info("Recording HTTP traffic: cassette=[%s]", path)
+    try:
+        yield recorder
+    finally:
+        HTTPAdapter.send = _original_send
+        recorder.close()
+
+
+@contextmanager
+def replaying(path, realtime=False):
+    """
+    Answers every HTTP request made in the process from a cassette while the context is active.
+    :param path: Path of a recorded cassette
+    :param realtime: If True, responses take as long as they did when they were recorded.
+    """
+    player = CassettePlayer(path, realtime)
+
+    def send(adapter, request, *args, **kwargs):
+        return player.play(request)
+
+    HTTPAdapter.send = send
+    logger.info("Replaying HTTP traffic: cassette=[%s], interactions=[%s], realtime=[%s]",
+                path, len(player.interactions), realtime)
+    try:
+        yield player
+    finally:
+        HTTPAdapter.send = _original_send
@@ -0,0 +1,146 @@
+import datetime
+import threading
+import time
+
+
+class Clock(object):
+    """
+    Tells bots what time it is and lets them sleep. Bots read time only through their clock, so a VirtualClock
+    can be given to them instead, e.g. to simulate weeks of work in seconds.
+    A Clock can be called like time.time, so it can also be given to code that takes a clock function,
+    e.g. a LeaseBackend.
+    """
+    def __call__(self):
+        return self.time()
+
+    def time(self):
+        """
+        :return: Seconds since the epoch
+        """
+        return time.time()
+
+    def monotonic(self):
+        """
+        :return: Seconds from an arbitrary point, which never go backwards. Use it to measure durations.
+        """
+        return time.monotonic()
+
+    def now(self, tz=None):
+        """
+        :return: The local time as a datetime, or the time in tz if it is given
+        """
+        return datetime.datetime.fromtimestamp(self.time(), tz)
+
+    def utcnow(self):
+        """
+        :return: The time in UTC as a naive datetime
+        """
+        return datetime.datetime.utcfromtimestamp(self.time())
+
+    def today(self):
+        """
+        :return: The local date
+        """
+        return self.now().date()
+
+    def wait(self, event, timeout=None):
+        """
+        Sleeps until the event is set or the timeout passes.
+        :param event: A threading.Event
+        :param timeout: Number of seconds, or None to wait for the event only
+        :return: True if the event is set
+        """
+        return event.wait(timeout)
+
+    def register(self):
+        """
+        Tells the clock that a thread that sleeps on it has started. The system clock does not need to know.
+        """
+        pass
+
+    def unregister(self):
+        """
+        Tells the clock that a thread that called register() has finished.
+        """
+        pass
+
+
+SYSTEM_CLOCK = Clock()
+
+
+class VirtualClock(Clock):
+    """
+    A clock whose time only moves forward when every registered thread is sleeping, and then jumps straight to the
+    earliest time one of them is waiting for, so sleeps end instantly and in the right order. Work takes no time
+    on a VirtualClock, unless advance() is called.
+    Threads must call register() before they first sleep, and unregister() when they finish. Bot does this itself.
+    If no threads are registered, e.g. when a test calls wait() directly, every wait() moves the clock at once.
+    """
+    def __init__(self, start=None):
+        """
+        :param start: The starting time in seconds since the epoch. Defaults to the current time.
+        """
+        self._now = time.time() if start is None else start
+        self._condition = threading.Condition()
+        self._running = 0  # registered threads that are not sleeping
+        self._deadlines = []  # times the sleeping threads are waiting for
+
+    def time(self):
+        with self._condition:
+            return self._now
+
+    def monotonic(self):
+        return self.time()
+
+    def advance(self, seconds):
+        """
+        Moves the clock forward, waking the threads whose sleep ends.
+        """
+        with self._condition:
+            self._now += seconds
+            self._condition.notify_all()
+
+    def register(self):
+        with self._condition:
+            self._running += 1
+
+    def unregister(self):
+        with self._condition:
+            self._running -= 1
+            self._skip_ahead()
+
+    def wait_until_idle(self):
+        """
+        Waits until every other registered thread is sleeping and none of their sleeps has ended, e.g. so a
+        simulation can be inspected between two steps. The calling thread must be registered, so the clock
+        does not move meanwhile.
+        """
+        with self._condition:
+            while self._running > 1 or any(deadline <= self._now for deadline in self._deadlines):
+                self._condition.wait(0.05)
+
+    def _skip_ahead(self):
+        if self._running <= 0 and self._deadlines:
+            self._now = max(self._now, min(self._deadlines))
+            self._condition.notify_all()
+
+    def wait(self, event, timeout=None):
+        """
+        Sleeps until the event is set or the clock reaches the end of the timeout.
+        Events are set by other threads without telling the clock, so it also checks them every 50ms of real time.
+        """
+        with self._condition:
+            deadline = None if timeout is None else self._now + timeout
+            if deadline is not None:
+                self._deadlines.append(deadline)
+            self._running -= 1
+            self._condition.notify_all()  # for wait_until_idle()
+            try:
+                self._skip_ahead()
+                while not event.is_set() and (deadline is None or self._now < deadline):
+                    self._condition.wait(0.05)
+            finally:
+                self._running += 1
+                if deadline is not None:
+                    self._deadlines.remove(deadline)
+            return event.is_set()
@@ -2,15 +2,20 @@ from logging import getLogger
 from logging.config import fileConfig
 import os
 import configparser
+from config import log_pipeline
 
 config_directory = os.path.dirname(__file__)
 root = os.path.dirname(config_directory)
 log_directory = os.path.join(root, 'logs')
 log_file_name = os.path.join(log_directory, "botlog.log")
+data_directory = os.path.join(root, 'data')
 
 if not os.path.exists(log_directory):
     os.mkdir(log_directory)
 
+if not os.path.exists(data_directory):
+    os.mkdir(data_directory)
+
 if not os.path.exists(log_file_name):
     with open(log_file_name, "a"):
         pass
@@ -24,7 +29,5 @@ if os.path.sep == "\\":
     new_args = new_args.replace("\\", "\\\\")
 
 cp['handler_file_handler']['args'] = new_args
-with open(log_config_file_name, "w") as config_file:
-    cp.write(config_file)
-
-fileConfig(os.path.join(config_directory, "log_config.ini"))
+fileConfig(cp)
+log_pipeline.start(getLogger())
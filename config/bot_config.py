@@ -34,6 +34,48 @@ def should_run_once():
         return False
 
 
+def should_use_news_feed():
+    try:
+        return get_flag('use_news_feed')
+    except KeyError:
+        return False
+
+
+def should_use_events_api():
+    try:
+        return get_flag('use_events_api')
+    except KeyError:
+        return False
+
+
+def should_scan_comments():
+    try:
+        return get_flag('scan_comments')
+    except KeyError:
+        return False
+
+
+def should_use_sharding():
+    try:
+        return get_flag('use_sharding')
+    except KeyError:
+        return False
+
+
+def should_use_tracing():
+    try:
+        return get_flag('use_tracing')
+    except KeyError:
+        return False
+
+
+def should_use_control_socket():
+    try:
+        return get_flag('use_control_socket')
+    except KeyError:
+        return False
+
+
 def get_intervals():
     return CONFIG['intervals']
 
@@ -48,3 +90,91 @@ def get_sleep_intervals():
 
 def get_sleep_interval(bot_class_name='debug'):
     return get_sleep_intervals()[bot_class_name]
+
+
+def get_supervisor_settings():
+    return CONFIG['supervisor']
+
+
+def get_supervisor_setting(setting_name):
+    return get_supervisor_settings()[setting_name]
+
+
+def get_rate_limit_settings():
+    return CONFIG['rate_limit']
+
+
+def get_rate_limit_setting(setting_name):
+    return get_rate_limit_settings()[setting_name]
+
+
+def get_outbox_settings():
+    return CONFIG['outbox']
+
+
+def get_outbox_setting(setting_name):
+    return get_outbox_settings()[setting_name]
+
+
+def get_auth_settings():
+    return CONFIG['auth']
+
+
+def get_auth_setting(setting_name):
+    return get_auth_settings()[setting_name]
+
+
+def get_profiling_settings():
+    return CONFIG['profiling']
+
+
+def get_profiling_setting(setting_name):
+    return get_profiling_settings()[setting_name]
+
+
+def get_sharding_settings():
+    return CONFIG['sharding']
+
+
+def get_sharding_setting(setting_name):
+    return get_sharding_settings()[setting_name]
+
+
+def get_ticket_scan_settings():
+    return CONFIG['ticket_scan']
+
+
+def get_ticket_scan_setting(setting_name):
+    return get_ticket_scan_settings()[setting_name]
+
+
+def get_near_duplicate_settings():
+    return CONFIG['near_duplicates']
+
+
+def get_near_duplicate_setting(setting_name):
+    return get_near_duplicate_settings()[setting_name]
+
+
+def get_tracing_settings():
+    return CONFIG['tracing']
+
+
+def get_tracing_setting(setting_name):
+    return get_tracing_settings()[setting_name]
+
+
+def get_control_settings():
+    return CONFIG['control']
+
+
+def get_control_setting(setting_name):
+    return get_control_settings()[setting_name]
+
+
+def get_dispatch_settings():
+    return CONFIG['dispatch']
+
+
+def get_dispatch_setting(setting_name):
+    return get_dispatch_settings()[setting_name]
@@ -0,0 +1,97 @@
+import atexit
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+from collections.abc import Mapping
+from logging import Formatter
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+
+IMMUTABLE_ARG_TYPES = (str, int, float, type(None))
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    A QueueHandler that hands records to the writer thread without formatting them when it is safe to.
+    The stock QueueHandler formats every message in the calling thread so that records can be pickled,
+    but our queue never leaves the process, so formatting is left to the writer thread.
+    Arguments other than strings and numbers may change before the writer thread gets to them, so a message with
+    such arguments is merged in the calling thread, and the writer thread logs what the bot saw when it logged.
+    """
+    def prepare(self, record):
+        args = record.args
+        if isinstance(args, Mapping):
+            args = args.values()
+        if args and not all(isinstance(arg, IMMUTABLE_ARG_TYPES) for arg in args):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+class JsonFormatter(Formatter):
+    """
+    Formats each record as a single line of JSON. To use it, set a handler's formatter to "json" in log_config.ini.
+    """
+    def format(self, record):
+        entry = {'level': record.levelname,
+                 'time': self.formatTime(record, self.datefmt),
+                 'logger': record.name,
+                 'thread': record.threadName,
+                 'file': record.filename,
+                 'line': record.lineno,
+                 'function': record.funcName,
+                 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class CompressingTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    A TimedRotatingFileHandler that gzips rotated log files.
+    The rotated file is renamed during rollover, and the compression happens in a separate thread so
+    the writer thread can go straight back to emptying the queue.
+    """
+    def __init__(self, *args, **kwargs):
+        super(CompressingTimedRotatingFileHandler, self).__init__(*args, **kwargs)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self._rotate_and_compress
+
+    @staticmethod
+    def _rotate_and_compress(source, dest):
+        if not os.path.exists(source):
+            return
+        pending = dest + ".pending"
+        os.rename(source, pending)
+        threading.Thread(target=_compress, args=(pending, dest), daemon=True).start()
+
+
+def _compress(source, dest):
+    """
+    Gzips source into dest, and removes source afterwards.
+    """
+    with open(source, "rb") as ifile, gzip.open(dest, "wb") as ofile:
+        shutil.copyfileobj(ifile, ofile)
+    os.remove(source)
+
+
+def start(logger):
+    """
+    Moves the handlers of a logger behind a queue that is emptied by a single writer thread.
+    After this is called, logging calls in the bots only put records on the queue, and all formatting,
+    file writes, and rotation happen in the writer thread.
+    :param logger: The logger whose handlers will be moved, usually the root logger.
+    :return: The running QueueListener. It is stopped automatically when the program exits.
+    """
+    handlers = logger.handlers[:]
+    for handler in handlers:
+        logger.removeHandler(handler)
+    log_queue = queue.Queue(-1)
+    logger.addHandler(LazyQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
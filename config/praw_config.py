@@ -1,5 +1,6 @@
 import os
 import configparser
+import tempfile
 from enum import IntEnum
 CONFIG_PATH = os.path.dirname(os.path.abspath(__file__))
 PRAW_FILE_PATH = os.path.join(os.path.dirname(CONFIG_PATH), "praw.ini")
@@ -61,10 +62,17 @@ def get_value(site_name, key, _current_parser=None):
 def _write_config(parser):
     """
     Writes to the config file. First you have to add values to the ConfigParser object, then you call this function.
+    The parser is written to a temporary file that then replaces the config file, so the file is never half-written.
     :param parser: The ConfigParser object whose data will be saved to the config file.
     """
-    with open(PRAW_FILE_PATH, "w") as c_file:
-        parser.write(c_file)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(PRAW_FILE_PATH), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as c_file:
+            parser.write(c_file)
+        os.replace(temp_path, PRAW_FILE_PATH)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
 
 def get_multi_values(site_name, keys, _current_parser=None):
@@ -108,6 +116,21 @@ def set_reddit_oauth_refresh_token(site_name, token, _current_parser=None):
     set_value(site_name, OAUTH_CRED_KEYS[CredKeys.refresh], token, _current_parser)
 
 
+def set_reddit_oauth_refresh_tokens(tokens, _current_parser=None):
+    """
+    Saves the refresh tokens of several accounts with a single write of the config file.
+    :param tokens: A dict mapping site names to new refresh tokens
+    Other params are the same as in other methods.
+    """
+    parser = _get_parser(_current_parser)
+    for site_name, token in tokens.items():
+        try:
+            parser[site_name][OAUTH_CRED_KEYS[CredKeys.refresh]] = token
+        except KeyError:
+            raise InvalidSiteName
+    _write_config(parser)
+
+
 def get_reddit_oauth_scope(site_name, _current_parser=None):
     """
     Retrieves the list of Reddit permissions the bot has, which is stored in the config file.
@@ -133,6 +156,33 @@ def get_bot_class_name(site_name, _current_parser=None):
     """
     return get_value(site_name, 'bot_class_name', _current_parser)
 
+def get_site_settings(site_name, _current_parser=None):
+    """
+    Gets every value of an account's section in the config file.
+    :return: A dict mapping keys to values
+    """
+    parser = _get_parser(_current_parser)
+    try:
+        return dict(parser[site_name])
+    except KeyError:
+        raise InvalidSiteName
+
+
+def reload_praw_settings(_current_parser=None):
+    """
+    PRAW reads praw.ini once, when it is imported, and praw.Reddit objects look up their site's credentials in
+    those settings. This copies every section of the config file into PRAW's settings, so accounts that were added
+    or changed since the program started can log in. Sections that were removed are left alone.
+    """
+    import praw.settings
+    parser = _get_parser(_current_parser)
+    for site_name in get_all_site_names(parser):
+        if praw.settings.CONFIG.has_section(site_name):
+            praw.settings.CONFIG.remove_section(site_name)
+        praw.settings.CONFIG.add_section(site_name)
+        for key, value in parser[site_name].items():
+            praw.settings.CONFIG.set(site_name, key, value)
+
 if __name__ == '__main__':
     print("Config path: {}".format(CONFIG_PATH))
     print("Praw file path: {}".format(PRAW_FILE_PATH))
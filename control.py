@@ -0,0 +1,158 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+from contextlib import contextmanager
+
+from config import bot_config
+from config import data_directory
+from config import getLogger
+
+logger = getLogger()
+
+SOCKET_PATH = os.path.join(data_directory, bot_config.get_control_setting('socket_file'))
+STOP_TIMEOUT = bot_config.get_control_setting('stop_timeout')
+COMMANDS = ('list', 'start', 'stop', 'restart', 'reload')
+
+
+class ControlError(ValueError):
+    pass
+
+
+def handle_request(dispatch, request, stop_timeout=STOP_TIMEOUT):
+    """
+    Carries out one request sent to the control socket.
+    :param dispatch: The running Dispatch
+    :param request: A dict with a 'command' (one of COMMANDS), and the 'account' and 'bot' class name it is for.
+                    Every command but list and reload needs an account. If no bot is given,
+                    start, stop, and restart apply to every bot of the account.
+    :param stop_timeout: Time to wait for each bot that is stopped
+    :return: The result of the command, which can be converted to JSON
+    """
+    command, account, bot = request.get('command'), request.get('account'), request.get('bot')
+    if command == 'list':
+        return dispatch.get_status()
+    elif command == 'reload':
+        return dispatch.reload_accounts(stop_timeout)
+    elif command not in COMMANDS:
+        raise ControlError("Unknown command: {}".format(command))
+    elif not account:
+        raise ControlError("The {} command needs an account".format(command))
+
+    if command == 'start' and bot:
+        dispatch.start_bot(account, bot)
+    elif command == 'start':
+        dispatch.start_account(account)
+    elif command == 'stop' and bot:
+        dispatch.stop_bot(account, bot, stop_timeout)
+    elif command == 'stop':
+        if not dispatch.get_class_names(account):
+            raise ControlError("Account is not running: {}".format(account))
+        dispatch.remove_account(account, stop_timeout)
+    else:
+        dispatch.restart_bots(account, bot, stop_timeout)
+    return dispatch.get_class_names(account)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """
+    Reads requests as lines of JSON, and answers each with a line of JSON:
+    {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+    """
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                logger.info("Control request: request=[%s]", request)
+                response = {'ok': True, 'result': handle_request(self.server.dispatch, request,
+                                                                 self.server.stop_timeout)}
+            except Exception as e:
+                logger.warning("Control request failed: error=[%r]", e)
+                response = {'ok': False, 'error': str(e) or repr(e)}
+            self.wfile.write((json.dumps(response, default=str) + "\n").encode('utf-8'))
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Listens on a Unix socket for commands that change a running Dispatch, e.g. from scripts/control.py.
+    Only the user running the program can connect to the socket.
+    """
+    daemon_threads = True
+
+    def __init__(self, dispatch, path=SOCKET_PATH, stop_timeout=STOP_TIMEOUT):
+        """
+        :param dispatch: The Dispatch the commands are carried out on
+        :param path: Path of the socket. A socket left behind by a program that has exited is replaced.
+        :param stop_timeout: Time to wait for each bot that is stopped
+        """
+        self.dispatch = dispatch
+        self.path = path
+        self.stop_timeout = stop_timeout
+        if os.path.exists(path):
+            if _is_listening(path):
+                raise ControlError("Another program is listening on the control socket: {}".format(path))
+            os.remove(path)
+        super(ControlServer, self).__init__(path, _RequestHandler)
+
+    def server_bind(self):
+        """
+        Creates the socket with no permissions for other users, so it is never reachable by them, even briefly.
+        """
+        old_umask = os.umask(0o177)
+        try:
+            super(ControlServer, self).server_bind()
+        finally:
+            os.umask(old_umask)
+
+    def server_close(self):
+        super(ControlServer, self).server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _is_listening(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+            return True
+        except OSError:
+            return False
+
+
+@contextmanager
+def serving(dispatch, path=SOCKET_PATH, stop_timeout=STOP_TIMEOUT):
+    """
+    Accepts control commands for a Dispatch while the context is active.
+    e.g. with dispatch, serving(dispatch):
+             # run bots
+    :return: The ControlServer
+    """
+    server = ControlServer(dispatch, path, stop_timeout)
+    thread = threading.Thread(target=server.serve_forever, name="ControlServer", daemon=True)
+    thread.start()
+    logger.info("Control socket listening: path=[%s]", path)
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def send_command(command, account=None, bot=None, path=SOCKET_PATH, timeout=None):
+    """
+    Sends a command to a running program's control socket, and waits for its answer.
+    :param timeout: Seconds to wait for the answer, or None to wait forever. Stopping bots can take a while.
+    :return: The result of the command
+    :raises ControlError: if the command failed
+    """
+    request = {'command': command, 'account': account, 'bot': bot}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall((json.dumps(request) + "\n").encode('utf-8'))
+        with sock.makefile('rb') as answer:
+            response = json.loads(answer.readline().decode('utf-8'))
+    if not response['ok']:
+        raise ControlError(response['error'])
+    return response['result']
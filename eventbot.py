@@ -3,13 +3,27 @@ from bs4 import BeautifulSoup
 import requests
 import datetime
 import json
+import praw
+from hashlib import sha1
+from outbox import SENT, PENDING, SENDING
 from cachetools import ttl_cache
 from pytz import timezone, utc
 from dateutil.parser import parse
 from bots import RedditBot
+from clock import SYSTEM_CLOCK
+from config.bot_config import get_interval, should_use_events_api
 from config.praw_config import get_all_site_names
+from eventsapi import EventsApiClient
+from singleflight import SingleFlight
+from store import JsonStore
+import tracing
 # region constants
 BASE_URL = "http://www.upressonline.com/fauevents/"
+EVENTS_API_URL = "http://www.upressonline.com/wp-json/tribe/events/v1/events"
+EVENT_LOOKAHEAD_DAYS = get_interval('event_lookahead_days')
+USE_EVENTS_API = should_use_events_api()
+EVENT_LIST_CACHE_SECONDS = get_interval('event_list_cache_seconds')
+TABLE_POST_CHECK_CYCLES = get_interval('table_post_check_cycles')
 TABLE_ROW = "{title} | {date} | {description}\n"
 HYPERLINK = "[{text}]({url})"
 HEADER_DIVIDER = "---|---|----\n"
@@ -17,34 +31,46 @@ TABLE_HEADER = TABLE_ROW.format(title='Title', date='Date', description='Descrip
 # endregion
 
 logger = getLogger()
+event_lists = SingleFlight(ttl=EVENT_LIST_CACHE_SECONDS)  # source -> event JSON strings, shared by every EventBot
 
 
 class EventBot(RedditBot):
     def __init__(self, user_name, *args, **kwargs):
         super(EventBot, self).__init__(user_name=user_name, *args, **kwargs)
         self.base_url = BASE_URL
+        self.events_api = EventsApiClient(EVENTS_API_URL)
         self.post_title = "{month} Event Calendar"
+        self.post_index = JsonStore("eventbot_posts_{}".format(self.USER_NAME))  # subreddit/month -> id and hash
 
     @staticmethod
-    def has_event_passed(event_json):
+    @tracing.traced("eventbot.has_event_passed")
+    def has_event_passed(event_json, clock=SYSTEM_CLOCK):
         """
         Takes the date field from the event_json strips it of all symbols and then
-        format it into a time object(US/Eastern) then compare it with the system current time
+        format it into a time object(US/Eastern) then compare it with the current time
+        Events from the events API carry their exact start time, which is used instead of the displayed date.
         :param event_json: JSON stripped from the event's data-tribejson HTML attribute.
         :type event_json: str
+        :param clock: The Clock that tells the current time
         :return: return true if an event has passed
         """
         event_dict = EventBot._get_event_dict(event_json)
-        timestamp = event_dict['date']
-        if " @ " in timestamp:
-            full_date = timestamp.replace(" @ ", " ")
-            dash_idx = full_date.index('-')
-            date = full_date[:dash_idx - 1]
+        if event_dict['start']:
+            start = parse(event_dict['start'])
         else:
-            date = timestamp
-        start_datetime = timezone("US/Eastern").localize(parse(date), is_dst=None).astimezone(utc)
+            timestamp = event_dict['date']
+            if " @ " in timestamp:
+                full_date = timestamp.replace(" @ ", " ")
+                dash_idx = full_date.index('-')
+                date = full_date[:dash_idx - 1]
+            else:
+                date = timestamp
+            # the displayed date has no year, so it is taken from the clock
+            default = clock.now().replace(hour=0, minute=0, second=0, microsecond=0)
+            start = parse(date, default=default)
+        start_datetime = timezone("US/Eastern").localize(start, is_dst=None).astimezone(utc)
 
-        now = utc.localize(datetime.datetime.utcnow())  # get current time in UTC timezone
+        now = utc.localize(clock.utcnow())  # get current time in UTC timezone
         return now > start_datetime  # True if now is after start time
 
     @staticmethod
@@ -53,12 +79,12 @@ class EventBot(RedditBot):
         Makes the HTTP request to the event calendar website.
         :return: String containing HTML, or None if the response is not 200 OK.
         """
-        logger.info("Getting event calendar HTML from {}".format(BASE_URL))
+        logger.info("Getting event calendar HTML from %s", BASE_URL)
         r = requests.get(BASE_URL)
         if r.status_code == requests.codes.ok:
             data = r.text
             return data
-        logger.warning("Returning None, Response not OK: code={}".format(r.status_code))
+        logger.warning("Returning None, Response not OK: code=%s", r.status_code)
         return None
 
     @staticmethod
@@ -73,74 +99,235 @@ class EventBot(RedditBot):
         event_dict = json.loads(event_json)
         return {'title': HYPERLINK.format(text=event_dict['title'], url=event_dict['permalink']),
                 'date': event_dict['dateDisplay'],
+                'start': event_dict.get('startDate'),
                 'description': event_dict['excerpt'][3:-4] or "None provided"}
 
-    @staticmethod
-    def _get_current_month_name():
-        return datetime.datetime.now().strftime('%B')
+    def _get_current_month_name(self):
+        return self.clock.now().strftime('%B')
 
     def _get_current_post_title(self):
         return self.post_title.format(month=self._get_current_month_name())
 
+    def _get_post_index_key(self, subreddit):
+        return "{}/{}".format(subreddit.lower(), self.clock.now().strftime('%Y-%m'))
+
+    @staticmethod
+    def _hash_contents(contents):
+        return sha1(contents.encode('utf-8')).hexdigest()
+
+    def _remember_table_post(self, subreddit, contents, post_id=None, write_id=None):
+        """
+        Saves a hash of the contents of the current month's table post in a subreddit, along with the post's id,
+        and the id of the queued write that will submit or edit it, if any. The posts of previous months are
+        forgotten.
+        """
+        key = self._get_post_index_key(subreddit)
+        prefix = "{}/".format(subreddit.lower())
+        for old_key in self.post_index.keys():
+            if old_key.startswith(prefix) and old_key != key:
+                self.post_index.delete(old_key)
+        entry = {'id': post_id, 'hash': self._hash_contents(contents)}
+        if write_id:
+            entry['pending'] = write_id
+        self.post_index.set(key, entry)
+
+    def _is_post_check_due(self):
+        """
+        The index only says what the bot last posted, so every few cycles the posts are read back from Reddit,
+        in case one was deleted or edited by someone else. The first cycle of a bot always checks.
+        """
+        return self.cycles % TABLE_POST_CHECK_CYCLES == 0
+
+    def _get_indexed_post(self, subreddit):
+        """
+        Gets the index entry for the current month's table post in a subreddit. If the post was queued
+        for submission or editing, the outbox is checked to see whether it has been sent yet. The hash is only
+        trusted once the write was sent: if an edit was given up on, the hash is cleared so the post is read
+        back from Reddit, and if a submission was given up on, the post is forgotten.
+        :return: A dict with id, hash, and possibly pending keys, or None if the post is not in the index.
+        """
+        key = self._get_post_index_key(subreddit)
+        entry = self.post_index.get(key)
+        if entry and entry.get('pending'):
+            write = self.outbox.get_write(entry['pending'])
+            if write and write['status'] == SENT:
+                entry = {'id': write['result'], 'hash': entry['hash']}
+                self.post_index.set(key, entry)
+            elif not write or write['status'] not in (PENDING, SENDING):
+                logger.warning("Queued table post was not sent: subreddit=[/r/%s], writeId=[%s]",
+                               subreddit, entry['pending'])
+                if entry['id']:
+                    entry = {'id': entry['id'], 'hash': None}
+                    self.post_index.set(key, entry)
+                else:
+                    self.post_index.delete(key)
+                    entry = None
+        return entry
+
     @staticmethod
-    def _make_reddit_table(html):
+    def _make_reddit_table(html, clock=SYSTEM_CLOCK):
         """
         Scrapes event data from HTML and creates a Reddit table with it.
         :param html: HTML from the event website
         :type data: str
+        :param clock: The Clock that tells which events have passed
+        :return: A single string containing a Reddit markdown table
+        """
+        return EventBot._make_reddit_table_from_events(EventBot._parse_event_jsons(html), clock)
+
+    @staticmethod
+    def _parse_event_jsons(html):
+        """
+        :param html: HTML from the event website
+        :return: A list of the JSON strings in the data-tribejson attributes of the events
+        """
+        with tracing.span("eventbot.parse", characters=len(html)) as span:
+            soup = BeautifulSoup(html, "html.parser")
+            event_jsons = [event.get('data-tribejson')
+                           for event in soup.find_all('div', attrs={'data-tribejson': True})]
+            span.set_attribute('events', len(event_jsons))
+        return event_jsons
+
+    @staticmethod
+    def _scrape_event_jsons():
+        """
+        :raises ValueError if the page cannot be read, so the failure is not shared with later calls.
+        :return: The events on the event calendar website as JSON strings
+        """
+        html = EventBot._get_event_html()
+        if not html:
+            raise ValueError("Could not read the event calendar: url=[{}]".format(BASE_URL))
+        return EventBot._parse_event_jsons(html)
+
+    @staticmethod
+    def _make_reddit_table_from_events(event_jsons, clock=SYSTEM_CLOCK):
+        """
+        Creates a Reddit table from event JSON, leaving out events that have already started.
+        :param event_jsons: A list of JSON strings, each in the shape of the data-tribejson HTML attribute
+        :param clock: The Clock that tells which events have passed
         :return: A single string containing a Reddit markdown table
         """
         logger.info("Generating reddit table")
 
         # start with the header, and append a new row for each event
-        table = TABLE_HEADER
-        soup = BeautifulSoup(html, "html.parser")
-        for event in soup.find_all('div', attrs={'data-tribejson': True}):
-            event_json = event.get('data-tribejson')
-            event_dict = EventBot._get_event_dict(event_json)
-            if not EventBot.has_event_passed(event_json):
-                table += TABLE_ROW.format(**event_dict)
+        with tracing.span("eventbot.render", events=len(event_jsons)) as span:
+            table = TABLE_HEADER
+            rows = 0
+            for event_json in event_jsons:
+                event_dict = EventBot._get_event_dict(event_json)
+                if not EventBot.has_event_passed(event_json, clock):
+                    table += TABLE_ROW.format(**event_dict)
+                    rows += 1
+            span.set_attribute('rows', rows)
         return table
 
     def create_new_table(self):
         """
-        Uses all the helper functions to get the HTML, scrape it, and generate a Reddit table.
+        Uses all the helper functions to get the events, and generate a Reddit table.
+        If the events API is enabled in config/bot_config.yaml, events are read from the calendar's JSON listing,
+        and the calendar's HTML is only scraped if the listing cannot be read.
+        Every EventBot in the process shares one download and parse of the events, and the events are kept for
+        intervals.event_list_cache_seconds. Events that have passed since then are left out of the table.
         :return: A single string containing a Reddit markdown table, or None if an error happens.
         """
-        table = None
-        html = self._get_event_html()
-        if html:
-            table = EventBot._make_reddit_table(html)
-        else:
+        if USE_EVENTS_API:
+            try:
+                return self.create_new_table_from_api()
+            except (requests.RequestException, ValueError, KeyError):
+                logger.exception("Could not read the events API. Scraping the calendar HTML instead.")
+        try:
+            event_jsons = event_lists.do(BASE_URL, EventBot._scrape_event_jsons)
+        except ValueError:
             logger.error("Table could not be generated.")
-        return table
+            return None
+        return EventBot._make_reddit_table_from_events(event_jsons, self.clock)
+
+    def create_new_table_from_api(self):
+        """
+        Gets upcoming events from the calendar's JSON listing, and generates a Reddit table.
+        :return: A single string containing a Reddit markdown table
+        """
+        now = self.clock.now()
+        event_jsons = event_lists.do((EVENTS_API_URL, now.date()), self.events_api.get_events,
+                                     now, now + datetime.timedelta(days=EVENT_LOOKAHEAD_DAYS))
+        return EventBot._make_reddit_table_from_events(event_jsons, self.clock)
 
     def get_existing_table_post(self, subreddit):
         """
-         Searches a subreddit for a specific post. If found, return it. Else, return None.
+        Gets the current month's table post in a subreddit. Posts this bot already knows about are fetched
+        directly by id, and a subreddit search is only done when the post is not in the index, e.g. when
+        a new month starts.
+        :param subreddit: The subreddit where the post will be looked for
+        :return: a Reddit post object, or None
+        """
+        entry = self._get_indexed_post(subreddit)
+        if entry and entry.get('pending'):
+            logger.info("Table post is queued but not submitted yet: subreddit=[/r/%s]", subreddit)
+            return None
+        if entry:
+            try:
+                with tracing.span("reddit.get_submission", subreddit=subreddit, id=entry['id']):
+                    post = self.r.get_submission(submission_id=entry['id'])
+                if post.author is not None:
+                    return post
+                logger.info("Indexed table post was deleted: subreddit=[/r/%s], id=[%s]", subreddit, entry['id'])
+            except praw.errors.HTTPException:
+                logger.warning("Indexed table post could not be fetched: subreddit=[/r/%s], id=[%s]",
+                               subreddit, entry['id'])
+            self.post_index.delete(self._get_post_index_key(subreddit))
+        return self.search_existing_table_post(subreddit)
+
+    def search_existing_table_post(self, subreddit):
+        """
+         Searches a subreddit for a specific post. If found, add it to the index and return it. Else, return None.
          :param subreddit: The subreddit where the url will be searched for
          :return: a Reddit post object, or None
          """
         post_title = self._get_current_post_title()
         to_return = None
-        logger.info("Looking for existing table post: subreddit=[/r/{}], postTitle=[{}]".format(subreddit, post_title))
-        for post in self.r.search("title:{} AND author:{}".format(post_title, self.USER_NAME), subreddit=subreddit):
-            if post:
-                logger.info("Existing table post found: {}".format(post))
-                to_return = post
-                break
-        else:
-            logger.info("No existing table post found.")
+        logger.info("Looking for existing table post: subreddit=[/r/%s], postTitle=[%s]", subreddit, post_title)
+        with tracing.span("reddit.search", subreddit=subreddit) as span:
+            for post in self.r.search("title:{} AND author:{}".format(post_title, self.USER_NAME),
+                                      subreddit=subreddit):
+                if post:
+                    logger.info("Existing table post found: %s", post)
+                    self._remember_table_post(subreddit, post.selftext, post_id=post.id)
+                    to_return = post
+                    break
+            else:
+                logger.info("No existing table post found.")
+            span.set_attribute('found', to_return is not None)
         return to_return
 
     def submit_new_table(self, table):
         """
-        Submit a new self post to Reddit containing a markdown table..
+        Submit a new self post to every subreddit containing a markdown table.
         :param table: A string containing a reddit markdown table
+        :return: A dict mapping each subreddit to a SubredditResult.
         """
-        for subreddit in self.subreddits:
-            logger.info("Submitting new table post in /r/" + subreddit)
-            self.r.submit(subreddit, self._get_current_post_title(), text=table)
+        return self.for_each_subreddit(lambda subreddit: self._submit_new_table_to_subreddit(table, subreddit))
+
+    def _submit_new_table_to_subreddit(self, table, subreddit):
+        """
+        Queue a new self post containing a markdown table for a single subreddit. If a post for the current
+        month is already queued, it is replaced so that only the newest table is submitted.
+        :return: The id of the queued write
+        """
+        logger.info("Queueing new table post in /r/%s", subreddit)
+        write_id = self.queue_submit(subreddit, self._get_current_post_title(), text=table,
+                                     coalesce_key="table:{}".format(self._get_post_index_key(subreddit)))
+        self._remember_table_post(subreddit, table, write_id=write_id)
+        return write_id
+
+    def _queue_table_edit(self, table, subreddit, post_id):
+        """
+        Queue an edit of the current month's table post in a single subreddit. The new contents are only
+        trusted by the index once the edit has been sent.
+        :return: The id of the queued write
+        """
+        write_id = self.queue_edit(post_id, table)
+        self._remember_table_post(subreddit, table, post_id=post_id, write_id=write_id)
+        return write_id
 
     @staticmethod
     def is_table_empty(table):
@@ -154,26 +341,52 @@ class EventBot(RedditBot):
             return table == TABLE_HEADER
         raise ValueError("The given table parameter is not the right markdown table, or not one at all.\ntable:\n" + table)
 
+    def update_table_post(self, table, is_empty, subreddit):
+        """
+        Edits the current month's table post in a subreddit, or submits a new one if none exists.
+        If the contents match what the index says was posted, Reddit is not asked, except every
+        intervals.table_post_check_cycles cycles, when the post is read back and repaired if it was changed.
+        :param table: A string containing a reddit markdown table
+        :param is_empty: True if the table has no events in it
+        :param subreddit: The subreddit whose table post will be updated
+        """
+        contents = table if not is_empty else "There are no upcoming events scheduled at this time. " \
+                                              "I will check again in {} minutes.".format(self.sleep_interval/60)
+        entry = self._get_indexed_post(subreddit)
+        if entry and entry['hash'] == self._hash_contents(contents) and \
+                (entry.get('pending') or not self._is_post_check_due()):
+            logger.info("Calendar is unchanged. Not editing existing table post.")
+            return
+        if entry and entry.get('pending'):
+            if self.outbox.get_write(entry['pending'])['status'] == SENDING:
+                logger.info("Table post is being sent. It will be updated next time.")
+            elif entry['id']:
+                logger.info("Replacing queued edit of table post")
+                self._queue_table_edit(contents, subreddit, entry['id'])
+            else:
+                logger.info("Replacing queued table post")
+                self._submit_new_table_to_subreddit(contents, subreddit)
+            return
+        existing_post = self.get_existing_table_post(subreddit)
+        if existing_post:
+            if contents != existing_post.selftext:
+                logger.info("Queueing edit of existing table post")
+                self._queue_table_edit(contents, subreddit, existing_post.id)
+            else:
+                logger.info("Calendar is unchanged. Not editing existing table post.")
+                self._remember_table_post(subreddit, contents, post_id=existing_post.id)
+        elif not is_empty:
+            logger.info("Submitting new table post")
+            self._submit_new_table_to_subreddit(table, subreddit)
+        else:
+            logger.info("Not submitting new calendar post because able is empty")
+
     def work(self):
         table = self.create_new_table()
         is_empty = self.is_table_empty(table)
-        logger.info("Table is {}empty".format('' if is_empty else 'not '))
-        for subreddit in self.subreddits:
-            existing_post = self.get_existing_table_post(subreddit)
-            if existing_post:
-                contents = table if not is_empty else "There are no upcoming events scheduled at this time. " \
-                                                      "I will check again in {} minutes.".format(self.sleep_interval/60)
-                if contents != existing_post.selftext:
-                    logger.info("Editing existing table post")
-                    existing_post.edit(contents)
-                else:
-                    logger.info("Calendar is unchanged. Not editing existing table post.")
-            elif not is_empty:
-                logger.info("Submitting new table post")
-                self.submit_new_table(table)
-            else:
-                logger.info("Not submitting new calendar post because able is empty")
-        logger.info("Sleeping for {} seconds".format(self.sleep_interval))
+        logger.info("Table is %sempty", '' if is_empty else 'not ')
+        self.for_each_subreddit(lambda subreddit: self.update_table_post(table, is_empty, subreddit))
+        logger.info("Sleeping for %s seconds", self.sleep_interval)
 
 
 def main():
@@ -0,0 +1,97 @@
+import json
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from dateutil.parser import parse
+
+import tracing
+from config import getLogger
+
+logger = getLogger()
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+REQUEST_TIMEOUT = 30
+
+
+class EventsApiClient(object):
+    """
+    Reads events from the JSON listing of The Events Calendar (tribe events) WordPress plugin,
+    i.e. <site>/wp-json/tribe/events/v1/events. After the first page tells how many pages there are,
+    the remaining pages are downloaded concurrently.
+    """
+    def __init__(self, url, per_page=50, max_workers=4):
+        """
+        :param url: URL of the events listing
+        :param per_page: Number of events requested per page
+        :param max_workers: Largest number of pages downloaded at the same time
+        """
+        self.url = url
+        self.per_page = per_page
+        self.max_workers = max_workers
+        self.session = requests.Session()
+
+    def _get_page(self, page, start_date, end_date):
+        """
+        Downloads one page of the events listing.
+        :raises ValueError if the HTTP response is anything but 200 OK.
+        :return: The decoded JSON response
+        """
+        params = {'page': page, 'per_page': self.per_page, 'start_date': start_date.strftime(DATE_FORMAT)}
+        if end_date:
+            params['end_date'] = end_date.strftime(DATE_FORMAT)
+        r = self.session.get(self.url, params=params, timeout=REQUEST_TIMEOUT)
+        if r.status_code != requests.codes.ok:
+            raise ValueError("Error reading events: url=[{}], page=[{}], code=[{}]".format(self.url, page, r.status_code))
+        return r.json()
+
+    def get_events(self, start_date, end_date=None):
+        """
+        Gets every event between two dates.
+        :param start_date: A datetime. Events starting before it are not returned.
+        :param end_date: A datetime, or None to get every event after start_date.
+        :raises requests.RequestException or ValueError if a page cannot be downloaded
+        :return: A list of event JSON strings, in the same shape as the data-tribejson attribute on the calendar page.
+        """
+        first_page = self._get_page(1, start_date, end_date)
+        pages = [first_page]
+        total_pages = first_page.get('total_pages', 1)
+        if total_pages > 1:
+            get_page = tracing.propagate(lambda page: self._get_page(page, start_date, end_date))
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, total_pages - 1)) as executor:
+                pages.extend(executor.map(get_page, range(2, total_pages + 1)))
+        events = [event for page in pages for event in page.get('events', [])]
+        logger.info("Read events: url=[%s], pages=[%s], events=[%s]", self.url, total_pages, len(events))
+        return [json.dumps(self.to_tribe_json(event)) for event in events]
+
+    @staticmethod
+    def to_tribe_json(event):
+        """
+        Converts an event from the JSON listing to the data-tribejson shape expected by EventBot.
+        The displayed date has no year, so the exact start time is passed along in startDate, in the calendar's
+        local time and DATE_FORMAT.
+        :param event: A dict from the "events" list of the listing
+        :return: A dict with title, permalink, dateDisplay, startDate, and excerpt keys
+        """
+        start = parse(event['start_date'])
+        return {'title': event['title'],
+                'permalink': event['url'],
+                'dateDisplay': EventsApiClient.format_date_display(start, parse(event['end_date']),
+                                                                   event.get('all_day', False)),
+                'startDate': start.strftime(DATE_FORMAT),
+                'excerpt': (event.get('excerpt') or '').strip()}
+
+    @staticmethod
+    def format_date_display(start, end, all_day=False):
+        """
+        Formats event times the way the calendar page does, e.g. "October 5 @ 7:00 pm - 9:00 pm".
+        """
+        def day(dt):
+            return "{:%B} {}".format(dt, dt.day)
+
+        def time(dt):
+            return "{}:{:%M} {}".format(dt.hour % 12 or 12, dt, "am" if dt.hour < 12 else "pm")
+
+        if all_day:
+            return day(start)
+        if start.date() == end.date():
+            return "{} @ {} - {}".format(day(start), time(start), time(end))
+        return "{} @ {} - {} @ {}".format(day(start), time(start), day(end), time(end))
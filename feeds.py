@@ -0,0 +1,115 @@
+import requests
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+from xml.etree.ElementTree import XMLPullParser
+
+from config import getLogger
+from singleflight import SingleFlight
+from store import JsonStore
+import tracing
+
+logger = getLogger()
+FeedEntry = namedtuple('FeedEntry', 'guid url title published')
+FeedResponse = namedtuple('FeedResponse', 'entries etag last_modified')
+downloads = SingleFlight()  # readers in the same state share a download that is in flight
+
+CHUNK_SIZE = 4096
+REQUEST_TIMEOUT = 30
+
+
+class FeedReader(object):
+    """
+    Reads an RSS feed incrementally. Only entries that were published after the last call to fetch_new_entries()
+    are returned, and the feed is downloaded with a conditional request so an unchanged feed costs almost nothing.
+    The validators and the last seen GUID are saved in a JsonStore, so they survive restarts.
+    """
+    def __init__(self, url, store_name):
+        """
+        :param url: URL of the RSS feed
+        :param store_name: Name of the JsonStore where the reader's state is saved
+        """
+        self.url = url
+        self.state = JsonStore(store_name)
+
+    def _get_headers(self):
+        headers = {}
+        if self.state.get('etag'):
+            headers['If-None-Match'] = self.state.get('etag')
+        if self.state.get('last_modified'):
+            headers['If-Modified-Since'] = self.state.get('last_modified')
+        return headers
+
+    def fetch_new_entries(self):
+        """
+        Downloads the feed and returns the entries that have not been seen yet, newest first.
+        :raises requests.RequestException if the feed cannot be downloaded
+        :raises ValueError if the HTTP response is anything but 200 OK or 304 Not Modified
+        :raises xml.etree.ElementTree.ParseError if the feed is not valid XML
+        :return: A list of FeedEntries
+        """
+        headers = self._get_headers()
+        last_guid = self.state.get('last_guid')
+        # readers of the same feed that are in the same state, e.g. the NewsBots of several accounts, get the same
+        # answer, so they share one download and parse
+        key = (self.url, tuple(sorted(headers.items())), last_guid)
+        response = downloads.do(key, FeedReader._download, self.url, headers, last_guid)
+        if response is None:
+            logger.info("Feed not modified: url=[%s]", self.url)
+            return []
+
+        self.state.set('etag', response.etag)
+        self.state.set('last_modified', response.last_modified)
+        if response.entries:
+            self.state.set('last_guid', response.entries[0].guid)
+        logger.info("Read feed: url=[%s], newEntries=[%s]", self.url, len(response.entries))
+        return list(response.entries)
+
+    @staticmethod
+    def _download(url, headers, last_guid):
+        """
+        :return: A FeedResponse, or None if the feed was not modified
+        """
+        r = requests.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+        try:
+            if r.status_code == requests.codes.not_modified:
+                return None
+            if r.status_code != requests.codes.ok:
+                raise ValueError("Error reading feed: url=[{}], code=[{}]".format(url, r.status_code))
+            with tracing.span("feeds.parse", url=url) as span:
+                entries = FeedReader._parse_until_seen(r.iter_content(CHUNK_SIZE), last_guid)
+                span.set_attribute('entries', len(entries))
+        finally:
+            r.close()
+        return FeedResponse(entries=entries, etag=r.headers.get('ETag'), last_modified=r.headers.get('Last-Modified'))
+
+    @staticmethod
+    def _parse_until_seen(chunks, last_guid):
+        """
+        Parses RSS items as the feed is downloaded, and stops downloading once the last seen item is reached.
+        :param chunks: An iterable of bytes containing the feed
+        :param last_guid: The GUID of the newest item from the previous fetch, or None
+        :return: A list of FeedEntries that are newer than last_guid
+        """
+        entries = []
+        parser = XMLPullParser(events=('end',))
+        for chunk in chunks:
+            parser.feed(chunk)
+            for _, element in parser.read_events():
+                if element.tag != 'item':
+                    continue
+                entry = FeedReader._get_entry(element)
+                element.clear()
+                if entry.guid == last_guid:
+                    return entries
+                entries.append(entry)
+        parser.close()
+        return entries
+
+    @staticmethod
+    def _get_entry(item):
+        link = item.findtext('link', '').strip()
+        published = item.findtext('pubDate')
+        return FeedEntry(guid=item.findtext('guid', link).strip(),
+                         url=link,
+                         title=item.findtext('title', '').strip(),
+                         published=parsedate_to_datetime(published) if published else None)
@@ -0,0 +1,376 @@
+import hashlib
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+
+from config import bot_config
+from config import data_directory
+from config import getLogger
+
+logger = getLogger()
+
+LEASE_TTL = bot_config.get_sharding_setting('lease_ttl')
+HEARTBEAT_INTERVAL = bot_config.get_sharding_setting('heartbeat_interval')
+STOP_TIMEOUT = bot_config.get_sharding_setting('stop_timeout')
+LEASE_PATH = os.path.join(data_directory, bot_config.get_sharding_setting('lease_file'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    node_id TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    account TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+def get_default_node_id():
+    return "{}:{}".format(socket.gethostname(), os.getpid())
+
+
+# region BACKENDS
+class LeaseBackend(metaclass=ABCMeta):
+    """
+    Shared storage for node heartbeats and account leases. Every node running FAUbot must use the same backend.
+    A lease gives one node the right to run an account's bots until the lease expires, unless it is renewed.
+    Expiry times are seconds since the epoch, so the nodes' clocks must be roughly in sync.
+    """
+    def __init__(self, clock=time.time):
+        """
+        :param clock: A function returning the current time in seconds since the epoch.
+        """
+        self.clock = clock
+
+    @abstractmethod
+    def heartbeat(self, node_id, ttl):
+        """
+        Marks a node as alive for ttl seconds.
+        """
+        pass
+
+    @abstractmethod
+    def remove_node(self, node_id):
+        pass
+
+    @abstractmethod
+    def get_live_nodes(self):
+        """
+        :return: A list of the ids of nodes whose heartbeat has not expired.
+        """
+        pass
+
+    @abstractmethod
+    def acquire(self, account, node_id, ttl):
+        """
+        Gives a node the lease of an account, if the lease is free, expired, or already held by the node.
+        :return: True if the node holds the lease for the next ttl seconds.
+        """
+        pass
+
+    @abstractmethod
+    def release(self, account, node_id):
+        """
+        Gives up an account's lease, if the node holds it.
+        """
+        pass
+
+    @abstractmethod
+    def get_owners(self):
+        """
+        :return: A dict mapping accounts to the ids of the nodes holding their unexpired leases.
+        """
+        pass
+
+    def renew(self, account, node_id, ttl):
+        """
+        Extends a lease held by the node. Renewing is the same as acquiring again.
+        :return: True if the node still holds the lease.
+        """
+        return self.acquire(account, node_id, ttl)
+
+
+class SqliteLeaseBackend(LeaseBackend):
+    """
+    Keeps heartbeats and leases in a SQLite file that every node can open, e.g. on a shared volume.
+    The rollback journal is used instead of WAL, since WAL does not work on network file systems.
+    """
+    def __init__(self, path=LEASE_PATH, clock=time.time):
+        super(SqliteLeaseBackend, self).__init__(clock)
+        self.path = path
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            connection.executescript(SCHEMA)
+        finally:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Opens a connection and holds the database's write lock for a single transaction,
+        which is committed if no exception is raised.
+        """
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.close()
+
+    def heartbeat(self, node_id, ttl):
+        with self._transaction() as connection:
+            connection.execute("INSERT OR REPLACE INTO nodes (node_id, expires_at) VALUES (?, ?)",
+                               (node_id, self.clock() + ttl))
+
+    def remove_node(self, node_id):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM nodes WHERE node_id=?", (node_id,))
+
+    def get_live_nodes(self):
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT node_id FROM nodes WHERE expires_at>?", (self.clock(),)).fetchall()
+        return [row[0] for row in rows]
+
+    def acquire(self, account, node_id, ttl):
+        now = self.clock()
+        with self._transaction() as connection:
+            row = connection.execute("SELECT owner, expires_at FROM leases WHERE account=?", (account,)).fetchone()
+            if row and row[0] != node_id and row[1] > now:
+                return False
+            connection.execute("INSERT OR REPLACE INTO leases (account, owner, expires_at) VALUES (?, ?, ?)",
+                               (account, node_id, now + ttl))
+        return True
+
+    def release(self, account, node_id):
+        with self._transaction() as connection:
+            connection.execute("DELETE FROM leases WHERE account=? AND owner=?", (account, node_id))
+
+    def get_owners(self):
+        with self._transaction() as connection:
+            rows = connection.execute("SELECT account, owner FROM leases WHERE expires_at>?",
+                                      (self.clock(),)).fetchall()
+        return dict(rows)
+
+
+class MemoryLeaseBackend(LeaseBackend):
+    """
+    Keeps heartbeats and leases in memory. It stands in for a shared backend when several
+    coordinators run in the same process, e.g. in tests.
+    """
+    def __init__(self, clock=time.time):
+        super(MemoryLeaseBackend, self).__init__(clock)
+        self.lock = threading.Lock()
+        self.nodes = {}  # node_id -> expires_at
+        self.leases = {}  # account -> (owner, expires_at)
+
+    def heartbeat(self, node_id, ttl):
+        with self.lock:
+            self.nodes[node_id] = self.clock() + ttl
+
+    def remove_node(self, node_id):
+        with self.lock:
+            self.nodes.pop(node_id, None)
+
+    def get_live_nodes(self):
+        now = self.clock()
+        with self.lock:
+            return [node_id for node_id, expires_at in self.nodes.items() if expires_at > now]
+
+    def acquire(self, account, node_id, ttl):
+        now = self.clock()
+        with self.lock:
+            owner, expires_at = self.leases.get(account, (None, 0))
+            if owner not in (None, node_id) and expires_at > now:
+                return False
+            self.leases[account] = (node_id, now + ttl)
+        return True
+
+    def release(self, account, node_id):
+        with self.lock:
+            if self.leases.get(account, (None, 0))[0] == node_id:
+                del self.leases[account]
+
+    def get_owners(self):
+        now = self.clock()
+        with self.lock:
+            return {account: owner for account, (owner, expires_at) in self.leases.items() if expires_at > now}
+
+
+LEASE_BACKENDS = {'sqlite': SqliteLeaseBackend, 'memory': MemoryLeaseBackend}
+
+
+def get_lease_backend(name=None):
+    """
+    :param name: A key of LEASE_BACKENDS. Defaults to the configured backend.
+    :return: A new LeaseBackend
+    """
+    return LEASE_BACKENDS[name or bot_config.get_sharding_setting('backend')]()
+# endregion
+
+
+def get_preferred_node(account, nodes):
+    """
+    Picks the node that should run an account using rendezvous hashing: every node agrees on the choice without
+    talking to the others, accounts are spread evenly, and when a node joins or leaves only the accounts it
+    gains or loses move.
+    :param account: A Reddit user name
+    :param nodes: A list of live node ids
+    :return: A node id, or None if there are no nodes
+    """
+    def weight(node_id):
+        return hashlib.sha1("{}/{}".format(node_id, account).encode('utf-8')).hexdigest()
+    return max(nodes, key=weight, default=None)
+
+
+class LeaseCoordinator(threading.Thread):
+    """
+    Decides which accounts this node runs. On every heartbeat it announces that the node is alive, acquires the
+    leases of the accounts it should run, renews the leases it holds, and releases the accounts that should move to
+    another node. Bots are started and stopped through the on_acquire and on_release callbacks. A lease is released
+    only after on_release returns, so an account's bots never run on two nodes at once.
+    """
+    def __init__(self, backend, accounts, on_acquire, on_release, node_id=None,
+                 ttl=LEASE_TTL, heartbeat_interval=HEARTBEAT_INTERVAL, stop_timeout=STOP_TIMEOUT):
+        """
+        :param backend: The LeaseBackend shared by every node
+        :param accounts: The Reddit user names that are shared between the nodes
+        :param on_acquire: A function called with a user name when this node gains its lease
+        :param on_release: A function called with a user name when this node must stop running it
+        :param node_id: A name that is unique to this node. Defaults to the host name and process id.
+        :param ttl: Number of seconds a lease or heartbeat lasts without being renewed
+        :param heartbeat_interval: Number of seconds between heartbeats. Must be well below ttl.
+        :param stop_timeout: Number of seconds on_release may take to stop an account's bots
+        :raises ValueError: if a lease could expire before its bots are stopped
+        """
+        super(LeaseCoordinator, self).__init__(daemon=True)
+        if heartbeat_interval + stop_timeout >= ttl:
+            raise ValueError("Lease ttl must be longer than the heartbeat interval and stop timeout together: "
+                             "ttl=[{}], heartbeatInterval=[{}], stopTimeout=[{}]"
+                             .format(ttl, heartbeat_interval, stop_timeout))
+        self.backend = backend
+        self.accounts = list(accounts)
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.node_id = node_id or get_default_node_id()
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.stop_timeout = stop_timeout
+        self.stop_event = threading.Event()
+        self.owned = {}  # account -> time when this node's lease expires, if it is not renewed
+        self.lock = threading.Lock()  # guards owned, which the control socket changes too; never held in callbacks
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.beat()
+            self.stop_event.wait(self.heartbeat_interval)
+
+    def beat(self):
+        """
+        Sends one heartbeat, then stops the accounts whose leases were not renewed and could expire before
+        their bots are stopped after the next heartbeat, e.g. because the backend could not be reached.
+        """
+        try:
+            self.tick()
+        except Exception:
+            logger.exception("Lease heartbeat failed: node=[%s]", self.node_id)
+        self._drop_expiring()
+
+    def join(self, timeout=None):
+        """
+        Stops heartbeats. The leases are kept until release_all() is called, so the bots can be stopped first.
+        """
+        self.stop_event.set()
+        return super(LeaseCoordinator, self).join(timeout)
+
+    def tick(self):
+        """
+        Sends one heartbeat and moves leases to where they belong.
+        """
+        self.backend.heartbeat(self.node_id, self.ttl)
+        live_nodes = self.backend.get_live_nodes()
+        for account in self.accounts:
+            preferred = get_preferred_node(account, live_nodes)
+            if self.is_owned(account):
+                if preferred != self.node_id:
+                    logger.info("Handing over account: account=[%s], node=[%s], to=[%s]",
+                                account, self.node_id, preferred)
+                    self.release(account)
+                elif self.backend.renew(account, self.node_id, self.ttl):
+                    with self.lock:
+                        if account in self.owned:  # unless it was released while the lease was renewed
+                            self.owned[account] = self.backend.clock() + self.ttl
+                elif self._disown(account):
+                    logger.warning("Lease lost: account=[%s], node=[%s]", account, self.node_id)
+                    self.on_release(account)
+            elif preferred == self.node_id and self.backend.acquire(account, self.node_id, self.ttl):
+                logger.info("Lease acquired: account=[%s], node=[%s]", account, self.node_id)
+                with self.lock:
+                    self.owned[account] = self.backend.clock() + self.ttl
+                self.on_acquire(account)
+
+    def _drop_expiring(self):
+        """
+        Stops the accounts whose leases will expire within a heartbeat interval and a stop timeout, since the
+        bots must be stopped before another node may take the accounts over.
+        """
+        now = self.backend.clock()
+        with self.lock:
+            owned = list(self.owned.items())
+        for account, expires_at in owned:
+            if expires_at - self.heartbeat_interval - self.stop_timeout <= now and self._disown(account):
+                logger.warning("Lease about to expire: account=[%s], node=[%s], seconds=[%.1f]",
+                               account, self.node_id, expires_at - now)
+                self.on_release(account)
+
+    def _disown(self, account):
+        """
+        :return: True if this node owned the account. Only one caller gets True, and it must call on_release.
+        """
+        with self.lock:
+            return self.owned.pop(account, None) is not None
+
+    def is_owned(self, account):
+        with self.lock:
+            return account in self.owned
+
+    def get_owned_accounts(self):
+        """
+        :return: A list of the accounts whose leases this node holds
+        """
+        with self.lock:
+            return list(self.owned)
+
+    def release(self, account):
+        """
+        Stops the account's bots, then gives up its lease. Does nothing if this node does not own the account,
+        e.g. because the coordinator thread already released it.
+        """
+        if not self._disown(account):
+            return
+        self.on_release(account)
+        self.backend.release(account, self.node_id)
+
+    def release_all(self):
+        """
+        Gives up every lease and removes the node, so other nodes take over its accounts right away.
+        """
+        for account in self.get_owned_accounts():
+            try:
+                self.release(account)
+            except Exception:
+                logger.exception("Lease could not be released: account=[%s], node=[%s]", account, self.node_id)
+        try:
+            self.backend.remove_node(self.node_id)
+        except Exception:
+            logger.exception("Node could not be removed: node=[%s]", self.node_id)
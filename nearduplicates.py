@@ -0,0 +1,158 @@
+import random
+import re
+import threading
+import zlib
+from collections import defaultdict
+
+from config import bot_config
+from store import JsonLinesStore
+
+THRESHOLD = bot_config.get_near_duplicate_setting('threshold')
+NUM_PERMUTATIONS = bot_config.get_near_duplicate_setting('num_permutations')
+BANDS = bot_config.get_near_duplicate_setting('bands')
+SHINGLE_SIZE = bot_config.get_near_duplicate_setting('shingle_size')
+
+PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+SEED = 1  # signatures are saved, so the permutations must be the same in every run
+
+_non_word_regex = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_title(title):
+    """
+    Lower cases a title and replaces punctuation and runs of whitespace with a single space,
+    e.g. "Parking Garage  Closes -- Again!" becomes "parking garage closes again".
+    """
+    return _non_word_regex.sub(" ", title.lower()).strip()
+
+
+def get_shingles(text, size=SHINGLE_SIZE):
+    """
+    :return: The set of every substring of text with the given length, or {text} if text is shorter.
+    """
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class MinHasher(object):
+    """
+    Computes MinHash signatures. The fraction of positions where two signatures agree estimates the Jaccard
+    similarity of the sets they were computed from.
+    """
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, seed=SEED):
+        generator = random.Random(seed)
+        self.permutations = [(generator.randint(1, PRIME - 1), generator.randint(0, PRIME - 1))
+                             for _ in range(num_permutations)]
+
+    def get_signature(self, shingles):
+        """
+        :param shingles: A non-empty set of strings
+        :return: A list of num_permutations ints
+        """
+        hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+        return [min(((a * h + b) % PRIME) & MAX_HASH for h in hashes) for a, b in self.permutations]
+
+
+def get_similarity(signature, other):
+    """
+    :return: The estimated Jaccard similarity of the sets two signatures were computed from, between 0 and 1.
+    """
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+
+class NearDuplicateIndex(object):
+    """
+    Finds titles that are nearly the same as a title seen before, e.g. a story republished with a slightly
+    different headline, using locality-sensitive hashing. Every signature is split into bands, and only titles that
+    share all the rows of at least one band with the query are compared to it, so a lookup takes about the same time
+    however many titles are indexed. With b bands of r rows, titles with similarity s share a band with probability
+    1 - (1 - s^r)^b, so the bands should be chosen to make that close to 1 at the threshold.
+    Signatures are appended to a JsonLinesStore, so adding a title does not rewrite every title saved before it,
+    and the bands are rebuilt from them on startup.
+    """
+    def __init__(self, store_name, threshold=THRESHOLD, num_permutations=NUM_PERMUTATIONS, bands=BANDS,
+                 shingle_size=SHINGLE_SIZE):
+        """
+        :param store_name: Name of the JsonLinesStore where titles and their signatures are saved
+        :param threshold: Smallest estimated similarity, between 0 and 1, for two titles to be near duplicates
+        :param num_permutations: Length of the signatures. Longer signatures give better estimates.
+        :param bands: Number of bands every signature is split into. Must divide num_permutations.
+        :param shingle_size: Length of the substrings titles are compared by
+        """
+        if num_permutations % bands:
+            raise ValueError("bands must divide num_permutations: bands=[{}], num_permutations=[{}]"
+                             .format(bands, num_permutations))
+        self.threshold = threshold
+        self.rows = num_permutations // bands
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.hasher = MinHasher(num_permutations)
+        self.store = JsonLinesStore(store_name)  # [key, title, signature] records
+        self._lock = threading.Lock()
+        self._signatures = {}
+        self._buckets = defaultdict(set)  # (band, rows of the signature) -> keys
+        changed = False
+        saved = {}
+        for key, title, signature in self.store.load():
+            if key in saved:
+                changed = True
+                continue
+            if len(signature) != num_permutations:
+                signature = self.get_signature(title)
+                changed = True
+            saved[key] = [key, title, signature]
+            self._insert(key, signature)
+        if changed:
+            self.store.replace(list(saved.values()))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._signatures)
+
+    def _get_bands(self, signature):
+        return [(band, tuple(signature[band * self.rows:(band + 1) * self.rows])) for band in range(self.bands)]
+
+    def _insert(self, key, signature):
+        self._signatures[key] = signature
+        for bucket in self._get_bands(signature):
+            self._buckets[bucket].add(key)
+
+    def get_signature(self, title):
+        return self.hasher.get_signature(get_shingles(normalize_title(title), self.shingle_size))
+
+    def add(self, key, title):
+        """
+        Indexes a title, and saves it.
+        :param key: A unique string identifying the title, e.g. the article's URL. Adding a key again does nothing.
+        """
+        signature = self.get_signature(title)
+        with self._lock:
+            if key in self._signatures:
+                return
+            self._insert(key, signature)
+            self.store.append([key, title, signature])
+
+    def query(self, title):
+        """
+        :return: A list of (key, similarity) for the indexed titles that are near duplicates of title,
+                 most similar first.
+        """
+        signature = self.get_signature(title)
+        with self._lock:
+            candidates = set()
+            for bucket in self._get_bands(signature):
+                candidates.update(self._buckets.get(bucket, ()))
+            matches = [(key, get_similarity(signature, self._signatures[key])) for key in candidates]
+        return sorted((match for match in matches if match[1] >= self.threshold), key=lambda match: -match[1])
+
+    def find(self, title, exclude=None):
+        """
+        :param exclude: A key that does not count as a match, e.g. the URL of the article being checked
+        :return: The key of the most similar indexed title, or None if there are no near duplicates.
+        """
+        for key, similarity in self.query(title):
+            if key != exclude:
+                return key
+        return None
@@ -1,20 +1,33 @@
 import requests
+import calendar
 import datetime
-from cachetools import ttl_cache
-from collections import namedtuple
+import threading
+from collections import defaultdict, namedtuple
 from bs4 import BeautifulSoup
-from random import randint
+from random import randint, randrange
+from xml.etree.ElementTree import ParseError
 from config import getLogger
-from config.bot_config import get_interval
+from config.bot_config import get_interval, should_use_news_feed
 from bots import RedditBot
+from feeds import FeedReader
+from nearduplicates import NearDuplicateIndex
+from outbox import PENDING, SENDING, SENT
+from singleflight import SingleFlight
+from store import JsonStore
+import tracing
 
 # region constants
 SUBMISSION_INTERVAL_HOURS = get_interval('submission_interval_hours')
+CANDIDATE_REFRESH_INTERVAL = get_interval('candidate_refresh_seconds')
+USE_NEWS_FEED = should_use_news_feed()
+URL_LOOKUP_LIMIT = 100  # the most submissions Reddit returns for one URL
+LINK_LIST_CACHE_SECONDS = get_interval('link_list_cache_seconds')
 # endregion
 
 # region globals
 logger = getLogger()
 Link = namedtuple('Link', 'url title')
+link_lists = SingleFlight(ttl=LINK_LIST_CACHE_SECONDS)  # url -> Links, shared by every NewsBot in the process
 # endregion
 
 
@@ -30,37 +43,231 @@ def clean_dir(obj):
 # endregion
 
 
+class CandidateQueue(object):
+    """
+    Today's articles that are known not to have been submitted yet, kept separately for every subreddit.
+    Each subreddit also remembers which articles were already checked, so every article is looked up only once.
+    The queues are saved, and start over when the date changes.
+    """
+    def __init__(self, store_name):
+        self.store = JsonStore(store_name)  # subreddit -> {'date', 'checked': [url], 'queue': [[url, title]]}
+        self.lock = threading.Lock()
+
+    def _get_entry(self, subreddit, date):
+        entry = self.store.get(subreddit.lower())
+        if not entry or entry['date'] != date.isoformat():
+            entry = {'date': date.isoformat(), 'checked': [], 'queue': []}
+        return entry
+
+    def get_unchecked(self, subreddit, date, links):
+        """
+        :return: The Links that have not been checked for the subreddit on the date.
+        """
+        with self.lock:
+            checked = set(self._get_entry(subreddit, date)['checked'])
+        return [link for link in links if link.url not in checked]
+
+    def add_checked(self, subreddit, date, link, is_candidate):
+        """
+        Records that a link was checked, and queues it if it has not been submitted to the subreddit.
+        """
+        with self.lock:
+            entry = self._get_entry(subreddit, date)
+            if link.url in entry['checked']:
+                return
+            entry['checked'].append(link.url)
+            if is_candidate:
+                entry['queue'].append([link.url, link.title])
+            self.store.set(subreddit.lower(), entry)
+
+    def pop(self, subreddit, date):
+        """
+        Removes a random candidate from the subreddit's queue.
+        :return: A Link, or None if the queue is empty.
+        """
+        with self.lock:
+            entry = self._get_entry(subreddit, date)
+            if not entry['queue']:
+                return None
+            url, title = entry['queue'].pop(randrange(len(entry['queue'])))
+            self.store.set(subreddit.lower(), entry)
+        return Link(url=url, title=title)
+
+    def size(self, subreddit, date):
+        with self.lock:
+            return len(self._get_entry(subreddit, date)['queue'])
+
+
+class SubmittedUrls(object):
+    """
+    Remembers which of today's article URLs have been submitted to which subreddits, grouped by subreddit.
+    Reddit's info endpoint returns a URL's submissions in every subreddit at once, so each URL is looked up only
+    once a day, however many subreddits it is checked against. The lookups start over when the date changes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.date = None
+        self._looked_up = set()  # urls
+        self._submitted = defaultdict(set)  # subreddit -> urls submitted there
+
+    def _check_date(self, date):
+        if date != self.date:
+            self.date = date
+            self._looked_up.clear()
+            self._submitted.clear()
+
+    def get_unknown(self, urls, date):
+        """
+        :return: The URLs that have not been looked up on the date, without repeats.
+        """
+        with self.lock:
+            self._check_date(date)
+            return [url for url in sorted(set(urls)) if url not in self._looked_up]
+
+    def add_lookup(self, url, subreddits, date):
+        """
+        Records the result of looking up a URL.
+        :param subreddits: The names of the subreddits where the URL was found
+        """
+        with self.lock:
+            self._check_date(date)
+            self._looked_up.add(url)
+            for subreddit in subreddits:
+                self._submitted[subreddit.lower()].add(url)
+
+    def add(self, url, subreddit, date):
+        """
+        Records that a URL is being submitted to a subreddit.
+        """
+        self.add_lookup(url, [subreddit], date)
+
+    def is_submitted(self, url, subreddit):
+        with self.lock:
+            return url in self._submitted.get(subreddit.lower(), ())
+
+
 class NewsBot(RedditBot):
     def __init__(self, user_name, *args, **kwargs):
         super(NewsBot, self).__init__(user_name=user_name, *args, **kwargs)
         self.base_url = "http://www.upressonline.com"
         self._last_created = None
+        self._pending_submits = {}  # outbox write id -> time the submission was queued
+        self.feed = FeedReader("{}/feed/".format(self.base_url), "newsbot_feed_{}".format(self.USER_NAME))
+        self.feed_articles = JsonStore("newsbot_feed_articles_{}".format(self.USER_NAME))  # date -> [[url, title]]
+        self.candidates = CandidateQueue("newsbot_candidates_{}".format(self.USER_NAME))
+        self.submitted_urls = SubmittedUrls()
+        self._next_candidate_refresh = None  # time when the candidate queues are refreshed next
+        self._title_indexes = {}  # subreddit -> NearDuplicateIndex of the titles submitted there
+        self._title_indexes_lock = threading.Lock()
+
+    def respawn(self):
+        """
+        An override of RedditBot.respawn() that remembers the last submission time, and the submissions
+        that are still queued.
+        """
+        new_bot = super(NewsBot, self).respawn()
+        new_bot._last_created = self._last_created
+        new_bot._pending_submits = dict(self._pending_submits)
+        return new_bot
 
+    def look_up_urls(self, urls):
+        """
+        Finds the subreddits where each URL has been submitted, with one call to Reddit's info endpoint for each
+        URL that has not been looked up today. The calls are made no faster than the account's rate limiter allows.
+        :param urls: The urls of articles
+        :return: The number of URLs that were looked up
+        """
+        today = self.clock.today()
+        unknown = self.submitted_urls.get_unknown(urls, today)
+        for url in unknown:
+            self.rate_limiter.acquire()
+            with tracing.span("reddit.get_info", url=url) as span:
+                submissions = self.r.get_info(url=url, limit=URL_LOOKUP_LIMIT) or []
+                span.set_attribute('submissions', len(submissions))
+            self.submitted_urls.add_lookup(url, [str(submission.subreddit) for submission in submissions], today)
+        return len(unknown)
 
-    @ttl_cache(ttl=86400)
     def is_already_submitted(self, url, subreddit):
         """
-        Checks if a URL has already been shared on self.subreddit.
-        Because praw.Reddit.search returns a generator instead of a list,
-        we have to actually loop through it to see if the post exists.
-        If no post exists, the loop won't happen and it will return False.
-        :param url: The url that will be searched for
-        :param subreddit: The subreddit where the url will be searched for
+        Checks if a URL has already been shared on a subreddit.
+        :param url: The url that will be looked up
+        :param subreddit: The subreddit where the url should not have been submitted
         :return: True if the url has already been posted to the subreddit
         """
-        for link in self.r.search("url:"+url, subreddit=subreddit):
-            if link:
-                return True
+        self.look_up_urls([url])
+        return self.submitted_urls.is_submitted(url, subreddit)
+
+    def get_title_index(self, subreddit):
+        """
+        :return: The NearDuplicateIndex of the titles of articles that were submitted to a subreddit.
+        """
+        subreddit = subreddit.lower()
+        with self._title_indexes_lock:
+            if subreddit not in self._title_indexes:
+                self._title_indexes[subreddit] = NearDuplicateIndex("newsbot_titles_{}_{}".format(self.USER_NAME,
+                                                                                                  subreddit))
+            return self._title_indexes[subreddit]
+
+    def is_posted(self, link, subreddit):
+        """
+        Checks if an article, or one with nearly the same title, has already been submitted to a subreddit.
+        upressonline.com sometimes republishes a story under a new URL, which the URL lookup does not find.
+        Titles are looked up locally first, so Reddit is only asked about articles that look new.
+        :param link: A Link
+        :return: True if the article should not be submitted
+        """
+        index = self.get_title_index(subreddit)
+        duplicate = index.find(link.title, exclude=link.url)
+        if duplicate:
+            logger.info("Near duplicate already submitted: subreddit=[%s], url=[%s], duplicate=[%s]",
+                        subreddit, link.url, duplicate)
+            return True
+        if self.is_already_submitted(link.url, subreddit):
+            index.add(link.url, link.title)
+            return True
         return False
 
     def get_articles_from_today(self):
         """
         Gets all articles posted to upressonline.com on today's date.
+        If the news feed is enabled in config/bot_config.yaml, articles are read from the site's RSS feed,
+        and the date archive page is only scraped if the feed cannot be read.
         :return: a list of Links (namedtuples) with url and title elements.
         """
-        today = datetime.datetime.today()
+        today = self.clock.now()
+        if USE_NEWS_FEED:
+            try:
+                return self.get_articles_from_feed(today.date())
+            except (requests.RequestException, ValueError, ParseError):
+                logger.exception("Could not read the news feed. Scraping the date archive instead.")
         return self.get_articles_by_date(today.year, today.month, today.day)
 
+    def get_articles_from_feed(self, date):
+        """
+        Reads new entries from the site's RSS feed, and adds the ones published on a certain date to the
+        articles already collected for that date. Collected articles are saved so they survive restarts.
+        An article is only collected once, even if the feed returns it again, e.g. when the last entry that was read
+        has dropped out of the feed.
+        :param date: A datetime.date
+        :return: list of Links (namedtuples)
+        """
+        date_key = date.isoformat()
+        articles = self.feed_articles.get(date_key, [])
+        collected = {url for url, title in articles}
+        for entry in reversed(self.feed.fetch_new_entries()):
+            if entry.published and entry.published.astimezone().date() == date and entry.url not in collected:
+                articles.append([entry.url, self._clean_title(entry.title)])
+                collected.add(entry.url)
+        for old_key in self.feed_articles.keys():
+            if old_key != date_key:
+                self.feed_articles.delete(old_key)
+        self.feed_articles.set(date_key, articles)
+        return [Link(url=url, title=title) for url, title in articles]
+
+    @staticmethod
+    def _clean_title(title):
+        return title.replace("“", '"').replace("”", '"').replace("’", "'")
+
     def get_articles_by_category(self, category_name, category_subname=None):
         """
         Get all articles tagged with a certain category name, e.g. category/reviews, or category/news.
@@ -86,7 +293,7 @@ class NewsBot(RedditBot):
         :raises ValueError if a day is specified without the month
         :return: list of Links (namedtuples)
         """
-        if not year or not 1995 <= year <= datetime.datetime.today().year:
+        if not year or not 1995 <= year <= self.clock.now().year:
             raise ValueError("Invalid year parameter.")
         url = "{}/{}".format(self.base_url, year)
         if month:
@@ -97,44 +304,89 @@ class NewsBot(RedditBot):
             raise ValueError("Cannot specify day without month.")
         return self._get_link_list(url)
     
-    @ttl_cache(ttl=600)  # cache for 10 minutes todo configurable ttl
     def _get_link_list(self, url):
         """
-        Parses a web page's HTML for links with a particular attribute (rel=bookmark),
-        which are assumed to be links to articles on the school paper's website.
+        Gets the links to articles on a web page. Every NewsBot in the process shares one download and parse of
+        a page, and the result is kept for intervals.link_list_cache_seconds in config/bot_config.yaml.
         :param url: The url to the page that should contain links to articles
         :raises ValueError if the HTTP response is anything but 200 OK.
         :return: A list of Links (namedtuples)
         """
+        return list(link_lists.do(url, NewsBot._download_link_list, url))
+
+    @staticmethod
+    def _download_link_list(url):
+        """
+        Parses a web page's HTML for links with a particular attribute (rel=bookmark),
+        which are assumed to be links to articles on the school paper's website.
+        """
         link_list = []
         r = requests.get(url)
         if r.status_code == requests.codes.ok:
-            soup = BeautifulSoup(r.content, 'html.parser')
-            for link in soup.find_all(rel='bookmark'):
-                url = link['href']
-                title = link.get_text().replace("“", '"').replace("”", '"').replace("’", "'")
-                link_list.append(Link(url=url, title=title))
+            with tracing.span("newsbot.parse", url=url) as span:
+                soup = BeautifulSoup(r.content, 'html.parser')
+                for link in soup.find_all(rel='bookmark'):
+                    title = NewsBot._clean_title(link.get_text())
+                    link_list.append(Link(url=link['href'], title=title))
+                span.set_attribute('links', len(link_list))
             return link_list
         elif r.status_code == requests.codes.not_found:
-            logger.info("No links found: url=[{}], code=[{}]".format(url, r.status_code))
+            logger.info("No links found: url=[%s], code=[%s]", url, r.status_code)
             return link_list
         else:
             raise ValueError("Error talking to UPress: url=[{}], code=[{}]".format(url, r.status_code))
 
     def submit_link(self, link_tuple):
         """
-        Submit a link to Reddit, and save the submission time to the database.
+        Submit a link to every subreddit where it has not been submitted yet, and save the submission time.
         :param link_tuple: A namedtuple with a url and a title.
+        :return: A dict mapping each subreddit to a SubredditResult.
         """
-        for subreddit in self.subreddits:
-            if self.is_already_submitted(link_tuple.url, subreddit):
-                logger.info("Link already submitted: subreddit=[{}], url=[{}]".format(subreddit, link_tuple.url))
-                # sleep for shorter time if time to submit but random article was already submitted
-                self.sleep_interval = 5
+        return self.for_each_subreddit(lambda subreddit: self._submit_link_to_subreddit(link_tuple, subreddit))
+
+    def _submit_link_to_subreddit(self, link_tuple, subreddit):
+        """
+        Submit a link to a single subreddit, unless it has already been submitted there.
+        :param link_tuple: A namedtuple with a url and a title.
+        :param subreddit: The subreddit where the link will be submitted
+        :return: True if the link was queued for submission.
+        """
+        if self.is_posted(link_tuple, subreddit):
+            logger.info("Link already submitted: subreddit=[%s], url=[%s]", subreddit, link_tuple.url)
+            return False
+        self._queue_link(link_tuple, subreddit)
+        return True
+
+    def _queue_link(self, link, subreddit):
+        """
+        Queues a link for submission, and remembers its title so near duplicates of it are not submitted later.
+        """
+        logger.info("Queueing link: subreddit=[%s], url=[%s]", subreddit, link.url)
+        write_id = self.queue_submit(subreddit, link.title, url=link.url,
+                                     coalesce_key="link:{}:{}".format(subreddit.lower(), link.url))
+        self.get_title_index(subreddit).add(link.url, link.title)
+        self.submitted_urls.add(link.url, subreddit, self.clock.today())
+        self._pending_submits[write_id] = self.clock.utcnow()
+
+    def _check_pending_submits(self):
+        """
+        Looks up the queued submissions in the outbox. A sent submission counts as the last submission, and one the
+        outbox gave up on is forgotten, so the next article is not held back by a post that was never made.
+        :return: True if a submission is still waiting to be sent
+        """
+        waiting = False
+        for write_id, queued_at in list(self._pending_submits.items()):
+            write = self.outbox.get_write(write_id)
+            status = write['status'] if write else None
+            if status in (PENDING, SENDING):
+                waiting = True
+                continue
+            del self._pending_submits[write_id]
+            if status == SENT:
+                self._last_created = max(self._last_created or queued_at, queued_at)
             else:
-                logger.info("Submitting link: subreddit=[{}], url=[{}]".format(subreddit, link_tuple.url))
-                self.r.submit(subreddit, link_tuple.title, url=link_tuple.url)
-                self._last_created = datetime.datetime.utcnow()
+                logger.warning("Queued submission was not sent: id=[%s], status=[%s]", write_id, status)
+        return waiting
 
     @staticmethod
     def _get_random_article(articles):
@@ -152,9 +404,10 @@ class NewsBot(RedditBot):
             article = articles[0]
         else:
             article = None
-        msg = "Random article: url=[{}], title=[{}]".format(article.url, article.title) if article \
-            else "Empty list provided. Returning None."
-        logger.info(msg)
+        if article:
+            logger.info("Random article: url=[%s], title=[%s]", article.url, article.title)
+        else:
+            logger.info("Empty list provided. Returning None.")
         return article
 
     def get_random_article_from_today(self):
@@ -186,19 +439,76 @@ class NewsBot(RedditBot):
         articles = self.get_articles_by_category(category, subcategory)
         return NewsBot._get_random_article(articles)
 
+    def refresh_candidates(self):
+        """
+        Checks today's articles that have not been checked yet against every subreddit,
+        and queues the ones that have not been submitted there.
+        The articles that look new in any subreddit are looked up on Reddit together first, so each is looked up
+        once instead of once for every subreddit.
+        """
+        today = self.clock.today()
+        articles = self.get_articles_from_today()
+        try:
+            self.look_up_urls([link.url for subreddit in self.subreddits
+                               for link in self.candidates.get_unchecked(subreddit, today, articles)
+                               if not self.get_title_index(subreddit).find(link.title, exclude=link.url)])
+        except Exception as e:
+            # the articles that were not looked up are looked up again one at a time below
+            logger.warning("Could not look up articles: error=[%r]", e)
+
+        def refresh(subreddit):
+            for link in self.candidates.get_unchecked(subreddit, today, articles):
+                self.candidates.add_checked(subreddit, today, link, is_candidate=not self.is_posted(link, subreddit))
+            return self.candidates.size(subreddit, today)
+
+        results = self.for_each_subreddit(refresh)
+        logger.info("Candidate articles: %s", ", ".join("/r/{}=[{}]".format(subreddit, result.result)
+                                                         for subreddit, result in results.items()))
+
+    def refresh_candidates_if_due(self):
+        """
+        Refreshes the candidate queues if intervals.candidate_refresh_seconds have passed since they were last
+        refreshed, so submitting rarely has to look up articles. A failed refresh is logged and tried again
+        when the next one is due.
+        """
+        if self._next_candidate_refresh is not None and self._next_candidate_refresh > self.clock.time():
+            return
+        try:
+            self.refresh_candidates()
+        except Exception:
+            if self.stop_event.is_set():
+                raise
+            logger.exception("Could not refresh candidate articles: bot=[%s]", self.name)
+        self._next_candidate_refresh = self.clock.time() + CANDIDATE_REFRESH_INTERVAL
+
+    def _submit_candidate(self, subreddit, today):
+        """
+        Submits one queued candidate to a subreddit.
+        :return: True if a link was queued for submission.
+        """
+        link = self.candidates.pop(subreddit, today)
+        # a candidate may have become a near duplicate of an article submitted after it was checked
+        while link and self.get_title_index(subreddit).find(link.title, exclude=link.url):
+            logger.info("Skipping near duplicate candidate: subreddit=[%s], url=[%s]", subreddit, link.url)
+            link = self.candidates.pop(subreddit, today)
+        if not link:
+            logger.info("No unsubmitted articles: subreddit=[%s]", subreddit)
+            return False
+        self._queue_link(link, subreddit)
+        return True
+
     def do_scheduled_submit(self):
         """
-        Check if enough time has passed since the last submission. If it has, submit a new link and save the current
-        submission time. This is the NewsBot's main logic function.
+        Check if enough time has passed since the last submission. If it has, submit a candidate article to every
+        subreddit and save the current submission time. This is the NewsBot's main logic function.
+        Candidates are normally found by refresh_candidates_if_due() at the start of every work cycle; they are
+        only looked for here if every queue is empty, e.g. when no articles were published at the last refresh.
         """
         if self.is_time_to_submit():
-            # You can hard code article date while developing. Production bot will get article from current day.
-            # article = self.get_random_article_by_date(2014, 10)
-            article = self.get_random_article_from_today()
-            if article:
-                self.submit_link(article)
-            else:
-                logger.info("No articles have been published yet today.")
+            today = self.clock.today()
+            if not any(self.candidates.size(subreddit, today) for subreddit in self.subreddits):
+                self.refresh_candidates()
+            self.for_each_subreddit(lambda subreddit: self._submit_candidate(subreddit, today))
         else:
             logger.info("Not time to submit.")
 
@@ -206,40 +516,61 @@ class NewsBot(RedditBot):
     def _check_difference(now, last, target_interval):
         difference = now - last
         if difference < target_interval:
-            logger.info("Not time to submit: currentTime=[{}], lastSubmissionTime=[{}], "
-                                "difference=[{:5.2f} hrs]".format(now, last, (difference.seconds/60)/60))
+            logger.info("Not time to submit: currentTime=[%s], lastSubmissionTime=[%s], "
+                        "difference=[%5.2f hrs]", now, last, (difference.seconds/60)/60)
             return False
         return True
 
     def is_time_to_submit(self):
         """
         Check if enough time has passed to submit another article.
-        This function checks the creation time of FAUbot's newest submissions. If at least 24 hours has passed since the
-        last article submission, it is time to submit a new article. The 24 hour interval is configurable in
-        config/bot_config.yaml.
+        This function checks the creation time of FAUbot's newest submission, which is remembered after it is first
+        looked up, or once a queued submission has been sent. It is not time while a submission is still queued. If at least 24 hours has passed since the last article submission, it is time to submit a new
+        article. The 24 hour interval is configurable in config/bot_config.yaml.
         :return: True if enough time has passed for a new article to be submitted.
         """
         is_time = True
-        me = self.r.get_me()
-        now = datetime.datetime.utcnow()
+        now = self.clock.utcnow()
         target_interval = datetime.timedelta(hours=SUBMISSION_INTERVAL_HOURS)
-        logger.info("Checking if time to submit: targetInterval=[{}]".format(target_interval))
+        logger.info("Checking if time to submit: targetInterval=[%s]", target_interval)
+        if self._check_pending_submits():
+            logger.info("Not time to submit, the last submissions are still queued.")
+            return False
 
+        if not self._last_created:
+            for post in self.r.get_me().get_submitted(sort="new", time="day"):
+                if post.url.startswith(self.base_url):
+                    self._last_created = datetime.datetime.utcfromtimestamp(post.created_utc)
+                    break
         if self._last_created:
             is_time = self._check_difference(now, self._last_created, target_interval)
-        else:
-            for post in me.get_submitted(sort="new", time="day"):
-                if post.url.startswith(self.base_url):
-                    created = datetime.datetime.utcfromtimestamp(post.created_utc)
-                    if not self._check_difference(now, created, target_interval):
-                        is_time = False
-                        break
         if is_time:
-            logger.info("Time to submit article. currentTime=[{}]".format(now))
+            logger.info("Time to submit article. currentTime=[%s]", now)
         return is_time
 
+    def get_next_submission_time(self):
+        """
+        Calculates when the next article should be submitted, based on the last submission time.
+        :return: The time in seconds since the epoch, or None if it is unknown or has already passed.
+        """
+        if not self._last_created:
+            return None
+        next_time = self._last_created + datetime.timedelta(hours=SUBMISSION_INTERVAL_HOURS)
+        if next_time <= self.clock.utcnow():
+            return None
+        return calendar.timegm(next_time.utctimetuple())
+
     def work(self):
+        """
+        Refreshes the candidate articles if it is time, submits an article if it is time, and sleeps until the
+        next submission or candidate refresh is due, whichever comes first.
+        The candidates are refreshed in the bot's own thread, since its praw.Reddit instance must not be used by
+        two threads at once.
+        """
+        self.refresh_candidates_if_due()
         self.do_scheduled_submit()
+        due_times = [due for due in (self.get_next_submission_time(), self._next_candidate_refresh) if due is not None]
+        return min(due_times) if due_times else None
 
 
 def main():
@@ -0,0 +1,367 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import praw
+import store
+import tracing
+
+from config import bot_config
+from config import getLogger
+
+logger = getLogger()
+
+OUTBOX_FILE_NAME = "outbox.db"
+MAX_ATTEMPTS = bot_config.get_outbox_setting('max_attempts')
+RETRY_BACKOFF_INITIAL = bot_config.get_outbox_setting('retry_backoff_initial')
+RETRY_BACKOFF_MAX = bot_config.get_outbox_setting('retry_backoff_max')
+POLL_INTERVAL = bot_config.get_outbox_setting('poll_interval')
+SENT_RETENTION = bot_config.get_outbox_setting('sent_retention')
+PRUNE_INTERVAL = 60 * 60
+SENT_MESSAGES_CHECKED = 100  # recently sent messages searched before a message is sent again
+CLOCK_SKEW = 5 * 60  # Reddit's clock may differ from ours
+
+PENDING, SENDING, SENT, DEAD = 'pending', 'sending', 'sent', 'dead'
+SUBMIT, EDIT, MESSAGE = 'submit', 'edit', 'message'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS writes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    account TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    coalesce_key TEXT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    due_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    result TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS writes_due ON writes (account, status, due_at);
+"""
+
+
+class Outbox(object):
+    """
+    A durable queue of Reddit writes (submissions, edits, and private messages) stored in SQLite.
+    Bots enqueue writes instead of calling praw directly, and an OutboxSender for each account sends them.
+    Writes that fail are retried later with exponential backoff, and survive restarts.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: The SQLite database file. Defaults to outbox.db in store.DATA_DIRECTORY.
+        """
+        self.path = path or os.path.join(store.DATA_DIRECTORY, OUTBOX_FILE_NAME)
+        self._wake_events = defaultdict(threading.Event)  # account -> Event set when a write is queued
+        self._next_prune = 0
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            # writes that were being sent when the program stopped may or may not have reached Reddit,
+            # so they are retried, which makes the sender check for duplicates first
+            connection.execute("UPDATE writes SET status=?, attempts=attempts+1 WHERE status=?", (PENDING, SENDING))
+
+    @contextmanager
+    def _connect(self):
+        """
+        Opens a connection for a single transaction. The transaction is committed if no exception is raised.
+        """
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, and avoids an fsync on every commit
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def enqueue(self, account, kind, payload, coalesce_key=None):
+        """
+        Adds a write to the queue. If a coalesce key is given, pending writes from the same account with the
+        same key are superseded by the new one, e.g. only the newest version of an edited post is sent.
+        :param account: The Reddit user name that will make the write
+        :param kind: One of SUBMIT, EDIT, or MESSAGE
+        :param payload: A JSON serializable dict of arguments for the write
+        :param coalesce_key: A string identifying writes that supersede each other, or None
+        :return: The id of the new write
+        """
+        now = time.time()
+        with self._connect() as connection:
+            if coalesce_key:
+                connection.execute("DELETE FROM writes WHERE account=? AND coalesce_key=? AND status=?",
+                                   (account, coalesce_key, PENDING))
+            cursor = connection.execute("INSERT INTO writes (account, kind, coalesce_key, payload, due_at, created_at) "
+                                        "VALUES (?, ?, ?, ?, ?, ?)",
+                                        (account, kind, coalesce_key, json.dumps(payload), now, now))
+            write_id = cursor.lastrowid
+        logger.info("Write queued: id=[%s], account=[%s], kind=[%s], coalesceKey=[%s]",
+                    write_id, account, kind, coalesce_key)
+        self.wake(account)
+        return write_id
+
+    def wake(self, account):
+        """
+        Wakes the account's sender if it is waiting for writes.
+        """
+        self._wake_events[account].set()
+
+    def wait_for_writes(self, account, timeout):
+        """
+        Blocks until a write is queued for the account, or the timeout passes.
+        """
+        event = self._wake_events[account]
+        event.wait(timeout)
+        event.clear()
+
+    def get_write(self, write_id):
+        """
+        :return: A sqlite3.Row for the write, or None if it does not exist (e.g. it was superseded).
+        """
+        with self._connect() as connection:
+            return connection.execute("SELECT * FROM writes WHERE id=?", (write_id,)).fetchone()
+
+    def claim_due_writes(self, account, limit=10):
+        """
+        Marks an account's pending writes that are due as being sent, so they can no longer be superseded.
+        Old sent writes are pruned at most once every PRUNE_INTERVAL.
+        :return: The claimed writes, oldest first.
+        """
+        if time.time() >= self._next_prune:
+            self._next_prune = time.time() + PRUNE_INTERVAL
+            self.prune()
+        with self._connect() as connection:
+            writes = connection.execute("SELECT * FROM writes WHERE account=? AND status=? AND due_at<=? "
+                                        "ORDER BY id LIMIT ?", (account, PENDING, time.time(), limit)).fetchall()
+            connection.executemany("UPDATE writes SET status=? WHERE id=?", [(SENDING, write['id']) for write in writes])
+        return writes
+
+    def prune(self, retention=SENT_RETENTION):
+        """
+        Deletes the sent writes that were queued more than retention seconds ago, so the outbox does not grow forever.
+        Pending and given up writes are kept.
+        :return: The number of deleted writes
+        """
+        with self._connect() as connection:
+            deleted = connection.execute("DELETE FROM writes WHERE status=? AND created_at<?",
+                                         (SENT, time.time() - retention)).rowcount
+        if deleted:
+            logger.info("Sent writes pruned: deleted=[%s], retention=[%s]", deleted, retention)
+        return deleted
+
+    def unclaim(self, write_ids):
+        """
+        Makes claimed writes that were never sent pending again, without counting an attempt.
+        """
+        with self._connect() as connection:
+            connection.executemany("UPDATE writes SET status=? WHERE id=? AND status=?",
+                                   [(PENDING, write_id, SENDING) for write_id in write_ids])
+
+    def get_next_due_time(self, account):
+        """
+        :return: The time when the account's next pending write is due, or None if there are none.
+        """
+        with self._connect() as connection:
+            row = connection.execute("SELECT MIN(due_at) FROM writes WHERE account=? AND status=?",
+                                     (account, PENDING)).fetchone()
+        return row[0]
+
+    def mark_sent(self, write_id, result=None):
+        with self._connect() as connection:
+            connection.execute("UPDATE writes SET status=?, result=?, attempts=attempts+1 WHERE id=?",
+                               (SENT, result, write_id))
+
+    def mark_failed(self, write_id, error, delay=None):
+        """
+        Schedules a failed write to be retried, or gives up on it after too many attempts.
+        :param write_id: The id of the write
+        :param error: The exception that was raised
+        :param delay: Seconds to wait before retrying. Defaults to exponential backoff.
+        """
+        with self._connect() as connection:
+            attempts = connection.execute("SELECT attempts FROM writes WHERE id=?", (write_id,)).fetchone()[0] + 1
+            if attempts >= MAX_ATTEMPTS:
+                status, due_at = DEAD, time.time()
+                logger.error("Giving up on write: id=[%s], attempts=[%s], error=[%r]", write_id, attempts, error)
+            else:
+                if delay is None:
+                    delay = min(RETRY_BACKOFF_INITIAL * 2 ** (attempts - 1), RETRY_BACKOFF_MAX)
+                status, due_at = PENDING, time.time() + delay
+                logger.warning("Write failed, retrying in %s seconds: id=[%s], attempts=[%s], error=[%r]",
+                               delay, write_id, attempts, error)
+            connection.execute("UPDATE writes SET status=?, attempts=?, due_at=?, last_error=? WHERE id=?",
+                               (status, attempts, due_at, repr(error), write_id))
+
+
+class OutboxSender(threading.Thread):
+    """
+    Sends the queued writes of one Reddit account. Only one sender runs per account, see start_for_account().
+    """
+    _senders = {}
+    _senders_lock = threading.Lock()
+
+    def __init__(self, outbox, account, login, rate_limiter):
+        """
+        :param outbox: The Outbox to drain
+        :param account: The Reddit user name whose writes are sent
+        :param login: A function that logs into the account and returns a new praw.Reddit instance. The sender
+                      uses its own instance, since a praw.Reddit instance must not be used by two threads at once.
+        :param rate_limiter: The account's RateLimiter
+        """
+        super(OutboxSender, self).__init__(daemon=True)
+        self.outbox = outbox
+        self.account = account
+        self.login = login
+        self.r = None  # the sender's own praw.Reddit instance, created by login()
+        self.rate_limiter = rate_limiter
+        self.stop_event = threading.Event()
+
+    @classmethod
+    def start_for_account(cls, outbox, account, login, rate_limiter):
+        """
+        Starts the account's sender if it is not already running.
+        :return: The account's OutboxSender
+        """
+        with cls._senders_lock:
+            sender = cls._senders.get(account)
+            if not sender or not sender.is_alive():
+                sender = cls(outbox, account, login, rate_limiter)
+                sender.start()
+                cls._senders[account] = sender
+            return sender
+
+    @classmethod
+    def stop_for_account(cls, account, timeout=None):
+        """
+        Stops the account's sender, e.g. when the account moves to another node. Writes that were claimed but not
+        sent yet are left pending.
+        :param timeout: Time to wait for the sender to stop (wait forever if None).
+        :return: True if the sender stopped, or none was running
+        """
+        with cls._senders_lock:
+            sender = cls._senders.pop(account, None)
+        if sender is None:
+            return True
+        sender.join(timeout)
+        return not sender.is_alive()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if not self._log_in():
+                self.stop_event.wait(RETRY_BACKOFF_INITIAL)
+                continue
+            writes = self.outbox.claim_due_writes(self.account)
+            for index, write in enumerate(writes):
+                self.rate_limiter.acquire()
+                if self.stop_event.is_set():
+                    self.outbox.unclaim([unsent['id'] for unsent in writes[index:]])
+                    return
+                self.send(write)
+            next_due = self.outbox.get_next_due_time(self.account)
+            timeout = POLL_INTERVAL if next_due is None else min(max(next_due - time.time(), 0), POLL_INTERVAL)
+            self.outbox.wait_for_writes(self.account, timeout)
+
+    def join(self, timeout=None):
+        self.stop_event.set()
+        self.outbox.wake(self.account)
+        return super(OutboxSender, self).join(timeout)
+
+    def _log_in(self):
+        """
+        Logs into the account if the sender has no praw.Reddit instance yet. Writes are not claimed until the
+        sender has logged in, so a failed login does not count as a failed attempt of any write.
+        :return: True if the sender is logged in
+        """
+        if self.r is None:
+            try:
+                self.r = self.login()
+            except Exception as e:
+                logger.error("Outbox sender could not log in: account=[%s], error=[%r]", self.account, e)
+                return False
+        return True
+
+    def send(self, write):
+        """
+        Sends a single write, and records the outcome in the outbox.
+        """
+        payload = json.loads(write['payload'])
+        try:
+            with tracing.start_trace("OutboxSender.send", account=self.account, id=write['id'], kind=write['kind'],
+                                     attempt=write['attempts'] + 1):
+                if self.r is None:
+                    self.r = self.login()
+                if write['kind'] == SUBMIT:
+                    result = self._submit(payload, is_retry=write['attempts'] > 0)
+                elif write['kind'] == EDIT:
+                    result = self._edit(payload)
+                elif write['kind'] == MESSAGE:
+                    result = self._send_message(payload, is_retry=write['attempts'] > 0,
+                                                queued_at=write['created_at'])
+                else:
+                    raise ValueError("Unknown write kind: {}".format(write['kind']))
+        except praw.errors.RateLimitExceeded as e:
+            self.outbox.mark_failed(write['id'], e, delay=e.sleep_time)
+        except Exception as e:
+            self.outbox.mark_failed(write['id'], e)
+        else:
+            logger.info("Write sent: id=[%s], kind=[%s], result=[%s]", write['id'], write['kind'], result)
+            self.outbox.mark_sent(write['id'], result)
+
+    def _submit(self, payload, is_retry):
+        """
+        Submits a post. If an earlier attempt may have reached Reddit before failing, the account's recent
+        submissions are checked first so the post is not submitted twice.
+        :return: The id of the post
+        """
+        if is_retry:
+            for post in self.r.get_me().get_submitted(sort="new", time="day"):
+                if post.title == payload['title'] and post.subreddit.display_name.lower() == \
+                        payload['subreddit'].lower():
+                    logger.info("Queued submission was already posted: id=[%s]", post.id)
+                    return post.id
+        with tracing.span("reddit.submit", subreddit=payload['subreddit'], url=payload.get('url')):
+            post = self.r.submit(payload['subreddit'], payload['title'], text=payload.get('text'),
+                                 url=payload.get('url'))
+        return post.id
+
+    def _edit(self, payload):
+        with tracing.span("reddit.edit", id=payload['post_id']):
+            post = self.r.get_submission(submission_id=payload['post_id'])
+            post.edit(payload['text'])
+        return payload['post_id']
+
+    def _send_message(self, payload, is_retry, queued_at):
+        """
+        Sends a private message. If an earlier attempt may have reached Reddit before failing, e.g. its response was
+        lost, the account's sent messages since the write was queued are checked first so it is not sent twice.
+        """
+        if is_retry:
+            for message in self.r.get_sent(limit=SENT_MESSAGES_CHECKED):
+                if message.created_utc < queued_at - CLOCK_SKEW:
+                    break
+                if message.dest.lower() == payload['recipient'].lower() and message.subject == payload['subject'] \
+                        and message.body.strip() == payload['text'].strip():
+                    logger.info("Queued message was already sent: id=[%s]", message.id)
+                    return None
+        with tracing.span("reddit.send_message", recipient=payload['recipient']):
+            self.r.send_message(payload['recipient'], payload['subject'], payload['text'])
+        return None
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox():
+    """
+    :return: The Outbox shared by every bot in the process.
+    """
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox()
+        return _outbox
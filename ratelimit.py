@@ -0,0 +1,52 @@
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    A thread-safe token bucket. Every call to acquire() takes one token, and blocks until one is available.
+    Bots that log into the same Reddit account should share a limiter, see RateLimiter.for_account().
+    """
+    _account_limiters = {}
+    _account_lock = threading.Lock()
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: Number of tokens added to the bucket per second.
+        :param burst: Largest number of tokens the bucket can hold. Defaults to rate, or 1 if rate is smaller.
+        """
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_account(cls, account_name, rate, burst=None):
+        """
+        Gets the limiter shared by every bot using a Reddit account, creating it if needed.
+        :param account_name: A Reddit user name
+        :return: A RateLimiter
+        """
+        with cls._account_lock:
+            if account_name not in cls._account_limiters:
+                cls._account_limiters[account_name] = cls(rate, burst)
+            return cls._account_limiters[account_name]
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """
+        Takes a token, waiting until one is available.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
@@ -1,7 +1,14 @@
 import configparser
+import threading
+import uuid
 import praw
 import webbrowser
-from config.praw_config import CredKeys, OAUTH_CRED_KEYS, set_reddit_oauth_refresh_token, PRAW_FILE_PATH, get_reddit_oath_credentials
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from config.praw_config import CredKeys, OAUTH_CRED_KEYS, set_reddit_oauth_refresh_token, PRAW_FILE_PATH, get_reddit_oath_credentials, set_reddit_oauth_refresh_tokens
+
+BATCH_TIMEOUT = 1800  # seconds to wait for every account to be authorized
 
 
 def get_sites_with_scopes(_parser=None):
@@ -28,6 +35,24 @@ def get_sites_without_refresh_tokens():
     return [(site_name, scope) for (site_name, scope) in get_sites_with_scopes(cp)if not cp[site_name][refresh_config_key]]
 
 
+def get_access_information(reddit, account_name, code):
+    """
+    Exchanges an authorization code for access information, and checks that the account itself allowed access.
+    A browser is logged into one Reddit account at a time, so the code may belong to another account.
+    :param reddit: The praw.Reddit instance that made the authorization URL
+    :param account_name: The Reddit user who should have allowed access
+    :param code: The code Reddit sent to the redirect URI
+    :return: The access information, including the refresh token
+    :raises ValueError: if another Reddit user allowed access
+    """
+    access_information = reddit.get_access_information(code)
+    authorized_name = reddit.get_me().name  # every registered account has the identity scope
+    if authorized_name.lower() != account_name.lower():
+        raise ValueError("Access was allowed by /u/{} instead of /u/{}. Log into /u/{} and try again."
+                         .format(authorized_name, account_name, account_name))
+    return access_information
+
+
 def set_oauth_refresh_token(account_name, oauth_scope):
     """
     Triggers the login process to generate a refresh token, and saves the token. The process steps are:
@@ -48,12 +73,137 @@ def set_oauth_refresh_token(account_name, oauth_scope):
     webbrowser.open(url)
     code = input("Enter code: ")
     print("Getting access information.")
-    access_information = r.get_access_information(code)
+    access_information = get_access_information(r, account_name, code)
     refresh_token = access_information['refresh_token']
     print("Saving refresh token.")
     set_reddit_oauth_refresh_token(account_name, refresh_token)
 
 
+class OAuthCallbackHandler(BaseHTTPRequestHandler):
+    """
+    Receives the redirect that Reddit sends the browser to after a login is authorized or declined.
+    """
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        state = query.get('state', [None])[0]
+        if not self.server.on_callback(state, query.get('code', [None])[0], query.get('error', [None])[0]):
+            self._respond(400, "This login was not started by account_register.py, or was already finished.")
+        elif 'error' in query:
+            self._respond(200, "The login was declined: {}. You can close this window.".format(query['error'][0]))
+        else:
+            self._respond(200, "The account was authorized. You can close this window.")
+
+    def _respond(self, status, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class OAuthCallbackServer(HTTPServer):
+    """
+    A local web server listening on an oauth_redirect_uri, so OAuth codes no longer have to be copied by hand.
+    """
+    def __init__(self, redirect_uri, on_callback):
+        """
+        :param redirect_uri: The redirect URI of the Reddit app, e.g. http://127.0.0.1:8080/authorize_callback
+        :param on_callback: A function called with the state, code, and error of every redirect.
+                            It returns False if the state is unknown.
+        """
+        parts = urlparse(redirect_uri)
+        super(OAuthCallbackServer, self).__init__((parts.hostname, parts.port or 80), OAuthCallbackHandler)
+        self.on_callback = on_callback
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def register_accounts_in_batch(accounts, timeout=BATCH_TIMEOUT, open_browser=True):
+    """
+    Authorizes several accounts at once, and saves all of their refresh tokens with a single write of praw.ini.
+    A callback server is started on each distinct oauth_redirect_uri host and port, and the authorization page of
+    every account is opened. Log into each account in the browser and allow access; each redirect is captured by the
+    callback server, and its code is exchanged for tokens in the background while the next account is authorized.
+    A token is only saved if the account it was made for allowed access, not whichever account the browser was
+    logged into.
+    :param accounts: A list of tuples containing site name and scopes, as returned by get_sites_with_scopes()
+    :param timeout: Number of seconds to wait for all the accounts to be authorized.
+    :param open_browser: If False, the authorization URLs are only printed.
+    :return: A dict mapping the site names that were registered to their refresh tokens
+    """
+    parser = configparser.ConfigParser()
+    parser.read(PRAW_FILE_PATH)
+    logins = {}  # state -> (account name, praw.Reddit)
+    urls = {}  # account name -> authorization URL
+    redirect_uris = set()
+    for account_name, oauth_scope in accounts:
+        oauth_credentials = get_reddit_oath_credentials(account_name, parser)
+        r = praw.Reddit("Getting first OAuth refresh token for /u/{}".format(account_name))
+        r.set_oauth_app_info(client_id=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.client]],
+                             client_secret=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.secret]],
+                             redirect_uri=oauth_credentials[OAUTH_CRED_KEYS[CredKeys.uri]])
+        state = uuid.uuid4().hex  # unguessable, so only logins started here are accepted
+        logins[state] = (account_name, r)
+        urls[account_name] = r.get_authorize_url(state=state, scope=oauth_scope, refreshable=True)
+        redirect_uris.add(oauth_credentials[OAUTH_CRED_KEYS[CredKeys.uri]])
+
+    lock = threading.Lock()
+    finished = threading.Event()
+    exchanges = {}  # account name -> Future of the access information
+    declined = {}  # account name -> error
+    executor = ThreadPoolExecutor(max_workers=max(len(accounts), 1))
+
+    def on_callback(state, code, error):
+        with lock:
+            if state not in logins:
+                return False
+            account, reddit = logins.pop(state)
+            if code:
+                print("Received code for {}, getting access information.".format(account))
+                exchanges[account] = executor.submit(get_access_information, reddit, account, code)
+            else:
+                print("Login for {} was declined: {}".format(account, error))
+                declined[account] = error
+            if not logins:
+                finished.set()
+            return True
+
+    servers = {}
+    for uri in redirect_uris:
+        parts = urlparse(uri)
+        if (parts.hostname, parts.port) not in servers:
+            servers[(parts.hostname, parts.port)] = OAuthCallbackServer(uri, on_callback).start()
+    try:
+        for account_name, url in urls.items():
+            print("Authorize {}: {}".format(account_name, url))
+            if open_browser:
+                webbrowser.open_new_tab(url)
+        if not finished.wait(timeout):
+            print("Timed out waiting for: {}".format(", ".join(account for account, _ in logins.values())))
+    finally:
+        for server in servers.values():
+            server.shutdown()
+            server.server_close()
+        executor.shutdown(wait=True)
+
+    tokens = {}
+    for account, future in exchanges.items():
+        try:
+            tokens[account] = future.result()['refresh_token']
+        except Exception as e:
+            print("Could not get access information for {}: {!r}".format(account, e))
+    if tokens:
+        print("Saving refresh tokens: {}".format(", ".join(sorted(tokens))))
+        set_reddit_oauth_refresh_tokens(tokens)  # re-reads praw.ini, in case it changed while waiting
+    return tokens
+
+
 def register_new_accounts():
     """
     High-level helper function that gets all Reddit users in praw.ini that have no refresh token, and triggers the login
@@ -79,10 +229,23 @@ def main():
                     help="Find all new accounts in the config file, and set their refresh tokens.")
     ap.add_argument("--account-names", "-a", dest="account_names", nargs="+", default=[], choices=choices,
                     help="Only set refresh tokens for specific accounts.")
+    ap.add_argument("--batch", "-b", dest="batch", action="store_true",
+                    help="Authorize all the accounts at once, capturing codes with a local server on each "
+                         "oauth_redirect_uri, and save every refresh token with a single write.")
+    ap.add_argument("--no-browser", dest="open_browser", action="store_false",
+                    help="With --batch, print the authorization URLs instead of opening them.")
     args = ap.parse_args()
 
     if args.only_new_accounts and args.account_names:
         print("You cannot have both new-accounts and account-names set.")
+    elif args.batch and (args.only_new_accounts or args.account_names):
+        accounts = get_sites_without_refresh_tokens() if args.only_new_accounts else \
+            [(account, scopes[account]) for account in args.account_names]
+        if not accounts:
+            print("No new accounts are in the PRAW config file.")
+        else:
+            print("Registering accounts in a batch: {}".format(", ".join(account for account, _ in accounts)))
+            register_accounts_in_batch(accounts, open_browser=args.open_browser)
     elif args.only_new_accounts:
         print("Registering all new accounts")
         register_new_accounts()
@@ -0,0 +1,51 @@
+"""
+Changes the bots of a running program through its control socket, without restarting the other bots.
+
+Run it from the project directory while `python .` is running:
+    python scripts/control.py list
+    python scripts/control.py start YourRedditAccountName           # an account added to praw.ini
+    python scripts/control.py stop YourRedditAccountName NewsBot
+    python scripts/control.py restart YourRedditAccountName
+    python scripts/control.py reload                                # apply the changes made to praw.ini
+"""
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import control
+
+
+def print_status(bots):
+    for bot in bots:
+        state = "stalled" if bot['stalled'] else "stopped" if not bot['alive'] else \
+            "running" if bot['ready'] else "starting"
+        print("{:<24} {:<12} {:<8} cycles {:<6} {}".format(bot['account'], bot['bot'], state, bot['cycles'],
+                                                           bot['last_error'] or ""))
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Start, stop, restart, or list the bots of a running program.")
+    parser.add_argument("command", choices=control.COMMANDS)
+    parser.add_argument("account", nargs='?', help="The Reddit account in praw.ini the command is for.")
+    parser.add_argument("bot", nargs='?', help="The bot class the command is for. Defaults to every bot of the "
+                                               "account.")
+    parser.add_argument("--socket", "-s", dest="socket", default=control.SOCKET_PATH,
+                        help="Path of the control socket.")
+    args = parser.parse_args()
+
+    try:
+        result = control.send_command(args.command, args.account, args.bot, path=args.socket)
+    except (OSError, control.ControlError) as e:
+        sys.exit("{}: {}".format(args.command, e))
+    if args.command == 'list':
+        print_status(result)
+    else:
+        print(json.dumps(result, indent=2))
+
+if __name__ == '__main__':
+    main()
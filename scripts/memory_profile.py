@@ -0,0 +1,344 @@
+"""
+Memory profiling harness for the bot fleet.
+It builds a Dispatch for NewsBot, EventBot, and TicketBot, replaces Reddit and the scraped websites with
+in-memory fixtures, and runs the Dispatch on a VirtualClock for thousands of simulated cycles under tracemalloc.
+Memory growth is reported per bot and per allocation site, and the run fails when a bot grows more than its budget.
+
+Run it from the project directory:
+    python scripts/memory_profile.py --cycles 2000
+"""
+import datetime
+import gc
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import tracemalloc
+from collections import namedtuple, defaultdict
+from email.utils import format_datetime
+from unittest.mock import patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import requests
+import eventbot
+import newsbot
+import outbox
+import store
+import tokencache
+from clock import VirtualClock
+from config import bot_config
+from ratelimit import RateLimiter
+
+BOT_CLASS_NAMES = "NewsBot,EventBot,TicketBot"
+FIXTURE_ACCOUNT = "memory_profile_bot"
+CYCLE_SECONDS = 600  # every bot works once per simulated cycle
+TRACED_FRAMES = 100  # enough to reach the bot's own module from the allocations made deep inside parsers
+STARTUP_TIMEOUT = 60
+
+BotReport = namedtuple('BotReport', 'classname cycles growth_kb budget_kb')
+ProfileReport = namedtuple('ProfileReport', 'cycles bots top_sites')
+
+
+# region REDDIT FIXTURES
+class FixtureSubreddit(object):
+    def __init__(self, name):
+        self.display_name = name
+
+
+class FixtureSubmission(object):
+    def __init__(self, post_id, subreddit, title, text=None, url=None):
+        self.id = post_id
+        self.subreddit = FixtureSubreddit(subreddit)
+        self.title = title
+        self.selftext = text or ""
+        self.url = url or ""
+        self.author = FIXTURE_ACCOUNT
+        self.created_utc = datetime.datetime.utcnow().timestamp()
+
+    def edit(self, text):
+        self.selftext = text
+        return self
+
+
+class FixtureMessage(object):
+    def __init__(self, message_id, body):
+        self.id = message_id
+        self.body = body
+        self.author = "fixture_user"
+
+    def mark_as_read(self):
+        pass
+
+
+class FixtureRedditor(object):
+    def __init__(self):
+        self.name = FIXTURE_ACCOUNT
+        self.link_karma = 1
+
+    def get_submitted(self, *args, **kwargs):
+        return iter([])
+
+
+class FixtureReddit(object):
+    """
+    Stands in for a logged in praw.Reddit instance. Submissions are kept in memory, and a few
+    unread messages and comments with commands arrive every cycle.
+    """
+    refresh_token = access_token = None  # the fixtures do not need OAuth tokens
+
+    def __init__(self):
+        self.self_posts = {}  # link posts are never read back, so only self posts are kept
+        self._ids = itertools.count(1)
+        self.cycle = 0
+
+    def get_me(self):
+        return FixtureRedditor()
+
+    def get_info(self, url=None, **kwargs):
+        return None
+
+    def submit(self, subreddit, title, text=None, url=None, **kwargs):
+        submission = FixtureSubmission("fx{}".format(next(self._ids)), subreddit, title, text, url)
+        if text is not None:
+            self.self_posts[submission.id] = submission
+        return submission
+
+    def get_submission(self, url=None, submission_id=None, **kwargs):
+        if submission_id not in self.self_posts:
+            raise ValueError("Unknown submission: {}".format(submission_id))
+        return self.self_posts[submission_id]
+
+    def send_message(self, recipient, subject, message, **kwargs):
+        pass
+
+    def get_unread(self, *args, **kwargs):
+        return [FixtureMessage("m{}-{}".format(self.cycle, n), "!FAUbot buy {}".format(n + 1)) for n in range(3)]
+
+    def get_comments(self, subreddit, limit=None, place_holder=None, **kwargs):
+        comments = [FixtureMessage("c{}-{}".format(cycle, n), "!FAUbot sell {}".format(n + 1) if n else "Hello")
+                    for cycle in (self.cycle, self.cycle - 1) for n in reversed(range(3))]
+        for comment in comments[:limit]:
+            yield comment
+            if comment.id == place_holder:
+                return
+# endregion
+
+
+# region WEB FIXTURES
+class FixtureResponse(object):
+    def __init__(self, body, status_code=200, headers=None):
+        self.content = body.encode('utf-8')
+        self.text = body
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FixtureWeb(object):
+    """
+    Serves generated upressonline.com pages. Every cycle publishes new articles and changes the events,
+    so the bots keep doing real work instead of hitting their caches.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.cycle = 0
+
+    def _events(self):
+        now = self.clock.now()
+        events = []
+        for n in range(10):
+            start = now + datetime.timedelta(days=n + 1)
+            events.append({'title': "Event {} (cycle {})".format(n, self.cycle),
+                           'url': "http://www.upressonline.com/event/{}-{}/".format(self.cycle, n),
+                           'excerpt': "<p>Fixture event {}</p>".format(n),
+                           'start_date': start.strftime("%Y-%m-%d %H:%M:%S"),
+                           'end_date': (start + datetime.timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S")})
+        return events
+
+    def _articles(self):
+        return [("http://www.upressonline.com/{}/{}/article-{}-{}/".format(self.cycle, n, self.cycle, n),
+                 "Article {} from cycle {}".format(n, self.cycle)) for n in range(3)]
+
+    def get(self, url, *args, **kwargs):
+        if "/feed/" in url:
+            now = format_datetime(self.clock.now(datetime.timezone.utc))
+            items = "".join("<item><title>{}</title><link>{}</link><guid>{}</guid><pubDate>{}</pubDate></item>"
+                            .format(title, link, link, now) for link, title in self._articles())
+            return FixtureResponse("<?xml version='1.0'?><rss><channel>{}</channel></rss>".format(items))
+        if "wp-json/tribe" in url:
+            return FixtureResponse(json.dumps({'events': self._events(), 'total_pages': 1}))
+        if "fauevents" in url:
+            from eventsapi import EventsApiClient
+            divs = "".join("<div data-tribejson='{}'></div>".format(json.dumps(EventsApiClient.to_tribe_json(event)))
+                           for event in self._events())
+            return FixtureResponse("<html><body>{}</body></html>".format(divs))
+        links = "".join("<a rel='bookmark' href='{}'>{}</a>".format(link, title) for link, title in self._articles())
+        return FixtureResponse("<html><body>{}</body></html>".format(links))
+# endregion
+
+
+def _load_dispatch_module():
+    """
+    Loads the program's __main__.py as a regular module, so its Dispatch can be used without running main().
+    """
+    spec = importlib.util.spec_from_file_location("faubot_main", os.path.join(ROOT, "__main__.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_budget_kb(classname, cycles):
+    """
+    Budgets are configured per 1000 cycles, since the fixtures publish new content every cycle
+    (e.g. NewsBot keeps every article published today).
+    :return: How many KiB a bot may grow during a number of cycles.
+    """
+    budgets = bot_config.get_profiling_setting('budgets_kb_per_1000_cycles')
+    return budgets.get(classname, budgets['default']) * cycles / 1000
+
+
+def run_profile(cycles=None, warmup_cycles=None, top=10):
+    """
+    Runs every bot for a number of simulated cycles and measures how much traced memory each one keeps.
+    The bots run in their own threads through a Dispatch, on a VirtualClock that the profiler holds between cycles,
+    so memory is only measured while every bot is sleeping. A bot's memory is everything allocated by its module,
+    e.g. newsbot.py for NewsBot, including what the libraries it called allocated.
+    :param cycles: Number of measured cycles. Defaults to the configured value.
+    :param warmup_cycles: Number of cycles run before measuring starts, so caches can fill up. The first cycle is
+                          always a warmup cycle.
+    :param top: Number of allocation sites to include in the report.
+    :return: A ProfileReport
+    """
+    cycles = cycles or bot_config.get_profiling_setting('cycles')
+    warmup_cycles = bot_config.get_profiling_setting('warmup_cycles') if warmup_cycles is None else warmup_cycles
+    warmup_cycles = max(warmup_cycles, 1)
+    clock = VirtualClock(start=int(datetime.datetime.now().timestamp()))
+    web = FixtureWeb(clock)
+    reddit = FixtureReddit()
+
+    # the outbox sender thread is never started; the writes the bots queued are sent between cycles instead.
+    # Every bot sleeps for one cycle between its work, and NewsBot refreshes its candidates and submits every cycle.
+    # Cycles are simulated back to back, so downloaded pages are not shared between them.
+    with tempfile.TemporaryDirectory() as data_directory, \
+            patch.object(store, 'DATA_DIRECTORY', data_directory), \
+            patch.object(outbox, '_outbox', outbox.Outbox(os.path.join(data_directory, "outbox.db"))), \
+            patch.object(outbox.OutboxSender, 'start', lambda sender: None), \
+            patch.object(tokencache, '_cache', tokencache.AccessTokenCache(directory=data_directory)), \
+            patch.object(bot_config, 'get_sleep_interval', lambda classname: CYCLE_SECONDS), \
+            patch.object(newsbot, 'SUBMISSION_INTERVAL_HOURS', CYCLE_SECONDS / 3600), \
+            patch.object(newsbot, 'CANDIDATE_REFRESH_INTERVAL', CYCLE_SECONDS), \
+            patch.object(newsbot.link_lists, 'ttl', 0), \
+            patch.object(eventbot.event_lists, 'ttl', 0), \
+            patch.object(requests, 'get', web.get), \
+            patch.object(requests.Session, 'get', web.get):
+        dispatch_module = _load_dispatch_module()
+        signature = dispatch_module.BotSignature(classname=BOT_CLASS_NAMES, username=FIXTURE_ACCOUNT, permissions="")
+        dispatch = dispatch_module.Dispatch([signature], clock=clock)
+        bots = dispatch.get_bot_list()
+        unlimited = RateLimiter(rate=1e9)  # the fixtures have no API limits, so cycles run back to back
+        for bot in bots:
+            bot.r = reddit
+            bot.rate_limiter = unlimited
+        sender = outbox.OutboxSender(outbox.get_outbox(), FIXTURE_ACCOUNT, lambda: reddit, unlimited)
+
+        def finish_cycle():
+            """
+            Waits until every bot has finished its work and sends the writes they queued.
+            """
+            clock.wait_until_idle()
+            crashed = [bot.name for bot in bots if not bot.is_alive()]
+            if crashed:
+                raise RuntimeError("Bots crashed while profiling: {}".format(", ".join(crashed)))
+            for write in sender.outbox.claim_due_writes(FIXTURE_ACCOUNT, limit=100):
+                sender.send(write)
+            gc.collect()
+
+        def measure():
+            """
+            :return: A snapshot of the traced memory, and the number of bytes held by each bot's allocations
+            """
+            snapshot = tracemalloc.take_snapshot()
+            sizes = {}
+            for bot in bots:
+                module_filter = tracemalloc.Filter(True, sys.modules[bot.__module__].__file__, all_frames=True)
+                sizes[bot] = sum(stat.size for stat in snapshot.filter_traces([module_filter]).statistics('filename'))
+            return snapshot, sizes
+
+        tracemalloc.start(TRACED_FRAMES)
+        clock.register()  # the clock only moves while the profiler waits for the next cycle
+        try:
+            dispatch.start()
+            if not dispatch.ready.wait(STARTUP_TIMEOUT):
+                raise RuntimeError("Bots did not start: {}".format(dispatch.get_readiness()))
+            for cycle in range(1, warmup_cycles + cycles + 1):  # each bot does its first cycle when it starts
+                finish_cycle()
+                if cycle == warmup_cycles:
+                    baseline, baseline_sizes = measure()
+                    baseline_cycles = {bot: bot.cycles for bot in bots}
+                if cycle < warmup_cycles + cycles:
+                    web.cycle = reddit.cycle = cycle
+                    clock.wait(threading.Event(), CYCLE_SECONDS)
+            final, final_sizes = measure()
+        finally:
+            dispatch.join(STARTUP_TIMEOUT)  # the bots stop while they sleep, since the clock cannot move
+            clock.unregister()
+            tracemalloc.stop()
+            outbox.OutboxSender._senders.pop(FIXTURE_ACCOUNT, None)
+
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen *>")]
+    top_sites = final.filter_traces(filters).compare_to(baseline.filter_traces(filters), 'lineno')[:top]
+    bot_reports = [BotReport(classname=bot.__class__.__name__, cycles=bot.cycles - baseline_cycles[bot],
+                             growth_kb=(final_sizes[bot] - baseline_sizes[bot]) / 1024,
+                             budget_kb=get_budget_kb(bot.__class__.__name__, cycles)) for bot in bots]
+    return ProfileReport(cycles=cycles, bots=bot_reports, top_sites=top_sites)
+
+
+def get_over_budget(report):
+    """
+    :return: The BotReports of bots that grew more than their budget.
+    """
+    return [bot for bot in report.bots if bot.growth_kb > bot.budget_kb]
+
+
+def print_report(report):
+    print("Memory growth over {} cycles:".format(report.cycles))
+    for bot in report.bots:
+        print("  {:<12} {:>10.1f} KiB in {} cycles (budget {:.1f} KiB)".format(bot.classname, bot.growth_kb,
+                                                                             bot.cycles, bot.budget_kb))
+    print("Top allocation sites:")
+    for stat in report.top_sites:
+        print("  {}".format(stat))
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Profile the memory use of the bot fleet against fixtures.")
+    parser.add_argument("--cycles", "-c", dest="cycles", type=int, help="Number of measured cycles.")
+    parser.add_argument("--warmup", "-w", dest="warmup_cycles", type=int, help="Number of unmeasured cycles.")
+    parser.add_argument("--top", "-t", dest="top", type=int, default=10, help="Number of allocation sites shown.")
+    args = parser.parse_args()
+
+    report = run_profile(args.cycles, args.warmup_cycles, args.top)
+    print_report(report)
+    over_budget = get_over_budget(report)
+    if over_budget:
+        print("Over budget: {}".format(", ".join(bot.classname for bot in over_budget)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
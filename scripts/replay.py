@@ -0,0 +1,149 @@
+"""
+Replays a cassette recorded with `python . --record CASSETTE` to reproduce what the bots saw.
+NewsBot, EventBot, and TicketBot are run one cycle at a time against the recorded upressonline.com pages and
+Reddit responses, without using the network. Each bot starts from an empty data directory, random numbers are
+seeded, and the bots run on a virtual clock that follows the recorded times, so every replay of a cassette makes
+the same requests, whatever day it is replayed on. Responses are returned immediately, or with their
+recorded latencies when --realtime is given, and the time each bot spends working is reported.
+
+Run it from the project directory:
+    python scripts/replay.py data/cassette.jsonl.gz --realtime
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from unittest.mock import patch
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import praw
+import cassette
+import outbox
+import store
+import newsbot  # the bot modules must be imported so RedditBot knows their classes
+import eventbot
+import ticketbot
+from bots import RedditBot
+from clock import VirtualClock
+from config import getLogger
+from ratelimit import RateLimiter
+
+logger = getLogger()
+
+BOT_CLASS_NAMES = "NewsBot,EventBot,TicketBot"
+REPLAY_ACCOUNT = "replay_bot"
+REPLAY_SCOPE = {'identity', 'edit', 'history', 'privatemessages', 'read', 'submit'}
+RANDOM_SEED = 0
+
+BotTimings = namedtuple('BotTimings', 'classname cycles total_seconds max_seconds errors')
+ReplayReport = namedtuple('ReplayReport', 'cycles bots played remaining')
+
+
+def get_replay_reddit(realtime):
+    """
+    Creates a praw.Reddit instance that uses placeholder credentials, since every response comes from the cassette.
+    :param realtime: If False, praw's delay between API requests is turned off.
+    """
+    r = praw.Reddit(user_agent="/u/{} replaying a cassette".format(REPLAY_ACCOUNT))
+    if not realtime:
+        r.config.api_request_delay = 0
+    r.set_oauth_app_info(client_id=cassette.REDACTED, client_secret=cassette.REDACTED,
+                         redirect_uri="http://127.0.0.1:65010/authorize_callback")
+    r.set_access_credentials(REPLAY_SCOPE, cassette.REDACTED, update_user=False)
+    return r
+
+
+def run_replay(path, realtime=False, max_cycles=None, class_names=BOT_CLASS_NAMES):
+    """
+    Runs the bots against a cassette until every recorded interaction has been played, a whole cycle plays
+    none, or max_cycles is reached.
+    :param path: Path of the cassette
+    :param realtime: If True, responses take as long as they did when they were recorded.
+    :param max_cycles: Largest number of cycles to run, or None
+    :param class_names: Comma separated names of the bot classes to run
+    :return: A ReplayReport
+    """
+    bot_classes = {cls.__name__: cls for cls in RedditBot.get_subclasses()}
+    random.seed(RANDOM_SEED)
+
+    # the outbox sender thread is never started; candidates are refreshed every time a NewsBot works and queued
+    # writes are sent right after, so the replay does not depend on thread or clock timing.
+    # Cycles run back to back, so downloaded pages are not shared between them.
+    with tempfile.TemporaryDirectory() as data_directory, \
+            patch.object(store, 'DATA_DIRECTORY', data_directory), \
+            patch.object(outbox, '_outbox', outbox.Outbox(os.path.join(data_directory, "outbox.db"))), \
+            patch.object(outbox.OutboxSender, 'start', lambda sender: None), \
+            patch.object(newsbot, 'CANDIDATE_REFRESH_INTERVAL', 0), \
+            patch.object(newsbot.link_lists, 'ttl', 0), \
+            patch.object(eventbot.event_lists, 'ttl', 0), \
+            cassette.replaying(path, realtime) as player:
+        if player.started_at is None:
+            raise ValueError("The cassette has no header with its start time: {}".format(path))
+        # e.g. NewsBot's articles from today and EventBot's passed events depend on the time
+        clock = VirtualClock(start=player.started_at)
+        r = get_replay_reddit(realtime)
+        unlimited = RateLimiter(rate=1e9)  # waits come from the recorded latencies, not the limiter
+        bots = [bot_classes[name](user_name=REPLAY_ACCOUNT, clock=clock) for name in class_names.split(",")]
+        for bot in bots:
+            bot.r = r
+            bot.rate_limiter = unlimited
+            bot.login()
+        sender = outbox.OutboxSender(outbox.get_outbox(), REPLAY_ACCOUNT, lambda: r, unlimited)
+        timings = {bot: [] for bot in bots}
+        errors = {bot: 0 for bot in bots}
+
+        cycles = 0
+        while player.remaining() and (max_cycles is None or cycles < max_cycles):
+            remaining_before = player.remaining()
+            for bot in bots:
+                clock.advance(max(player.get_recorded_time() - clock.time(), 0))
+                started = time.monotonic()
+                try:
+                    bot.work()
+                except Exception:
+                    logger.exception("Bot failed during replay: bot=[%s]", bot.__class__.__name__)
+                    errors[bot] += 1
+                for write in sender.outbox.claim_due_writes(REPLAY_ACCOUNT, limit=100):
+                    sender.send(write)
+                timings[bot].append(time.monotonic() - started)
+            cycles += 1
+            if player.remaining() == remaining_before:
+                break
+        outbox.OutboxSender._senders.pop(REPLAY_ACCOUNT, None)
+        remaining = player.remaining()
+
+    bot_timings = [BotTimings(classname=bot.__class__.__name__, cycles=len(timings[bot]),
+                              total_seconds=sum(timings[bot]), max_seconds=max(timings[bot], default=0),
+                              errors=errors[bot]) for bot in bots]
+    return ReplayReport(cycles=cycles, bots=bot_timings, played=len(player.interactions) - remaining,
+                        remaining=remaining)
+
+
+def print_report(report):
+    print("Replayed {} interactions in {} cycles ({} not played):".format(report.played, report.cycles,
+                                                                          report.remaining))
+    for bot in report.bots:
+        print("  {:<12} total {:>8.3f}s  max {:>8.3f}s  errors {}".format(bot.classname, bot.total_seconds,
+                                                                         bot.max_seconds, bot.errors))
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Replay a recorded cassette through the bots, without using the network.")
+    parser.add_argument("cassette", help="Path of a cassette recorded with --record.")
+    parser.add_argument("--realtime", action="store_true",
+                        help="Delay every response by its recorded latency instead of replaying at full speed.")
+    parser.add_argument("--cycles", "-c", dest="cycles", type=int, help="Largest number of cycles to run.")
+    parser.add_argument("--bots", "-b", dest="bots", default=BOT_CLASS_NAMES,
+                        help="Comma separated names of the bot classes to run.")
+    args = parser.parse_args()
+
+    print_report(run_replay(args.cassette, args.realtime, args.cycles, args.bots))
+
+if __name__ == '__main__':
+    main()
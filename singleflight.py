@@ -0,0 +1,80 @@
+import threading
+import time
+
+import tracing
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical work requested by several threads, e.g. every bot of a Dispatch downloading and parsing the
+    same page in the same minute. The first caller with a key runs the function, and callers that arrive with the
+    same key while it runs wait for it and share its result, or its exception. A result can also be kept for a while
+    after it finishes, so callers that arrive shortly after share it too. Exceptions are never kept.
+    Callers share the same result object, so they must not change it.
+    """
+    def __init__(self, ttl=0, clock=time.monotonic):
+        """
+        :param ttl: Number of seconds a result is kept after the function returns it. 0 only shares calls in flight.
+        :param clock: A function that returns seconds, used to expire results
+        """
+        self.ttl = ttl
+        self.clock = clock
+        self.calls = 0  # number of times a function actually ran
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call, running or with a kept result
+
+    def _drop_expired(self):
+        now = self.clock()
+        for key in [key for key, call in self._calls.items()
+                    if call.finished_at is not None and now - call.finished_at >= self.ttl]:
+            del self._calls[key]
+
+    def do(self, key, function, *args, **kwargs):
+        """
+        Calls function(*args, **kwargs), unless a call with the same key is running or its result is still kept.
+        :param key: A hashable value that identifies the work, e.g. a URL
+        :return: The result of the function
+        """
+        with self._lock:
+            self._drop_expired()
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+        if not is_leader:
+            if not call.done.is_set():
+                with tracing.span("singleflight.wait", key=str(key)):
+                    call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                call.finished_at = self.clock()
+                if call.error is not None or self.ttl <= 0:
+                    del self._calls[key]
+            call.done.set()
+
+    def clear(self):
+        """
+        Forgets every kept result. Calls in flight are still shared.
+        """
+        with self._lock:
+            for key in [key for key, call in self._calls.items() if call.finished_at is not None]:
+                del self._calls[key]
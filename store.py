@@ -0,0 +1,123 @@
+import json
+import os
+import tempfile
+import threading
+
+from config import data_directory
+
+DATA_DIRECTORY = data_directory
+
+
+class JsonStore(object):
+    """
+    A small dictionary that is saved to a JSON file in the data directory whenever it changes.
+    Bots use it to remember things across restarts. Keys must be strings, and values must be JSON serializable.
+    """
+    def __init__(self, name, directory=None):
+        """
+        :param name: Name of the store. The file will be named <name>.json.
+        :param directory: The directory where the file is saved. Defaults to DATA_DIRECTORY.
+        """
+        self.path = os.path.join(directory or DATA_DIRECTORY, "{}.json".format(name))
+        self._lock = threading.RLock()
+        self._data = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as ifile:
+                return json.load(ifile)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        """
+        Writes the whole dictionary to a temporary file, then moves it over the old file,
+        so a crash never leaves a half-written store behind.
+        """
+        directory = os.path.dirname(self.path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as ofile:
+                json.dump(self._data, ofile)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._save()
+
+    def delete(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._save()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+
+class JsonLinesStore(object):
+    """
+    A list of records saved to a file in the data directory, one JSON record per line. Adding a record appends a
+    line instead of rewriting the file, so it suits stores that only grow, e.g. an index of every title a bot
+    submitted. A line left half-written by a crash is skipped when the file is read.
+    """
+    def __init__(self, name, directory=None):
+        """
+        :param name: Name of the store. The file will be named <name>.jsonl.
+        :param directory: The directory where the file is saved. Defaults to DATA_DIRECTORY.
+        """
+        self.path = os.path.join(directory or DATA_DIRECTORY, "{}.jsonl".format(name))
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        :return: A list of every record in the file, oldest first
+        """
+        records = []
+        with self._lock:
+            try:
+                with open(self.path, "r") as ifile:
+                    for line in ifile:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            pass
+            except IOError:
+                pass
+        return records
+
+    def append(self, record):
+        """
+        Adds a record to the end of the file. Records must be JSON serializable.
+        """
+        line = (json.dumps(record) + "\n").encode('utf-8')
+        with self._lock:
+            with open(self.path, "a+b") as ofile:
+                if ofile.seek(0, os.SEEK_END):
+                    ofile.seek(-1, os.SEEK_END)
+                    if ofile.read(1) != b"\n":
+                        line = b"\n" + line  # the last line was left half-written
+                ofile.write(line)
+
+    def replace(self, records):
+        """
+        Replaces every record, e.g. to migrate them. Like JsonStore, the file is replaced all at once.
+        """
+        with self._lock:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as ofile:
+                    for record in records:
+                        ofile.write(json.dumps(record) + "\n")
+                os.replace(temp_path, self.path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
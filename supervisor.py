@@ -0,0 +1,94 @@
+import threading
+import time
+
+from config import bot_config
+from config import getLogger
+
+
+logger = getLogger()
+
+CHECK_INTERVAL = bot_config.get_supervisor_setting('check_interval')
+RESTART_BACKOFF_INITIAL = bot_config.get_supervisor_setting('restart_backoff_initial')
+RESTART_BACKOFF_MAX = bot_config.get_supervisor_setting('restart_backoff_max')
+
+
+class Supervisor(threading.Thread):
+    """
+    A watchdog that keeps a Dispatch's bots running.
+    It periodically checks every bot, and replaces bots that have died (work() raised an exception)
+    or stalled (missed their heartbeat deadline). Restarts of the same bot are delayed with exponential backoff.
+    """
+    def __init__(self, bots, stop_event, check_interval=CHECK_INTERVAL,
+                 backoff_initial=RESTART_BACKOFF_INITIAL, backoff_max=RESTART_BACKOFF_MAX):
+        """
+        :param bots: The Dispatch's dictionary of bot lists. Replaced bots are swapped into these lists in place.
+        :param stop_event: A threading.Event that tells the Supervisor to stop.
+        :param check_interval: Number of seconds between health checks.
+        :param backoff_initial: Number of seconds to wait before the first restart of a bot.
+        :param backoff_max: The longest a bot will wait to be restarted.
+        """
+        super(Supervisor, self).__init__(daemon=True)
+        self.bots = bots
+        self.stop_event = stop_event
+        self.check_interval = check_interval
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.lock = threading.Lock()
+        self._failures = {}  # (key, index) -> number of restarts since the bot last completed a cycle
+        self._restart_times = {}  # (key, index) -> monotonic time when the bot may be restarted
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.check()
+            self.stop_event.wait(self.check_interval)
+
+    def check(self):
+        """
+        Checks the health of every bot once, and restarts the bots that are due to be restarted.
+        """
+        with self.lock:
+            for key, bot_list in self.bots.items():
+                for index, bot in enumerate(bot_list):
+                    slot = (key, index)
+                    if bot.cycles and slot in self._failures and slot not in self._restart_times:
+                        del self._failures[slot]
+                    if bot.has_died() or bot.is_stalled():
+                        self._handle_unhealthy(slot, bot_list, bot)
+
+    def forget(self, key):
+        """
+        Drops the restart history of a bot list that was removed from the Dispatch.
+        Must be called while holding self.lock.
+        """
+        for slot in [slot for slot in self._failures if slot[0] == key]:
+            del self._failures[slot]
+        for slot in [slot for slot in self._restart_times if slot[0] == key]:
+            del self._restart_times[slot]
+
+    def _handle_unhealthy(self, slot, bot_list, bot):
+        now = time.monotonic()
+        if slot not in self._restart_times:
+            failures = self._failures.get(slot, 0)
+            delay = min(self.backoff_initial * 2 ** failures, self.backoff_max)
+            self._restart_times[slot] = now + delay
+            reason = "died" if bot.has_died() else "stalled"
+            logger.warning("Bot %s, restarting in %s seconds: bot=[%s], lastError=[%r]",
+                           reason, delay, bot.name, bot.last_error)
+        elif now >= self._restart_times[slot]:
+            del self._restart_times[slot]
+            self._failures[slot] = self._failures.get(slot, 0) + 1
+            bot_list[slot[1]] = self.restart(bot)
+
+    @staticmethod
+    def restart(bot):
+        """
+        Replaces a bot with a fresh copy of itself. A stalled bot is told to stop,
+        and its thread is abandoned since it cannot be interrupted.
+        :param bot: The bot to replace.
+        :return: The new, running bot.
+        """
+        bot.stop_event.set()
+        new_bot = bot.respawn()
+        new_bot.start()
+        logger.info("Bot restarted: oldBot=[%s], newBot=[%s]", bot.name, new_bot.name)
+        return new_bot
@@ -0,0 +1,61 @@
+"""
+Stand-ins shared by the tests of the Dispatch and of the control socket.
+"""
+import importlib.util
+import os
+import threading
+import time
+
+from bots import Bot
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "__main__.py")
+
+
+def load_dispatch_module():
+    spec = importlib.util.spec_from_file_location("faubot_main", MAIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_praw_ini(path, accounts, tokens=None):
+    """
+    :param accounts: A dict mapping each username to its bot_class_name
+    :param tokens: A dict mapping usernames to refresh tokens. Other accounts get "token".
+    """
+    with open(path, "w") as f:
+        for username, classnames in accounts.items():
+            f.write("[{}]\nbot_class_name = {}\noauth_scope = identity\noauth_refresh_token = {}\n\n"
+                    .format(username, classnames, (tokens or {}).get(username, "token")))
+
+
+class ExampleBot1(Bot):
+    """
+    Stands in for a RedditBot whose work is a request that cannot be interrupted, so it only notices it was told to
+    stop when the work returns. It is named after a bot class in config/bot_config.yaml, so it has a configured
+    sleep interval.
+    """
+    work_seconds = 0
+    logged_in = threading.Event()  # clear it to keep the bots "logging in"
+
+    def __init__(self, user_name, *args, **kwargs):
+        super(ExampleBot1, self).__init__(*args, **kwargs)
+        self.USER_NAME = user_name
+
+    def run(self):
+        self.logged_in.wait()
+        super(ExampleBot1, self).run()
+
+    def work(self):
+        time.sleep(self.work_seconds)
+
+    def respawn(self):
+        return self.__class__(self.USER_NAME, clock=self.clock)
+
+
+class ExampleBot2(ExampleBot1):
+    pass
+
+
+ExampleBot1.logged_in.set()
+BOT_CLASSES = {'ExampleBot1': ExampleBot1, 'ExampleBot2': ExampleBot2}
@@ -0,0 +1,113 @@
+import configparser
+import importlib.util
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from urllib.parse import urlparse, parse_qs
+
+import praw
+import requests
+from config import praw_config
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts",
+                           "account_register.py")
+ACCOUNTS = [("first_bot", "identity submit"), ("second_bot", "identity read")]
+
+
+def load_account_register():
+    spec = importlib.util.spec_from_file_location("account_register", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class FakeRedditor(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class BatchRegisterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.account_register = load_account_register()
+        self.directory = tempfile.TemporaryDirectory()
+        self.praw_path = os.path.join(self.directory.name, "praw.ini")
+        self.redirect_uri = "http://127.0.0.1:{}/authorize_callback".format(get_free_port())
+        parser = configparser.ConfigParser()
+        for account, scope in ACCOUNTS:
+            parser[account] = {'oauth_client_id': "id", 'oauth_client_secret': "secret",
+                               'oauth_redirect_uri': self.redirect_uri, 'oauth_refresh_token': "",
+                               'oauth_scope': scope, 'bot_class_name': "TicketBot"}
+        with open(self.praw_path, "w") as f:
+            parser.write(f)
+
+        self.browser_users = [account for account, _ in ACCOUNTS]  # who is logged in when each tab is opened
+        self.users_by_code = {}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def authorize_in_browser(self, url):
+        """
+        Stands in for a person allowing access: the browser is redirected to the callback server.
+        """
+        state = parse_qs(urlparse(url).query)['state'][0]
+        code = "code-{}".format(state)
+        self.users_by_code[code] = self.browser_users.pop(0)
+        redirect = "{}?state={}&code={}".format(self.redirect_uri, state, code)
+        threading.Thread(target=requests.get, args=(redirect,), daemon=True).start()
+
+    def register_in_batch(self):
+        test = self
+
+        def get_access_information(reddit, code):
+            reddit.code = code
+            return {'refresh_token': "refresh-for-" + code, 'access_token': "access", 'scope': {'identity'}}
+
+        def get_me(reddit):
+            return FakeRedditor(test.users_by_code[reddit.code])
+
+        with patch.object(praw_config, 'PRAW_FILE_PATH', self.praw_path), \
+                patch.object(self.account_register, 'PRAW_FILE_PATH', self.praw_path), \
+                patch.object(praw.Reddit, 'get_access_information', get_access_information), \
+                patch.object(praw.Reddit, 'get_me', get_me), \
+                patch.object(self.account_register.webbrowser, 'open_new_tab', self.authorize_in_browser):
+            tokens = self.account_register.register_accounts_in_batch(ACCOUNTS, timeout=10)
+            saved = {account: praw_config.get_value(account, 'oauth_refresh_token') for account, _ in ACCOUNTS}
+        return tokens, saved
+
+    def test_batch_saves_every_refresh_token(self):
+        tokens, saved = self.register_in_batch()
+        self.assertEqual(sorted(tokens), ["first_bot", "second_bot"])
+        self.assertEqual(saved, tokens)
+        self.assertTrue(all(token.startswith("refresh-for-code-") for token in tokens.values()))
+
+    def test_token_allowed_by_another_account_is_not_saved(self):
+        self.browser_users = ["first_bot", "first_bot"]  # the browser stayed logged into the first account
+        tokens, saved = self.register_in_batch()
+        self.assertEqual(sorted(tokens), ["first_bot"])
+        self.assertEqual(saved, {'first_bot': tokens['first_bot'], 'second_bot': ""})
+
+    def test_callback_with_unknown_state_is_rejected(self):
+        received = []
+        server = self.account_register.OAuthCallbackServer(
+            self.redirect_uri, lambda state, code, error: received.append((state, code, error)) or state == "known")
+        server.start()
+        try:
+            bad = requests.get(self.redirect_uri + "?state=forged&code=abc")
+            good = requests.get(self.redirect_uri + "?state=known&error=access_denied")
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(bad.status_code, 400)
+        self.assertEqual(good.status_code, 200)
+        self.assertEqual(received, [("forged", "abc", None), ("known", None, "access_denied")])
@@ -0,0 +1,66 @@
+import threading
+import time
+import unittest
+
+import bots
+from ratelimit import RateLimiter
+
+SUBREDDITS = ["first", "second", "third", "fourth"]
+
+
+class SingleThreadedReddit(object):
+    """
+    Stands in for a praw.Reddit instance, which breaks when two threads use it at once: praw toggles a flag on the
+    instance around every OAuth request and asserts that it was not already set.
+    """
+    def __init__(self):
+        self._in_use = threading.Lock()
+        self.messages = []
+
+    def send_message(self, recipient, subject, text):
+        if not self._in_use.acquire(blocking=False):
+            raise AssertionError("praw.Reddit instance used by two threads at once")
+        try:
+            time.sleep(0.05)
+            if recipient == "broken":
+                raise ValueError("broken")
+            self.messages.append(recipient)
+        finally:
+            self._in_use.release()
+
+
+class ForEachSubredditTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = bots.ExampleBot1("subreddit_test_bot")
+        self.bot.r = SingleThreadedReddit()
+        self.bot.rate_limiter = RateLimiter(rate=1e9)
+
+    def send(self, subreddit):
+        self.bot.r.send_message(subreddit, "subject", "text")
+        return subreddit.upper()
+
+    def test_subreddits_are_handled_one_after_another(self):
+        results = self.bot.for_each_subreddit(self.send, SUBREDDITS)
+        self.assertEqual(self.bot.r.messages, SUBREDDITS)
+        self.assertEqual([results[subreddit].result for subreddit in SUBREDDITS],
+                         [subreddit.upper() for subreddit in SUBREDDITS])
+        self.assertFalse(any(result.error for result in results.values()))
+
+    def test_errors_do_not_affect_other_subreddits(self):
+        results = self.bot.for_each_subreddit(self.send, ["first", "broken", "second"])
+        self.assertIsInstance(results["broken"].error, ValueError)
+        self.assertEqual(self.bot.r.messages, ["first", "second"])
+
+    def test_operations_are_rate_limited(self):
+        self.bot.rate_limiter = RateLimiter(rate=20, burst=1)
+        started = time.monotonic()
+        self.bot.for_each_subreddit(lambda subreddit: None, SUBREDDITS)
+        self.assertGreaterEqual(time.monotonic() - started, 0.9 * (len(SUBREDDITS) - 1) / 20)
+
+    def test_stopping_skips_the_remaining_subreddits(self):
+        def send_and_stop(subreddit):
+            self.bot.stop_event.set()
+            return self.send(subreddit)
+
+        self.assertEqual(list(self.bot.for_each_subreddit(send_and_stop, SUBREDDITS)), ["first"])
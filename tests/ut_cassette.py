@@ -0,0 +1,108 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import requests
+import cassette
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves a page whose content changes on every request, and a token endpoint.
+    """
+    hits = 0
+
+    def do_GET(self):
+        StandInHandler.hits += 1
+        body = "<html><body>hit {} of {}</body></html>".format(StandInHandler.hits, self.path).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('ETag', '"{}"'.format(StandInHandler.hits))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'access_token': "secret-access", 'scope': "identity"}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CassetteTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cassette.jsonl.gz")
+        self.recorded_at = time.time()
+        with cassette.recording(self.path):
+            self.first = requests.get(self.url + "/page?date=2016-10-01")
+            self.streamed = b"".join(requests.get(self.url + "/feed/", stream=True).iter_content(8))
+            requests.post(self.url + "/api/v1/access_token", data={'grant_type': "refresh_token",
+                                                                   'refresh_token': "secret-refresh"})
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_replay_returns_recorded_responses(self):
+        with cassette.replaying(self.path) as player:
+            r = requests.get(self.url + "/page?date=2016-10-01")
+            streamed = b"".join(requests.get(self.url + "/feed/", stream=True).iter_content(8))
+            self.assertEqual(player.remaining(), 1)
+        self.assertEqual(r.text, self.first.text)
+        self.assertEqual(r.headers['ETag'], self.first.headers['ETag'])
+        self.assertEqual(streamed, self.streamed)
+
+    def test_replay_matches_path_when_query_differs(self):
+        with cassette.replaying(self.path):
+            self.assertEqual(requests.get(self.url + "/page?date=2016-11-01").text, self.first.text)
+
+    def test_unrecorded_request_raises(self):
+        with cassette.replaying(self.path):
+            requests.get(self.url + "/page")
+            with self.assertRaises(cassette.CassetteMiss):
+                requests.get(self.url + "/page")
+
+    def test_secrets_are_redacted(self):
+        with cassette.replaying(self.path) as player:
+            token = requests.post(self.url + "/api/v1/access_token", data={'grant_type': "refresh_token",
+                                                                           'refresh_token': "other-refresh"}).json()
+            recorded = player.interactions[2]
+        self.assertEqual(token, {'access_token': cassette.REDACTED, 'scope': "identity"})
+        self.assertNotIn("secret-refresh", recorded['body'])
+
+    def test_realtime_replay_waits_for_recorded_latency(self):
+        with cassette.replaying(self.path, realtime=True) as player:
+            player.interactions[0]['elapsed'] = 0.2
+            started = time.monotonic()
+            requests.get(self.url + "/page?date=2016-10-01")
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+
+    def test_start_time_is_recorded(self):
+        with cassette.recording(self.path):  # appending keeps the first start time
+            requests.get(self.url + "/page")
+        with cassette.replaying(self.path) as player:
+            self.assertEqual(len(player.interactions), 4)
+            self.assertAlmostEqual(player.started_at, self.recorded_at, delta=5)
+            self.assertEqual(player.get_recorded_time(), player.started_at)
+            requests.get(self.url + "/feed/")
+            self.assertEqual(player.get_recorded_time(), player.started_at + player.interactions[1]['offset'])
@@ -0,0 +1,124 @@
+import calendar
+import datetime
+import json
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import store
+from bots import Bot
+from clock import VirtualClock
+from eventbot import EventBot
+from newsbot import NewsBot
+
+START = calendar.timegm(datetime.datetime(2016, 10, 1, 16, 0).utctimetuple())  # noon in Boca Raton
+DAY = 24 * 60 * 60
+
+
+class ExampleBot1(Bot):
+    """
+    Records the clock's time whenever it works, and stops itself once the clock reaches a deadline.
+    It is named after a bot class in config/bot_config.yaml, so it has a configured sleep interval.
+    """
+    def __init__(self, interval, until, *args, **kwargs):
+        super(ExampleBot1, self).__init__(reset_sleep_interval=False, *args, **kwargs)
+        self.sleep_interval = interval
+        self.until = until
+        self.times = []
+
+    def work(self):
+        self.times.append(self.clock.time())
+        if self.clock.time() >= self.until:
+            self.stop_event.set()
+
+
+class VirtualClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(start=START)
+
+    def test_wait_ends_instantly(self):
+        started = time.monotonic()
+        self.assertFalse(self.clock.wait(threading.Event(), 7 * DAY))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.clock.time(), START + 7 * DAY)
+        self.assertEqual(self.clock.utcnow(), datetime.datetime(2016, 10, 8, 16, 0))
+
+    def test_set_event_ends_wait(self):
+        event = threading.Event()
+        event.set()
+        self.assertTrue(self.clock.wait(event, DAY))
+        self.assertEqual(self.clock.time(), START + DAY)
+
+    def test_four_weeks_of_hourly_work_finish_quickly(self):
+        bot = ExampleBot1(60 * 60, until=START + 28 * DAY, clock=self.clock)
+        started = time.monotonic()
+        bot.start()
+        self.assertTrue(bot.stop_event.wait(timeout=30))
+        bot.join()
+        self.assertLess(time.monotonic() - started, 30)
+        self.assertEqual(bot.times, [START + hour * 60 * 60 for hour in range(28 * 24 + 1)])
+
+    def test_bots_sleep_on_a_shared_timeline(self):
+        bots = [ExampleBot1(interval, until=START + DAY, clock=self.clock) for interval in (60 * 60, 90 * 60)]
+        self.clock.register()  # like Dispatch, the clock is held until every bot has started
+        for bot in bots:
+            bot.start()
+        self.clock.unregister()
+        for bot in bots:
+            self.assertTrue(bot.stop_event.wait(timeout=30))
+            bot.join()
+        hourly, ninety_minutes = bots
+        self.assertEqual(hourly.times, [START + n * 60 * 60 for n in range(25)])
+        self.assertEqual(ninety_minutes.times, [START + n * 90 * 60 for n in range(17)])
+
+    def test_simulation_can_be_stepped(self):
+        bots = [ExampleBot1(60 * 60, until=START + DAY, clock=self.clock) for _ in range(3)]
+        self.clock.register()
+        try:
+            for bot in bots:
+                bot.start()
+            for hour in range(1, 6):
+                self.clock.wait_until_idle()
+                self.assertEqual([len(bot.times) for bot in bots], [hour] * 3)
+                self.assertEqual(self.clock.time(), START + (hour - 1) * 60 * 60)
+                self.clock.wait(threading.Event(), 60 * 60)
+        finally:
+            self.clock.unregister()
+        for bot in bots:
+            bot.join(5)
+
+
+class ClockInjectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(start=START)
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_newsbot_submission_interval(self):
+        with patch.object(store, 'DATA_DIRECTORY', self.directory.name):
+            bot = NewsBot("clock_test_bot", clock=self.clock)
+        bot._last_created = self.clock.utcnow()
+        self.assertEqual(bot.get_next_submission_time(), START + DAY)
+        self.clock.advance(DAY - 60)
+        self.assertFalse(bot.is_time_to_submit())
+        self.clock.advance(60)
+        self.assertTrue(bot.is_time_to_submit())
+        self.assertEqual(bot.respawn().clock, self.clock)
+
+    def test_eventbot_uses_clock(self):
+        with patch.object(store, 'DATA_DIRECTORY', self.directory.name):
+            bot = EventBot("clock_test_bot", clock=self.clock)
+        event_json = json.dumps({'title': "Homecoming", 'permalink': "http://www.upressonline.com/event/homecoming/",
+                                 'dateDisplay': "October 1 @ 7:00 pm - 10:00 pm", 'excerpt': "<p>Game</p>"})
+        self.assertFalse(EventBot.has_event_passed(event_json, self.clock))
+        self.assertEqual(bot._get_current_post_title(), "October Event Calendar")
+        self.clock.advance(8 * 60 * 60)
+        self.assertTrue(EventBot.has_event_passed(event_json, self.clock))
+        self.clock.advance(31 * DAY)
+        self.assertEqual(bot._get_current_post_title(), "November Event Calendar")
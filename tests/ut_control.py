@@ -0,0 +1,130 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import control
+import tokencache
+from config import praw_config
+from dispatch_fixtures import BOT_CLASSES, load_dispatch_module, write_praw_ini
+from tokencache import AccessTokenCache
+
+class ControlTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.main = load_dispatch_module()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.socket_path = os.path.join(self.directory.name, "control.sock")
+        praw_path = os.path.join(self.directory.name, "praw.ini")
+        write_praw_ini(praw_path, {'first': "ExampleBot1,ExampleBot2", 'second': "ExampleBot1"})
+        patches = [patch.object(praw_config, 'PRAW_FILE_PATH', praw_path),
+                   patch.object(self.main, 'BOT_CLASSES', BOT_CLASSES)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.praw_path = praw_path
+        self.token_cache = AccessTokenCache(directory=self.directory.name)
+        token_patch = patch.object(tokencache, '_cache', self.token_cache)
+        token_patch.start()
+        self.addCleanup(token_patch.stop)
+        self.dispatch = self.main.GlobalDispatch()
+        self.dispatch.start()
+        self.addCleanup(self.dispatch.join)
+        self.assertTrue(self.dispatch.ready.wait(10))  # the bots are started by the Dispatch's thread
+        server = control.serving(self.dispatch, self.socket_path, stop_timeout=10)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+
+    def send(self, command, account=None, bot=None):
+        return control.send_command(command, account, bot, path=self.socket_path, timeout=30)
+
+    def get_bots(self):
+        return {(bot.USER_NAME, bot.__class__.__name__): bot for bots in self.dispatch.bots.values() for bot in bots}
+
+    def test_list(self):
+        status = self.send('list')
+        self.assertEqual([(bot['account'], bot['bot']) for bot in status],
+                         [('first', 'ExampleBot1'), ('first', 'ExampleBot2'), ('second', 'ExampleBot1')])
+        self.assertTrue(all(bot['alive'] and not bot['stalled'] for bot in status))
+
+    def test_stop_and_start_one_bot(self):
+        others = self.get_bots()
+        self.assertEqual(self.send('stop', 'first', 'ExampleBot2'), ['ExampleBot1'])
+        stopped = others.pop(('first', 'ExampleBot2'))
+        self.assertFalse(stopped.is_alive())
+        self.assertEqual(self.get_bots(), others)
+        self.assertEqual(self.send('start', 'first', 'ExampleBot2'), ['ExampleBot1', 'ExampleBot2'])
+        self.assertTrue(self.get_bots()[('first', 'ExampleBot2')].is_alive())
+        self.assertEqual(self.get_bots()[('second', 'ExampleBot1')], others[('second', 'ExampleBot1')])
+
+    def test_restart_one_bot(self):
+        old = self.get_bots()
+        self.assertEqual(self.send('restart', 'first', 'ExampleBot1'), ['ExampleBot1', 'ExampleBot2'])
+        new = self.get_bots()
+        self.assertIsNot(new[('first', 'ExampleBot1')], old[('first', 'ExampleBot1')])
+        self.assertFalse(old[('first', 'ExampleBot1')].is_alive())
+        self.assertTrue(new[('first', 'ExampleBot1')].is_alive())
+        self.assertIs(new[('first', 'ExampleBot2')], old[('first', 'ExampleBot2')])
+
+    def test_stop_whole_account(self):
+        self.assertEqual(self.send('stop', 'second'), [])
+        self.assertNotIn('second', self.dispatch.bots)
+        with self.assertRaises(control.ControlError):
+            self.send('stop', 'second')
+
+    def test_errors_are_returned(self):
+        with self.assertRaises(control.ControlError):
+            self.send('start', 'first', 'ExampleBot1')
+        with self.assertRaises(control.ControlError):
+            self.send('start', 'first', 'NoSuchBot')
+        with self.assertRaises(control.ControlError):
+            self.send('restart')
+        with self.assertRaises(control.ControlError):
+            self.send('explode', 'first')
+        self.assertEqual(len(self.send('list')), 3)
+
+    def test_reload_changes_only_changed_accounts(self):
+        old = self.get_bots()
+        write_praw_ini(self.praw_path, {'first': "ExampleBot1", 'second': "ExampleBot1", 'third': "ExampleBot2"})
+        self.assertEqual(self.send('reload'), {'first': "added [], removed ['ExampleBot2']", 'third': "started"})
+        new = self.get_bots()
+        self.assertEqual(sorted(new), [('first', 'ExampleBot1'), ('second', 'ExampleBot1'), ('third', 'ExampleBot2')])
+        self.assertIs(new[('first', 'ExampleBot1')], old[('first', 'ExampleBot1')])
+        self.assertIs(new[('second', 'ExampleBot1')], old[('second', 'ExampleBot1')])
+        self.assertEqual(self.send('reload'), {})
+
+        write_praw_ini(self.praw_path, {'first': "ExampleBot1", 'second': "ExampleBot1"},
+                            tokens={'second': "new token"})
+        self.assertEqual(self.send('reload'), {'second': "restarted", 'third': "stopped"})
+        self.assertIs(self.get_bots()[('first', 'ExampleBot1')], old[('first', 'ExampleBot1')])
+        self.assertIsNot(self.get_bots()[('second', 'ExampleBot1')], old[('second', 'ExampleBot1')])
+
+    def cache_access_token(self, username):
+        self.token_cache.put(username, {'scope': {'identity'}, 'access_token': "access", 'refresh_token': "token"})
+
+    def test_restarted_account_does_not_use_its_cached_token(self):
+        self.cache_access_token('first')
+        self.cache_access_token('second')
+        with open(self.praw_path, "a") as f:
+            f.write("user_agent = new agent\n")  # a change that keeps the refresh token
+        self.assertEqual(self.send('reload'), {'second': "restarted"})
+        self.assertIsNone(self.token_cache.get('second', "token"))
+        self.assertIsNotNone(self.token_cache.get('first', "token"))
+
+    def test_started_account_does_not_use_its_cached_token(self):
+        self.send('stop', 'second')
+        self.cache_access_token('second')
+        self.assertEqual(self.send('start', 'second'), ['ExampleBot1'])
+        self.assertIsNone(self.token_cache.get('second', "token"))
+
+    def test_socket_is_private(self):
+        self.assertEqual(os.stat(self.socket_path).st_mode & 0o777, 0o600)
+        old_umask = os.umask(0o022)
+        os.umask(old_umask)
+        self.assertNotEqual(old_umask, 0o177)  # the umask is put back after the socket is created
+        with self.assertRaises(control.ControlError):
+            control.ControlServer(self.dispatch, self.socket_path)
@@ -0,0 +1,190 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import requests
+
+import bots
+import tokencache
+from bots import BotStopped, interruptible_requests, stopped_by
+from config import praw_config
+from leases import MemoryLeaseBackend
+from outbox import Outbox, OutboxSender
+from ratelimit import RateLimiter
+from tokencache import AccessTokenCache, TokenRefresher
+from dispatch_fixtures import BOT_CLASSES, ExampleBot1, ExampleBot2, load_dispatch_module, write_praw_ini
+
+class DispatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.main = load_dispatch_module()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        praw_path = os.path.join(self.directory.name, "praw.ini")
+        write_praw_ini(praw_path, {'first': "ExampleBot1,ExampleBot2", 'second': "ExampleBot1"})
+        patches = [patch.object(praw_config, 'PRAW_FILE_PATH', praw_path),
+                   patch.object(self.main, 'BOT_CLASSES', BOT_CLASSES),
+                   patch.object(ExampleBot1, 'work_seconds', 1)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.dispatch = self.main.GlobalDispatch()
+        self.addCleanup(self.dispatch.join, 0)
+
+    def test_bots_stop_together(self):
+        self.dispatch.start()
+        self.assertTrue(self.dispatch.ready.wait(10))
+        time.sleep(0.1)  # let every bot start its work
+        started = time.monotonic()
+        self.dispatch.join(10)
+        self.assertLess(time.monotonic() - started, 2)  # one work cycle, not one per bot
+        self.assertFalse(self.dispatch.is_alive())
+        self.assertEqual(self.dispatch.drain_status['stopped'], 3)
+        self.assertEqual(self.dispatch.drain_status['running'], [])
+
+    def test_join_has_one_deadline(self):
+        with patch.object(ExampleBot1, 'work_seconds', 3):
+            self.dispatch.start()
+            self.assertTrue(self.dispatch.ready.wait(10))
+            time.sleep(0.1)  # let every bot start its work
+            started = time.monotonic()
+            self.dispatch.join(0.5)
+        self.assertLess(time.monotonic() - started, 1.5)
+        self.assertEqual(self.dispatch.drain_status['stopped'], 0)
+        self.assertEqual(len(self.dispatch.drain_status['running']), 3)
+
+    def test_bot_that_does_not_stop_is_not_restarted(self):
+        errors = []
+
+        def restart():
+            try:
+                self.dispatch.restart_bots('first', timeout=1)
+            except ValueError as e:
+                errors.append(e)
+
+        with patch.object(ExampleBot1, 'work_seconds', 3), patch.object(ExampleBot2, 'work_seconds', 0):
+            self.dispatch.start()
+            self.assertTrue(self.dispatch.ready.wait(10))
+            time.sleep(0.1)  # let every bot start its work
+            old = list(self.dispatch.bots['first'])
+            restarting = threading.Thread(target=restart)
+            restarting.start()
+            time.sleep(0.2)
+            # the supervisor can still check the other accounts while the bots stop
+            self.assertTrue(self.dispatch.supervisor.lock.acquire(timeout=0.5))
+            self.dispatch.supervisor.lock.release()
+            restarting.join(10)
+        new = self.dispatch.bots['first']
+        self.assertIs(new[0], old[0])
+        self.assertIsNot(new[1], old[1])
+        self.assertTrue(new[1].is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertIn(old[0].name, str(errors[0]))
+
+    def test_readiness(self):
+        ExampleBot1.logged_in.clear()
+        self.addCleanup(ExampleBot1.logged_in.set)
+        self.dispatch.start()
+        time.sleep(0.2)
+        self.assertEqual(len(self.dispatch.get_readiness()['starting']), 3)
+        self.assertFalse(self.dispatch.ready.is_set())
+        self.assertFalse(any(bot['ready'] for bot in self.dispatch.get_status()))
+        ExampleBot1.logged_in.set()
+        self.assertTrue(self.dispatch.ready.wait(10))
+        readiness = self.dispatch.get_readiness()
+        self.assertEqual(len(readiness['ready']), 3)
+        self.assertEqual(readiness['starting'] + readiness['failed'], [])
+
+
+class ShardedDispatchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.main = load_dispatch_module()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        praw_path = os.path.join(self.directory.name, "praw.ini")
+        write_praw_ini(praw_path, {'first': "ExampleBot1", 'second': "ExampleBot2"})
+        self.refresher = TokenRefresher(AccessTokenCache(directory=self.directory.name))  # never started
+        patches = [patch.object(praw_config, 'PRAW_FILE_PATH', praw_path),
+                   patch.object(self.main, 'BOT_CLASSES', BOT_CLASSES),
+                   patch.object(tokencache, '_refresher', self.refresher)]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.backend = MemoryLeaseBackend()
+        self.dispatch = self.main.ShardedDispatch(backend=self.backend, node_id="node0")
+        self.addCleanup(self.dispatch.join, 5)
+
+    def start_services(self, username):
+        """
+        Does what a RedditBot does when it logs in: starts the account's outbox sender, and has its token refreshed.
+        """
+        outbox = Outbox(os.path.join(self.directory.name, "outbox.db"))
+        self.addCleanup(OutboxSender.stop_for_account, username, 5)
+        self.refresher.register(username, object)
+        return OutboxSender.start_for_account(outbox, username, object, RateLimiter(rate=1e9))
+
+    def test_handed_over_account_is_not_served_by_the_old_node(self):
+        self.dispatch.coordinator.tick()
+        self.assertEqual(sorted(self.dispatch.bots), ['first', 'second'])
+        sender = self.start_services('first')
+        self.assertTrue(sender.is_alive())
+
+        self.backend.heartbeat("node1", self.dispatch.coordinator.ttl)  # both accounts belong to node1
+        self.dispatch.coordinator.tick()
+        self.assertEqual(self.dispatch.bots, {})
+        self.assertFalse(sender.is_alive())
+        self.assertNotIn('first', OutboxSender._senders)
+        self.assertNotIn('first', self.refresher._connectors)
+
+    def test_only_accounts_with_a_lease_can_be_started(self):
+        self.backend.acquire('first', "node1", self.dispatch.coordinator.ttl)  # first runs on another node
+        self.dispatch.coordinator.tick()
+        self.assertEqual(list(self.dispatch.bots), ['second'])
+        with self.assertRaises(ValueError):
+            self.dispatch.start_account('first')
+        with self.assertRaises(ValueError):
+            self.dispatch.start_bot('first', 'ExampleBot1')
+        self.assertEqual(list(self.dispatch.bots), ['second'])
+        self.dispatch.start_bot('second', 'ExampleBot1')
+        self.assertEqual(self.dispatch.get_class_names('second'), ['ExampleBot2', 'ExampleBot1'])
+
+
+class StoppedByTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sent = []
+        self.send = lambda session, request, **kwargs: self.sent.append(kwargs)
+        send_patch = patch.object(requests.Session, 'send', self.send)
+        send_patch.start()
+        self.addCleanup(send_patch.stop)
+
+    def test_requests_fail_once_stopped(self):
+        stop_event = threading.Event()
+        with interruptible_requests():
+            with stopped_by(stop_event):
+                requests.get("http://127.0.0.1:9/")
+                stop_event.set()
+                with self.assertRaises(BotStopped):
+                    requests.get("http://127.0.0.1:9/")
+            requests.get("http://127.0.0.1:9/")  # outside of the bot, nothing is stopped or changed
+        self.assertEqual([kwargs['timeout'] for kwargs in self.sent], [bots.HTTP_TIMEOUT, None])
+
+    def test_requests_are_unchanged_outside_of_the_context(self):
+        stop_event = threading.Event()
+        stop_event.set()
+        with interruptible_requests():
+            pass
+        self.assertIs(requests.Session.send, self.send)
+        with stopped_by(stop_event):
+            requests.get("http://127.0.0.1:9/")
+        self.assertEqual([kwargs['timeout'] for kwargs in self.sent], [None])
@@ -0,0 +1,132 @@
+import calendar
+import datetime
+import json
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import eventbot
+import outbox
+import store
+from clock import VirtualClock
+from eventbot import EventBot
+from eventsapi import EventsApiClient
+
+TABLE = eventbot.TABLE_HEADER + eventbot.TABLE_ROW.format(title="Homecoming", date="October 5", description="Game")
+NEW_TABLE = TABLE + eventbot.TABLE_ROW.format(title="Career Fair", date="October 9", description="Jobs")
+
+
+class FakePost(object):
+    def __init__(self, post_id, selftext, author="event_test_bot"):
+        self.id = post_id
+        self.selftext = selftext
+        self.author = author
+
+
+class FakeReddit(object):
+    def __init__(self):
+        self.posts = {}
+        self.fetched = []
+
+    def get_submission(self, submission_id=None):
+        self.fetched.append(submission_id)
+        return self.posts[submission_id]
+
+    def search(self, query, subreddit=None):
+        return iter([])
+
+
+class EventBotTablePostTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = patch.object(store, 'DATA_DIRECTORY', self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot = EventBot("event_test_bot")
+        self.bot.r = FakeReddit()
+        self.bot.outbox = outbox.Outbox()
+        self.bot.r.posts["abc"] = FakePost("abc", TABLE)
+        self.bot._remember_table_post("first", TABLE, post_id="abc")
+
+    def claim_writes(self, kind):
+        """
+        Claims the writes the bot queued, as the outbox sender would.
+        :return: The claimed writes of the given kind, with their payloads
+        """
+        return [(write, json.loads(write['payload'])) for write in self.bot.outbox.claim_due_writes("event_test_bot")
+                if write['kind'] == kind]
+
+    def claim_edits(self):
+        return [(payload['post_id'], payload['text']) for _, payload in self.claim_writes(outbox.EDIT)]
+
+    def test_unchanged_table_is_not_fetched(self):
+        self.bot.cycles = 1
+        self.bot.update_table_post(TABLE, False, "first")
+        self.assertEqual(self.bot.r.fetched, [])
+        self.assertEqual(self.claim_edits(), [])
+
+    def test_post_edited_outside_the_bot_is_repaired(self):
+        self.bot.r.posts["abc"].selftext = "Edited by a moderator"
+        self.bot.cycles = 1
+        self.bot.update_table_post(TABLE, False, "first")
+        self.assertEqual(self.claim_edits(), [])
+        self.bot.cycles = eventbot.TABLE_POST_CHECK_CYCLES
+        self.bot.update_table_post(TABLE, False, "first")
+        self.assertEqual(self.bot.r.fetched, ["abc"])
+        self.assertEqual(self.claim_edits(), [("abc", TABLE)])
+
+    def test_deleted_post_is_submitted_again(self):
+        self.bot.r.posts["abc"].author = None
+        self.bot.cycles = 0
+        self.bot.update_table_post(TABLE, False, "first")
+        self.assertEqual([payload['subreddit'] for _, payload in self.claim_writes(outbox.SUBMIT)], ["first"])
+
+    def test_sent_edit_is_trusted(self):
+        self.bot.cycles = 1
+        self.bot.update_table_post(NEW_TABLE, False, "first")
+        (write, _), = self.claim_writes(outbox.EDIT)
+        self.bot.update_table_post(NEW_TABLE, False, "first")  # the edit is being sent
+        self.bot.outbox.mark_sent(write['id'], "abc")
+        self.bot.update_table_post(NEW_TABLE, False, "first")
+        self.assertEqual(self.bot.r.fetched, ["abc"])  # only read once, before the edit was queued
+        self.assertEqual(self.claim_edits(), [])
+
+    def test_edit_that_was_given_up_on_is_queued_again(self):
+        self.bot.cycles = 1
+        self.bot.update_table_post(NEW_TABLE, False, "first")
+        (write, _), = self.claim_writes(outbox.EDIT)
+        with patch.object(outbox, 'MAX_ATTEMPTS', 1):
+            self.bot.outbox.mark_failed(write['id'], ValueError("broken"))
+        self.assertEqual(self.bot.outbox.get_write(write['id'])['status'], outbox.DEAD)
+        self.bot.update_table_post(NEW_TABLE, False, "first")
+        self.assertEqual(self.bot.r.fetched, ["abc", "abc"])
+        self.assertEqual(self.claim_edits(), [("abc", NEW_TABLE)])
+
+
+def make_api_event(start):
+    end = start + datetime.timedelta(hours=2)
+    return json.dumps(EventsApiClient.to_tribe_json({'title': "Event", 'url': "http://example.com/event/",
+                                                     'start_date': str(start), 'end_date': str(end)}))
+
+
+class HasEventPassedTest(unittest.TestCase):
+
+    def setUp(self):
+        # noon in Boca Raton on December 20th, with a 31 day lookahead reaching into the next year
+        self.clock = VirtualClock(start=calendar.timegm(datetime.datetime(2016, 12, 20, 17, 0).utctimetuple()))
+
+    def test_events_in_the_next_year_have_not_passed(self):
+        self.assertFalse(EventBot.has_event_passed(make_api_event(datetime.datetime(2017, 1, 5, 19, 0)), self.clock))
+        self.assertFalse(EventBot.has_event_passed(make_api_event(datetime.datetime(2016, 12, 20, 13, 0)),
+                                                   self.clock))
+
+    def test_past_events_have_passed(self):
+        self.assertTrue(EventBot.has_event_passed(make_api_event(datetime.datetime(2016, 12, 20, 11, 0)), self.clock))
+        self.assertTrue(EventBot.has_event_passed(make_api_event(datetime.datetime(2015, 12, 25, 19, 0)), self.clock))
+
+    def test_scraped_events_use_the_displayed_date(self):
+        event_json = json.dumps({'title': "Event", 'permalink': "http://example.com/event/",
+                                 'dateDisplay': "December 21 @ 7:00 pm - 9:00 pm", 'excerpt': "<p>Event</p>"})
+        self.assertFalse(EventBot.has_event_passed(event_json, self.clock))
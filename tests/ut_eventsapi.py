@@ -0,0 +1,88 @@
+import json
+import threading
+import unittest
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from eventsapi import EventsApiClient
+
+
+TOTAL_PAGES = 3
+PER_PAGE = 2
+
+
+def make_event(number):
+    return {'id': number,
+            'title': "Event {}".format(number),
+            'url': "http://example.com/event/{}/".format(number),
+            'excerpt': "<p>Excerpt {}</p>\n".format(number),
+            'start_date': "2016-10-{:02} 19:00:00".format(number),
+            'end_date': "2016-10-{:02} 21:30:00".format(number),
+            'all_day': False}
+
+
+class StandInEventsHandler(BaseHTTPRequestHandler):
+    """
+    Serves a paged events listing shaped like the tribe events JSON API.
+    """
+    requests_seen = []
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        StandInEventsHandler.requests_seen.append(query)
+        page = int(query['page'][0])
+        first = (page - 1) * PER_PAGE + 1
+        body = json.dumps({'events': [make_event(n) for n in range(first, first + PER_PAGE)],
+                           'total': TOTAL_PAGES * PER_PAGE,
+                           'total_pages': TOTAL_PAGES}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EventsApiClientTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StandInEventsHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}/wp-json/tribe/events/v1/events".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        StandInEventsHandler.requests_seen = []
+
+    def test_get_events_reads_every_page(self):
+        client = EventsApiClient(self.url, per_page=PER_PAGE)
+        events = [json.loads(event) for event in client.get_events(datetime(2016, 10, 1), datetime(2016, 10, 31))]
+        self.assertEqual([event['title'] for event in events], ["Event {}".format(n) for n in range(1, 7)])
+        self.assertEqual(sorted(int(query['page'][0]) for query in StandInEventsHandler.requests_seen), [1, 2, 3])
+
+    def test_get_events_sends_date_range(self):
+        client = EventsApiClient(self.url, per_page=PER_PAGE)
+        client.get_events(datetime(2016, 10, 1), datetime(2016, 10, 31))
+        query = StandInEventsHandler.requests_seen[0]
+        self.assertEqual(query['start_date'], ["2016-10-01 00:00:00"])
+        self.assertEqual(query['end_date'], ["2016-10-31 00:00:00"])
+
+    def test_to_tribe_json(self):
+        event = EventsApiClient.to_tribe_json(make_event(5))
+        self.assertEqual(event, {'title': "Event 5",
+                                 'permalink': "http://example.com/event/5/",
+                                 'dateDisplay': "October 5 @ 7:00 pm - 9:30 pm",
+                                 'startDate': "2016-10-05 19:00:00",
+                                 'excerpt': "<p>Excerpt 5</p>"})
+
+    def test_format_date_display(self):
+        start, end = datetime(2016, 10, 5, 0, 15), datetime(2016, 10, 6, 12, 0)
+        self.assertEqual(EventsApiClient.format_date_display(start, end),
+                         "October 5 @ 12:15 am - October 6 @ 12:00 pm")
+        self.assertEqual(EventsApiClient.format_date_display(start, end, all_day=True), "October 5")
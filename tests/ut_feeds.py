@@ -0,0 +1,115 @@
+import tempfile
+import threading
+import unittest
+from email.utils import format_datetime
+from datetime import datetime, timezone
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch
+
+import store
+from feeds import FeedReader
+from newsbot import NewsBot
+
+PUBLISHED_AT = datetime(2016, 10, 5, 12, 0, tzinfo=timezone.utc)
+PUBLISHED = format_datetime(PUBLISHED_AT)
+
+
+def make_item(number):
+    url = "http://www.upressonline.com/2016/10/article{}/".format(number)
+    return "<item><title>Article {}</title><link>{}</link><guid>{}</guid><pubDate>{}</pubDate></item>" \
+        .format(number, url, url, PUBLISHED)
+
+
+class StandInFeedHandler(BaseHTTPRequestHandler):
+    """
+    Serves an RSS feed with the newest item first, and answers 304 Not Modified when the client has the current ETag.
+    """
+    items = []
+    etag = '"1"'
+    requests_seen = []
+
+    def do_GET(self):
+        StandInFeedHandler.requests_seen.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = "<?xml version='1.0'?><rss><channel>{}</channel></rss>".format(
+            "".join(make_item(number) for number in reversed(self.items))).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('ETag', self.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInFeedTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StandInFeedHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}/feed/".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = patch.object(store, 'DATA_DIRECTORY', self.directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        StandInFeedHandler.items = [1, 2, 3]
+        StandInFeedHandler.etag = '"1"'
+        StandInFeedHandler.requests_seen = []
+        self.reader = FeedReader(self.url, "feed_test")
+
+
+class FeedReaderTest(StandInFeedTest):
+
+    def fetch_numbers(self):
+        return [int(entry.title.split()[-1]) for entry in self.reader.fetch_new_entries()]
+
+    def test_unmodified_feed_returns_nothing(self):
+        self.assertEqual(self.fetch_numbers(), [3, 2, 1])
+        self.assertEqual(self.fetch_numbers(), [])
+        self.assertNotIn('If-None-Match', StandInFeedHandler.requests_seen[0])
+        self.assertEqual(StandInFeedHandler.requests_seen[1]['If-None-Match'], '"1"')
+
+    def test_changed_feed_returns_only_new_entries(self):
+        self.fetch_numbers()
+        StandInFeedHandler.items = [1, 2, 3, 4, 5]
+        StandInFeedHandler.etag = '"2"'
+        self.assertEqual(self.fetch_numbers(), [5, 4])
+        self.assertEqual(self.reader.state.get('etag'), '"2"')
+        self.assertEqual(self.fetch_numbers(), [])
+
+    def test_every_entry_is_new_when_the_last_seen_entry_is_gone(self):
+        self.fetch_numbers()
+        StandInFeedHandler.items = [4, 5, 6]
+        StandInFeedHandler.etag = '"2"'
+        self.assertEqual(self.fetch_numbers(), [6, 5, 4])
+
+    def test_state_is_saved(self):
+        self.fetch_numbers()
+        self.assertEqual(FeedReader(self.url, "feed_test").fetch_new_entries(), [])
+
+
+class NewsBotFeedTest(StandInFeedTest):
+
+    def test_articles_are_collected_once(self):
+        bot = NewsBot("feed_test_bot")
+        bot.feed = self.reader
+        date = PUBLISHED_AT.astimezone().date()
+        self.assertEqual(len(bot.get_articles_from_feed(date)), 3)
+        StandInFeedHandler.items = [1, 2, 4]  # the last entry that was read was taken down
+        StandInFeedHandler.etag = '"2"'
+        articles = bot.get_articles_from_feed(date)
+        self.assertEqual([article.title for article in articles], ["Article 1", "Article 2", "Article 3", "Article 4"])
@@ -0,0 +1,167 @@
+import os
+import tempfile
+import unittest
+
+from leases import LeaseCoordinator, MemoryLeaseBackend, SqliteLeaseBackend, get_preferred_node
+
+ACCOUNTS = ["account{}".format(n) for n in range(12)]
+TTL = 60
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LeaseCoordinatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = MemoryLeaseBackend(clock=self.clock)
+        self.running = {}  # node_id -> set of accounts whose bots are running there
+
+    def add_node(self, node_id):
+        self.running[node_id] = set()
+        return LeaseCoordinator(self.backend, ACCOUNTS, on_acquire=self.running[node_id].add,
+                                on_release=self.running[node_id].discard, node_id=node_id, ttl=TTL)
+
+    def tick(self, coordinators, rounds=2):
+        for _ in range(rounds):
+            for coordinator in coordinators:
+                coordinator.tick()
+
+    def assert_each_account_runs_once(self, node_ids):
+        running = [account for node_id in node_ids for account in self.running[node_id]]
+        self.assertEqual(sorted(running), sorted(ACCOUNTS))
+
+    def test_accounts_are_spread_between_nodes(self):
+        coordinators = [self.add_node("node{}".format(n)) for n in range(3)]
+        self.tick(coordinators)
+        self.assert_each_account_runs_once(self.running)
+        for coordinator in coordinators:
+            self.assertTrue(self.running[coordinator.node_id])
+            self.assertEqual(set(coordinator.owned), self.running[coordinator.node_id])
+
+    def test_joining_node_takes_over_its_accounts(self):
+        first = self.add_node("node0")
+        self.tick([first])
+        self.assertEqual(self.running["node0"], set(ACCOUNTS))
+
+        second = self.add_node("node1")
+        self.tick([first, second])
+        self.assert_each_account_runs_once(["node0", "node1"])
+        self.assertTrue(self.running["node1"])
+        for account in ACCOUNTS:
+            self.assertEqual(self.backend.get_owners()[account], get_preferred_node(account, ["node0", "node1"]))
+
+    def test_accounts_of_a_dead_node_move(self):
+        coordinators = [self.add_node("node{}".format(n)) for n in range(3)]
+        self.tick(coordinators)
+        for _ in range(3):  # node2 stops sending heartbeats
+            self.clock.now += TTL / 2
+            self.tick(coordinators[:2], rounds=1)
+        self.tick(coordinators[:2])
+        self.assert_each_account_runs_once(["node0", "node1"])
+
+    def test_lease_is_not_taken_before_it_expires(self):
+        first = self.add_node("node0")
+        self.tick([first])
+        self.backend.remove_node("node0")  # looks dead, but its leases are still valid
+        second = self.add_node("node1")
+        self.tick([second], rounds=1)
+        self.assertEqual(self.running["node1"], set())
+
+    def test_release_all_hands_over_immediately(self):
+        first, second = self.add_node("node0"), self.add_node("node1")
+        self.tick([first, second])
+        first.release_all()
+        self.assertEqual(self.running["node0"], set())
+        self.tick([second])
+        self.assertEqual(self.running["node1"], set(ACCOUNTS))
+
+
+    def test_bots_stop_before_the_lease_expires_when_the_backend_is_unreachable(self):
+        first = self.add_node("node0")
+        first.beat()
+        expires_at = max(first.owned.values())
+
+        def unreachable(*args, **kwargs):
+            raise ConnectionError("backend is unreachable")
+
+        self.backend.heartbeat = unreachable
+        while self.running["node0"]:
+            self.clock.now += first.heartbeat_interval
+            first.beat()
+            self.assertLess(self.clock.now, expires_at)
+        self.assertEqual(first.owned, {})
+        # the bots may take the whole stop timeout to stop, and still stop before another node can take over
+        self.assertLessEqual(self.clock.now + first.stop_timeout, expires_at)
+
+    def test_release_of_an_account_that_is_not_owned_does_nothing(self):
+        first = self.add_node("node0")
+        self.tick([first])
+        first.release(ACCOUNTS[0])
+        first.release(ACCOUNTS[0])
+        first.release("unknown")
+        self.assertEqual(self.running["node0"], set(ACCOUNTS[1:]))
+
+    def test_account_released_while_its_lease_is_renewed_stays_released(self):
+        first = self.add_node("node0")
+        self.tick([first])
+        releases = []
+        first.on_release = releases.append
+        renew = self.backend.renew
+
+        def renew_while_released(account, node_id, ttl):  # e.g. the control socket releases it meanwhile
+            renewed = renew(account, node_id, ttl)
+            if account == ACCOUNTS[0]:
+                first.release(account)
+            return renewed
+
+        self.backend.renew = renew_while_released
+        first.beat()
+        self.assertEqual(releases, [ACCOUNTS[0]])
+        self.assertEqual(first.get_owned_accounts(), ACCOUNTS[1:])
+
+    def test_ttl_must_leave_time_to_stop_the_bots(self):
+        with self.assertRaises(ValueError):
+            LeaseCoordinator(self.backend, ACCOUNTS, on_acquire=None, on_release=None, ttl=TTL,
+                             heartbeat_interval=TTL / 2, stop_timeout=TTL / 2)
+
+
+class SqliteLeaseBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+        self.backend = SqliteLeaseBackend(os.path.join(self.directory.name, "leases.db"), clock=self.clock)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_lease_has_one_owner_until_it_expires(self):
+        self.assertTrue(self.backend.acquire("account", "node0", TTL))
+        self.assertFalse(self.backend.acquire("account", "node1", TTL))
+        self.assertTrue(self.backend.renew("account", "node0", TTL))
+        self.clock.now += TTL + 1
+        self.assertEqual(self.backend.get_owners(), {})
+        self.assertTrue(self.backend.acquire("account", "node1", TTL))
+        self.assertEqual(self.backend.get_owners(), {"account": "node1"})
+
+    def test_only_the_owner_can_release(self):
+        self.backend.acquire("account", "node0", TTL)
+        self.backend.release("account", "node1")
+        self.assertEqual(self.backend.get_owners(), {"account": "node0"})
+        self.backend.release("account", "node0")
+        self.assertEqual(self.backend.get_owners(), {})
+
+    def test_live_nodes(self):
+        self.backend.heartbeat("node0", TTL)
+        self.backend.heartbeat("node1", TTL / 2)
+        self.clock.now += TTL / 2
+        self.assertEqual(self.backend.get_live_nodes(), ["node0"])
+        self.backend.remove_node("node0")
+        self.assertEqual(self.backend.get_live_nodes(), [])
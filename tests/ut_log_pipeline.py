@@ -0,0 +1,31 @@
+import logging
+import queue
+import unittest
+
+from config.log_pipeline import LazyQueueHandler
+
+
+class LazyQueueHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.handler = LazyQueueHandler(self.queue)
+
+    def log(self, msg, *args):
+        record = logging.LogRecord("test", logging.INFO, __file__, 1, msg, args, None)
+        self.handler.handle(record)
+        return self.queue.get_nowait()
+
+    def test_messages_with_plain_arguments_are_left_for_the_writer_thread(self):
+        record = self.log("user=[%s] count=[%d]", "bot", 3)
+        self.assertEqual(record.msg, "user=[%s] count=[%d]")
+        self.assertEqual(record.getMessage(), "user=[bot] count=[3]")
+
+    def test_mutable_arguments_are_formatted_when_logged(self):
+        subreddits = ["FAU"]
+        record = self.log("subreddits=[%s]", subreddits)
+        subreddits.append("boca")
+        self.assertEqual(record.getMessage(), "subreddits=[['FAU']]")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import importlib.util
+import os
+import unittest
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "memory_profile.py")
+
+
+def load_memory_profile():
+    spec = importlib.util.spec_from_file_location("memory_profile", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class MemoryProfileTest(unittest.TestCase):
+    """
+    Checks that the profiler runs. A few cycles say nothing about memory growth, so budgets are only checked by
+    running scripts/memory_profile.py itself, which runs a thousand cycles by default.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.memory_profile = load_memory_profile()
+        cls.report = cls.memory_profile.run_profile(cycles=3, warmup_cycles=2, top=5)
+
+    def test_every_bot_is_profiled(self):
+        self.assertEqual([bot.classname for bot in self.report.bots], ["NewsBot", "EventBot", "TicketBot"])
+        self.assertEqual(len(self.report.top_sites), 5)
+
+    def test_bots_run_through_dispatch(self):
+        self.assertEqual([bot.cycles for bot in self.report.bots], [3, 3, 3])
@@ -0,0 +1,59 @@
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import store
+from nearduplicates import NearDuplicateIndex, normalize_title
+
+
+class NearDuplicateIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.patcher = patch.object(store, 'DATA_DIRECTORY', self.directory.name)
+        self.patcher.start()
+        self.index = NearDuplicateIndex("titles")
+        self.index.add("url0", "Student government approves new budget for spring semester")
+        self.index.add("url1", "Men's basketball falls to Miami in season opener")
+
+    def tearDown(self):
+        self.patcher.stop()
+        self.directory.cleanup()
+
+    def test_normalize_title(self):
+        self.assertEqual(normalize_title("  Parking Garage  Closes -- Again!"), "parking garage closes again")
+
+    def test_edited_title_is_a_near_duplicate(self):
+        self.assertEqual(self.index.find("Student Government approves new budget for the spring semester"), "url0")
+        self.assertEqual(self.index.find("UPDATED: Men's basketball falls to Miami in season opener"), "url1")
+
+    def test_different_title_is_not_a_near_duplicate(self):
+        self.assertIsNone(self.index.find("Library extends hours for finals week"))
+        self.assertIsNone(self.index.find("Student government rejects parking proposal"))
+
+    def test_excluded_key_does_not_match(self):
+        self.assertIsNone(self.index.find("Men's basketball falls to Miami in season opener", exclude="url1"))
+
+    def test_threshold(self):
+        strict = NearDuplicateIndex("strict", threshold=1.0)
+        strict.add("url0", "Student government approves new budget for spring semester")
+        self.assertEqual(strict.find("Student government approves new budget for spring semester!"), "url0")
+        self.assertIsNone(strict.find("Student government approves new budget for fall semester"))
+
+    def test_index_is_saved(self):
+        reloaded = NearDuplicateIndex("titles")
+        self.assertEqual(len(reloaded), 2)
+        self.assertEqual(reloaded.find("Men's basketball falls to Miami in season opener"), "url1")
+
+    def test_titles_are_appended(self):
+        self.index.add("url2", "Library extends hours for finals week")
+        self.index.add("url2", "Library extends hours for finals week")
+        self.assertEqual([record[0] for record in self.index.store.load()], ["url0", "url1", "url2"])
+
+    def test_signatures_are_recomputed_when_their_length_changes(self):
+        longer = NearDuplicateIndex("titles", num_permutations=128, bands=32)
+        self.assertEqual(longer.find("Men's basketball falls to Miami in season opener"), "url1")
+
+    def test_bands_must_divide_signature(self):
+        with self.assertRaises(ValueError):
+            NearDuplicateIndex("invalid", num_permutations=64, bands=10)
@@ -0,0 +1,158 @@
+import datetime
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import newsbot
+import outbox
+import store
+from clock import VirtualClock
+from newsbot import NewsBot, Link
+from ratelimit import RateLimiter
+
+TITLES = ["Owls win homecoming game in overtime", "Library extends hours for finals week",
+          "New parking garage opens on Boca campus"]
+ARTICLES = [Link(url="http://www.upressonline.com/2016/10/article{}/".format(n), title=title)
+            for n, title in enumerate(TITLES)]
+
+
+class FakeRedditor(object):
+    def get_submitted(self, sort=None, time=None):
+        return iter([])
+
+
+class FakeSubmission(object):
+    def __init__(self, subreddit, url):
+        self.subreddit = subreddit
+        self.url = url
+
+
+class FakeReddit(object):
+    """
+    Finds the submissions of a URL in every subreddit it was posted to.
+    The bot itself has not submitted anything.
+    """
+    def __init__(self, posted):
+        self.posted = posted  # set of (subreddit, url)
+        self.lookups = []
+
+    def get_info(self, url=None, limit=None):
+        self.lookups.append(url)
+        return [FakeSubmission(subreddit, url) for subreddit, posted_url in self.posted if posted_url == url] or None
+
+    def get_me(self):
+        return FakeRedditor()
+
+
+class NewsBotCandidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        patcher = patch.object(store, 'DATA_DIRECTORY', self.directory.name)  # title indexes are opened lazily
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.bot = NewsBot("news_test_bot")
+        self.bot.subreddits = ["first", "second"]
+        self.bot.rate_limiter = RateLimiter(rate=1e9)
+        self.bot.r = FakeReddit(posted={("first", ARTICLES[0].url), ("second", ARTICLES[0].url),
+                                        ("second", ARTICLES[1].url)})
+        self.bot.get_articles_from_today = lambda: ARTICLES
+        self.bot.outbox = outbox.Outbox(os.path.join(self.directory.name, "outbox.db"))
+
+    @property
+    def submits(self):
+        with self.bot.outbox._connect() as connection:
+            payloads = [json.loads(row['payload']) for row in connection.execute("SELECT payload FROM writes")]
+        return [(payload['subreddit'], payload['url']) for payload in payloads]
+
+    def finish_submits(self, status):
+        """
+        Stands in for the outbox sender: every queued submission is sent, or given up on.
+        """
+        with self.bot.outbox._connect() as connection:
+            connection.execute("UPDATE writes SET status=?", (status,))
+
+    def test_only_unsubmitted_articles_are_queued(self):
+        self.bot.refresh_candidates()
+        self.bot.refresh_candidates()
+        self.assertEqual(sorted(self.bot.r.lookups), [article.url for article in ARTICLES])  # each article once, for both subreddits
+        self.bot.do_scheduled_submit()
+        submitted = dict(self.submits)
+        self.assertIn(submitted["first"], [ARTICLES[1].url, ARTICLES[2].url])
+        self.assertEqual(submitted["second"], ARTICLES[2].url)
+        self.assertEqual(len(self.submits), 2)
+
+    def test_scheduled_submit_does_not_look_up_articles(self):
+        self.bot.refresh_candidates()
+        lookups = len(self.bot.r.lookups)
+        self.bot.do_scheduled_submit()
+        self.assertEqual(len(self.bot.r.lookups), lookups)
+        self.assertEqual(len(self.submits), 2)
+
+    def test_empty_queues_are_refreshed_before_submitting(self):
+        self.bot.do_scheduled_submit()
+        self.assertEqual(len(self.submits), 2)
+
+    def test_submission_counts_once_it_is_sent(self):
+        self.bot.do_scheduled_submit()
+        self.bot.do_scheduled_submit()  # still queued
+        self.assertEqual(len(self.submits), 2)
+        self.assertIsNone(self.bot._last_created)
+        self.finish_submits(outbox.SENT)
+        self.assertFalse(self.bot.is_time_to_submit())
+        self.assertIsNotNone(self.bot._last_created)
+
+    def test_submission_that_was_given_up_on_does_not_count(self):
+        self.bot.do_scheduled_submit()
+        self.finish_submits(outbox.DEAD)
+        self.assertTrue(self.bot.is_time_to_submit())
+        self.assertIsNone(self.bot._last_created)
+
+    def test_nothing_is_submitted_when_every_article_was_posted(self):
+        self.bot.r.posted.update(("first", article.url) for article in ARTICLES)
+        self.bot.r.posted.update(("second", article.url) for article in ARTICLES)
+        self.bot.do_scheduled_submit()
+        self.assertEqual(self.submits, [])
+        self.assertIsNone(self.bot._last_created)
+
+    def test_republished_story_is_not_submitted(self):
+        self.bot.refresh_candidates()
+        republished = Link(url="http://www.upressonline.com/2016/10/owls-win-homecoming/",
+                           title="Owls Win Homecoming Game in Overtime!")
+        self.bot.get_articles_from_today = lambda: ARTICLES + [republished]
+        lookups = len(self.bot.r.lookups)
+        self.bot.refresh_candidates()
+        self.assertEqual(len(self.bot.r.lookups), lookups)  # the title was found locally
+        self.assertEqual(self.bot.candidates.size("first", datetime.date.today()), 2)
+
+    def test_lookups_are_grouped_by_subreddit(self):
+        self.assertEqual(self.bot.look_up_urls([article.url for article in ARTICLES] * 2), 3)
+        self.assertTrue(self.bot.is_already_submitted(ARTICLES[0].url, "First"))
+        self.assertFalse(self.bot.is_already_submitted(ARTICLES[1].url, "first"))
+        self.assertTrue(self.bot.is_already_submitted(ARTICLES[1].url, "second"))
+        self.assertEqual(self.bot.look_up_urls([article.url for article in ARTICLES]), 0)
+        self.assertEqual(len(self.bot.r.lookups), 3)
+
+    def test_candidates_are_refreshed_by_work_when_due(self):
+        self.bot.clock = clock = VirtualClock()
+        refreshes = []
+        refresh_candidates = self.bot.refresh_candidates
+        self.bot.refresh_candidates = lambda: refreshes.append(clock.time()) or refresh_candidates()
+        self.assertEqual(self.bot.work(), clock.time() + newsbot.CANDIDATE_REFRESH_INTERVAL)
+        self.assertEqual(len(self.submits), 2)
+        clock.advance(newsbot.CANDIDATE_REFRESH_INTERVAL - 1)
+        self.bot.work()
+        clock.advance(1)
+        self.bot.work()
+        self.assertEqual(refreshes, [clock.time() - newsbot.CANDIDATE_REFRESH_INTERVAL, clock.time()])
+
+    def test_failed_refresh_does_not_stop_the_bot(self):
+        def broken():
+            raise ValueError("broken")
+
+        self.bot.get_articles_from_today = broken
+        self.bot.refresh_candidates_if_due()
+        self.assertIsNotNone(self.bot._next_candidate_refresh)
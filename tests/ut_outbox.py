@@ -0,0 +1,209 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import requests
+
+import bots
+import outbox
+from outbox import Outbox, OutboxSender, PENDING, SENDING, SENT, DEAD, SUBMIT, MESSAGE
+from ratelimit import RateLimiter
+
+ACCOUNT = "outbox_test_bot"
+
+
+class FakeSubreddit(object):
+    def __init__(self, display_name):
+        self.display_name = display_name
+
+
+class FakePost(object):
+    def __init__(self, post_id, subreddit, title):
+        self.id = post_id
+        self.subreddit = FakeSubreddit(subreddit)
+        self.title = title
+
+
+class FakeMessage(object):
+    def __init__(self, message_id, dest, subject, body):
+        self.id = message_id
+        self.dest = dest
+        self.subject = subject
+        self.body = body
+        self.created_utc = time.time()
+
+
+class FakeReddit(object):
+    """
+    Stands in for a praw.Reddit instance, recording the writes that reached Reddit.
+    """
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.response_lost = False  # writes reach Reddit, but fail like a timed out request
+        self.sent = []
+        self.posts = []
+        self.messages = []
+
+    def _write(self, *write):
+        if self.broken:
+            raise ValueError("broken")
+        self.sent.append(write)
+
+    def submit(self, subreddit, title, text=None, url=None):
+        self._write(SUBMIT, title)
+        self.posts.append(FakePost("post{}".format(len(self.posts)), subreddit, title))
+        return self.posts[-1]
+
+    def send_message(self, recipient, subject, text):
+        self._write(MESSAGE, subject)
+        self.messages.append(FakeMessage("message{}".format(len(self.messages)), recipient, subject, text))
+        if self.response_lost:
+            raise requests.Timeout("read timed out")
+
+    def get_sent(self, limit=None):
+        return list(reversed(self.messages))[:limit]
+
+    def get_me(self):
+        return self
+
+    def get_submitted(self, sort=None, time=None):
+        return reversed(self.posts)
+
+
+class StoppingRateLimiter(object):
+    """
+    Tells the sender to stop while it waits to send its first write.
+    """
+    def __init__(self, sender):
+        self.sender = sender
+
+    def acquire(self):
+        self.sender.stop_event.set()
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "outbox.db")
+        self.outbox = Outbox(self.path)
+        self.reddit = FakeReddit()
+        self.sender = OutboxSender(self.outbox, ACCOUNT, lambda: self.reddit, RateLimiter(rate=1e9))
+
+    def queue_message(self, subject, coalesce_key=None):
+        payload = {'recipient': "someone", 'subject': subject, 'text': "text"}
+        return self.outbox.enqueue(ACCOUNT, MESSAGE, payload, coalesce_key)
+
+    def send_due_writes(self):
+        for write in self.outbox.claim_due_writes(ACCOUNT):
+            self.sender.send(write)
+
+    def test_writes_are_sent_in_order(self):
+        for subject in ["first", "second", "third"]:
+            self.queue_message(subject)
+        self.send_due_writes()
+        self.assertEqual(self.reddit.sent, [(MESSAGE, "first"), (MESSAGE, "second"), (MESSAGE, "third")])
+
+    def test_failed_write_is_retried_until_it_is_given_up_on(self):
+        write_id = self.queue_message("message")
+        self.reddit.broken = True
+        with patch.object(outbox, 'RETRY_BACKOFF_INITIAL', 0):
+            for attempt in range(1, outbox.MAX_ATTEMPTS):
+                self.send_due_writes()
+                write = self.outbox.get_write(write_id)
+                self.assertEqual((write['status'], write['attempts']), (PENDING, attempt))
+            self.send_due_writes()
+        write = self.outbox.get_write(write_id)
+        self.assertEqual((write['status'], write['attempts']), (DEAD, outbox.MAX_ATTEMPTS))
+        self.assertIsNone(self.outbox.get_next_due_time(ACCOUNT))
+
+    def test_pending_writes_are_coalesced(self):
+        first_id = self.queue_message("first", coalesce_key="key")
+        second_id = self.queue_message("second", coalesce_key="key")
+        self.assertIsNone(self.outbox.get_write(first_id))
+        self.outbox.claim_due_writes(ACCOUNT)
+        third_id = self.queue_message("third", coalesce_key="key")
+        # a write that is being sent can no longer be superseded
+        self.assertEqual(self.outbox.get_write(second_id)['status'], SENDING)
+        self.assertEqual(self.outbox.get_write(third_id)['status'], PENDING)
+
+    def test_writes_being_sent_are_recovered_after_a_crash(self):
+        payload = {'subreddit': "test", 'title': "Title", 'text': "text", 'url': None}
+        write_id = self.outbox.enqueue(ACCOUNT, SUBMIT, payload)
+        self.sender.send(self.outbox.claim_due_writes(ACCOUNT)[0])
+        with self.outbox._connect() as connection:  # the program stopped after Reddit accepted the post
+            connection.execute("UPDATE writes SET status=?, attempts=0 WHERE id=?", (SENDING, write_id))
+
+        self.outbox = Outbox(self.path)
+        write = self.outbox.get_write(write_id)
+        self.assertEqual((write['status'], write['attempts']), (PENDING, 1))
+        self.sender.outbox = self.outbox
+        self.send_due_writes()
+        self.assertEqual(self.reddit.sent, [(SUBMIT, "Title")])  # not submitted twice
+        write = self.outbox.get_write(write_id)
+        self.assertEqual((write['status'], write['result']), (SENT, "post0"))
+
+    def test_claimed_writes_are_left_pending_when_the_sender_stops(self):
+        write_ids = [self.queue_message(subject) for subject in ["first", "second"]]
+        self.sender.rate_limiter = StoppingRateLimiter(self.sender)
+        self.sender.run()
+        self.assertEqual(self.reddit.sent, [])
+        self.assertEqual([self.outbox.get_write(write_id)['status'] for write_id in write_ids], [PENDING, PENDING])
+        self.assertEqual([self.outbox.get_write(write_id)['attempts'] for write_id in write_ids], [0, 0])
+
+    def test_message_whose_response_was_lost_is_not_sent_twice(self):
+        self.queue_message("earlier")
+        self.send_due_writes()
+        write_id = self.queue_message("message")
+        with patch.object(outbox, 'RETRY_BACKOFF_INITIAL', 0):
+            self.reddit.response_lost = True
+            self.send_due_writes()
+            self.reddit.response_lost = False
+            self.send_due_writes()
+        self.assertEqual(self.reddit.sent, [(MESSAGE, "earlier"), (MESSAGE, "message")])
+        self.assertEqual(self.outbox.get_write(write_id)['status'], SENT)
+
+    def test_old_sent_writes_are_pruned(self):
+        old_id = self.queue_message("old")
+        pending_id = self.outbox.enqueue("other_bot", MESSAGE, {'recipient': "someone", 'subject': "pending",
+                                                                'text': "text"})
+        self.send_due_writes()
+        with self.outbox._connect() as connection:
+            connection.execute("UPDATE writes SET created_at=created_at-?", (outbox.SENT_RETENTION + 1,))
+        recent_id = self.queue_message("recent")
+        self.send_due_writes()
+        self.assertEqual(self.outbox.prune(), 1)
+        self.assertIsNone(self.outbox.get_write(old_id))
+        self.assertEqual(self.outbox.get_write(pending_id)['status'], PENDING)
+        self.assertEqual(self.outbox.get_write(recent_id)['status'], SENT)
+
+    def test_sender_logs_in_with_its_own_session(self):
+        sessions = []
+        self.sender.login = lambda: sessions.append(FakeReddit()) or sessions[-1]
+        self.queue_message("message")
+        self.send_due_writes()
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions[0].sent, [(MESSAGE, "message")])
+        self.assertEqual(self.reddit.sent, [])
+
+    def test_failed_login_does_not_use_up_attempts(self):
+        def broken_login():
+            raise ValueError("broken")
+
+        self.sender.login = broken_login
+        write_id = self.queue_message("message")
+        self.assertFalse(self.sender._log_in())
+        self.assertEqual(self.outbox.get_write(write_id)['attempts'], 0)
+
+    def test_default_path_is_in_the_data_directory(self):
+        with patch.object(outbox.store, 'DATA_DIRECTORY', self.directory.name):
+            self.assertEqual(Outbox().path, self.path)
+
+    def test_creating_a_bot_does_not_create_the_outbox(self):
+        with patch.object(outbox.store, 'DATA_DIRECTORY', self.directory.name), patch.object(outbox, '_outbox', None):
+            os.remove(self.path)
+            bots.ExampleBot1(ACCOUNT)
+            self.assertEqual(os.listdir(self.directory.name), [])
@@ -0,0 +1,122 @@
+import datetime
+import json
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import eventbot
+import newsbot
+import store
+from singleflight import SingleFlight
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def run_concurrently(self, flight, function, callers=5):
+        """
+        Calls flight.do() from several threads, and lets the function finish only after all of them have called.
+        """
+        release = threading.Event()
+        waiting = threading.Barrier(callers + 1)
+
+        def call():
+            waiting.wait()
+            return flight.do("key", function, release)
+
+        with ThreadPoolExecutor(max_workers=callers) as executor:
+            futures = [executor.submit(call) for _ in range(callers)]
+            waiting.wait()
+            threading.Timer(0.2, release.set).start()
+        return futures
+
+    def test_concurrent_calls_share_one_result(self):
+        flight = SingleFlight()
+        futures = self.run_concurrently(flight, lambda release: release.wait() and object())
+        results = [future.result() for future in futures]
+        self.assertEqual(flight.calls, 1)
+        self.assertTrue(all(result is results[0] for result in results))
+        flight.do("key", lambda: None)
+        self.assertEqual(flight.calls, 2)  # nothing is kept without a ttl
+
+    def test_errors_are_shared_but_not_kept(self):
+        flight = SingleFlight(ttl=60)
+
+        def fail(release):
+            release.wait()
+            raise ValueError("broken")
+
+        for future in self.run_concurrently(flight, fail):
+            self.assertIsInstance(future.exception(), ValueError)
+        self.assertEqual(flight.calls, 1)
+        self.assertEqual(flight.do("key", lambda: "fixed"), "fixed")
+
+    def test_results_are_kept_for_the_ttl(self):
+        clock = FakeClock()
+        flight = SingleFlight(ttl=60, clock=clock)
+        self.assertEqual(flight.do("key", lambda: 1), 1)
+        clock.now = 59
+        self.assertEqual(flight.do("key", lambda: 2), 1)
+        self.assertEqual(flight.do("other key", lambda: 3), 3)
+        clock.now = 60
+        self.assertEqual(flight.do("key", lambda: 4), 4)
+        flight.clear()
+        self.assertEqual(flight.do("key", lambda: 5), 5)
+
+
+class FakeResponse(object):
+    status_code = 200
+    content = b"<a rel='bookmark' href='http://www.upressonline.com/2016/10/article/'>Owls win</a>"
+
+
+class SharedFetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with patch.object(store, 'DATA_DIRECTORY', self.directory.name):
+            self.news_bots = [newsbot.NewsBot("news_bot_{}".format(n)) for n in range(3)]
+            self.event_bots = [eventbot.EventBot("event_bot_{}".format(n)) for n in range(3)]
+        self.requests = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def slow_get(self, *args, **kwargs):
+        self.requests.append(args)
+        time.sleep(0.5)  # long enough for every bot to ask
+        return FakeResponse()
+
+    def test_bots_share_link_lists(self):
+        with patch.object(newsbot, 'link_lists', SingleFlight(ttl=60)), \
+                patch.object(newsbot.requests, 'get', self.slow_get):
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                results = list(executor.map(lambda bot: bot.get_articles_by_date(2016, 10, 1), self.news_bots))
+            self.news_bots[0].get_articles_by_date(2016, 10, 1)
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(results[0], [newsbot.Link(url="http://www.upressonline.com/2016/10/article/",
+                                                   title="Owls win")])
+        self.assertTrue(all(result == results[0] for result in results))
+
+    def test_bots_share_event_lists(self):
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        event_json = json.dumps({'title': "Homecoming", 'permalink': "http://www.upressonline.com/event/homecoming/",
+                                 'dateDisplay': tomorrow.strftime("%B %d @ 7:00 pm - 10:00 pm"),
+                                 'excerpt': "<p>Game</p>"})
+        for bot in self.event_bots:
+            bot.events_api.get_events = lambda *args: self.slow_get(*args) and [event_json]
+        with patch.object(eventbot, 'event_lists', SingleFlight(ttl=60)):
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                tables = list(executor.map(lambda bot: bot.create_new_table_from_api(), self.event_bots))
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(set(tables)), 1)
+        self.assertIn("Homecoming", tables[0])
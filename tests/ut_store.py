@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import store
+from store import JsonLinesStore, JsonStore
+
+
+class JsonStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.store = JsonStore("test_store", directory=self.directory.name)
+
+    def read_file(self):
+        with open(self.store.path) as ifile:
+            return json.load(ifile)
+
+    def test_values_are_saved(self):
+        self.store.set("key", {'value': [1, 2]})
+        self.assertEqual(self.store.get("key"), {'value': [1, 2]})
+        self.assertEqual(self.read_file(), {"key": {'value': [1, 2]}})
+        self.assertEqual(JsonStore("test_store", directory=self.directory.name).get("key"), {'value': [1, 2]})
+
+    def test_missing_or_broken_file_is_empty(self):
+        self.assertIsNone(self.store.get("key"))
+        self.assertEqual(self.store.get("key", "default"), "default")
+        with open(self.store.path, "w") as ofile:
+            ofile.write("{not json")
+        self.assertEqual(JsonStore("test_store", directory=self.directory.name).keys(), [])
+
+    def test_keys_and_delete(self):
+        self.store.set("first", 1)
+        self.store.set("second", 2)
+        self.assertEqual(sorted(self.store.keys()), ["first", "second"])
+        self.store.delete("first")
+        self.store.delete("missing")
+        self.assertEqual(self.store.keys(), ["second"])
+        self.assertEqual(self.read_file(), {"second": 2})
+
+    def test_failed_write_leaves_the_old_file(self):
+        self.store.set("key", "old")
+
+        def broken_dump(data, ofile):
+            ofile.write('{"key": "ne')
+            raise IOError("disk full")
+
+        with patch.object(store.json, 'dump', broken_dump), self.assertRaises(IOError):
+            self.store.set("key", "new")
+        self.assertEqual(self.read_file(), {"key": "old"})
+        self.assertEqual(os.listdir(self.directory.name), ["test_store.json"])
+
+    def test_default_directory(self):
+        with patch.object(store, 'DATA_DIRECTORY', self.directory.name):
+            default = JsonStore("default_store")
+        self.assertEqual(os.path.dirname(default.path), self.directory.name)
+
+
+class JsonLinesStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.store = JsonLinesStore("test_store", directory=self.directory.name)
+
+    def test_records_are_appended(self):
+        self.assertEqual(self.store.load(), [])
+        self.store.append(["first", 1])
+        self.store.append({'second': 2})
+        reloaded = JsonLinesStore("test_store", directory=self.directory.name)
+        self.assertEqual(reloaded.load(), [["first", 1], {'second': 2}])
+        with open(self.store.path) as ifile:
+            self.assertEqual(ifile.read(), '["first", 1]\n{"second": 2}\n')
+
+    def test_half_written_line_is_skipped(self):
+        self.store.append("first")
+        with open(self.store.path, "a") as ofile:  # the program stopped while appending
+            ofile.write('["sec')
+        self.assertEqual(self.store.load(), ["first"])
+        self.store.append("third")
+        self.assertEqual(self.store.load(), ["first", "third"])
+
+    def test_replace(self):
+        self.store.append("old")
+        self.store.replace(["first", "second"])
+        self.assertEqual(self.store.load(), ["first", "second"])
+        self.assertEqual(os.listdir(self.directory.name), ["test_store.jsonl"])
@@ -0,0 +1,135 @@
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import bots
+from bots import Bot
+from supervisor import Supervisor
+
+BACKOFF_INITIAL = 0.2
+BACKOFF_MAX = 0.5
+
+
+class ExampleBot1(Bot):
+    """
+    A bot whose work either raises, blocks until it is released, or returns, depending on its mode.
+    It is named after a bot class in config/bot_config.yaml, so it has a configured sleep interval.
+    """
+    def __init__(self, mode, *args, **kwargs):
+        super(ExampleBot1, self).__init__(*args, **kwargs)
+        self.mode = mode
+        self.release = threading.Event()
+
+    def work(self):
+        if self.mode == 'die':
+            raise ValueError("broken")
+        if self.mode == 'stall':
+            self.release.wait()
+
+    def respawn(self):
+        return self.__class__(self.mode, clock=self.clock)
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stop_event = threading.Event()
+        self.bots = {}
+        self.supervisor = Supervisor(self.bots, self.stop_event, check_interval=0.05,
+                                     backoff_initial=BACKOFF_INITIAL, backoff_max=BACKOFF_MAX)
+        self.addCleanup(self.stop_bots)
+
+    def stop_bots(self):
+        for bot in self.bots.get('account', []):
+            bot.release.set()
+            bot.join(5)
+
+    def start_bot(self, mode):
+        bot = ExampleBot1(mode)
+        self.bots['account'] = [bot]
+        bot.start()
+        return bot
+
+    @staticmethod
+    def wait_until_dead(bot):
+        threading.Thread.join(bot, 5)  # Bot.join() would tell the bot to stop, so it would not count as dead
+
+    def get_restart_delay(self):
+        """
+        Checks the bots once, and returns how long the supervisor will wait before restarting the bot.
+        """
+        self.supervisor.check()
+        return self.supervisor._restart_times[('account', 0)] - time.monotonic()
+
+    def restart_when_due(self, delay):
+        time.sleep(max(delay, 0) + 0.05)
+        self.supervisor.check()
+        return self.bots['account'][0]
+
+    def test_dead_bot_is_restarted(self):
+        old = self.start_bot('die')
+        self.wait_until_dead(old)
+        self.assertTrue(old.has_died())
+        self.assertIsInstance(old.last_error, ValueError)
+        delay = self.get_restart_delay()
+        self.assertIs(self.bots['account'][0], old)  # not before the backoff delay
+        new = self.restart_when_due(delay)
+        self.assertIsNot(new, old)
+        self.assertTrue(new.ident)
+
+    def test_stalled_bot_is_restarted(self):
+        old = self.start_bot('stall')
+        time.sleep(0.1)
+        self.assertFalse(old.is_stalled())
+        old.heartbeat_deadline = time.monotonic() - 1
+        self.assertTrue(old.is_stalled())
+        new = self.restart_when_due(self.get_restart_delay())
+        self.assertIsNot(new, old)
+        self.assertTrue(old.stop_event.is_set())
+        old.release.set()
+        old.join(5)
+        self.assertFalse(old.is_alive())
+
+    def test_healthy_bot_is_not_restarted(self):
+        bot = self.start_bot('work')
+        time.sleep(0.1)
+        self.supervisor.check()
+        self.assertEqual(self.supervisor._restart_times, {})
+        self.assertIs(self.bots['account'][0], bot)
+
+    def test_restarts_back_off(self):
+        bot = self.start_bot('die')
+        delays = []
+        for _ in range(4):
+            self.wait_until_dead(bot)
+            delays.append(self.get_restart_delay())
+            bot = self.restart_when_due(delays[-1])
+        for delay, expected in zip(delays, [BACKOFF_INITIAL, 2 * BACKOFF_INITIAL, BACKOFF_MAX, BACKOFF_MAX]):
+            self.assertAlmostEqual(delay, expected, delta=0.05)
+
+    def test_backoff_resets_after_a_successful_cycle(self):
+        bot = self.start_bot('die')
+        self.wait_until_dead(bot)
+        bot = self.restart_when_due(self.get_restart_delay())
+        self.wait_until_dead(bot)
+        bot.cycles = 1  # the restarted bot completed a cycle before it died
+        self.assertAlmostEqual(self.get_restart_delay(), BACKOFF_INITIAL, delta=0.05)
+
+
+class RedditBotRespawnTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = bots.ExampleBot1("respawn_test_bot", reset_sleep_interval=False, run_once=True)
+        self.bot.r = object()
+
+    def test_respawn_keeps_flags(self):
+        new_bot = self.bot.respawn()
+        self.assertTrue(new_bot._run_once)
+        self.assertFalse(new_bot._reset_sleep_interval)
+        self.assertIs(new_bot.r, self.bot.r)
+
+    def test_respawn_of_running_bot_logs_in_again(self):
+        with patch.object(self.bot, 'is_alive', return_value=True):
+            new_bot = self.bot.respawn()
+        self.assertIsNone(new_bot.r)
@@ -0,0 +1,88 @@
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import store
+from ticketbot import TicketBot
+
+
+class FakeComment(object):
+    def __init__(self, comment_id, body, author="student"):
+        self.id = comment_id
+        self.body = body
+        self.author = author
+
+
+class FakeReddit(object):
+    """
+    Returns the subreddit's comments newest first, stopping at the place holder like praw does.
+    """
+    def __init__(self):
+        self.comments = []
+        self.requests = []
+
+    def get_comments(self, subreddit, limit=None, place_holder=None):
+        self.requests.append((subreddit, limit, place_holder))
+        for comment in list(reversed(self.comments))[:limit]:
+            yield comment
+            if comment.id == place_holder:
+                return
+
+
+class TicketBotCommentScanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        with patch.object(store, 'DATA_DIRECTORY', self.directory.name):
+            self.bot = TicketBot("ticket_test_bot")
+        self.bot.r = FakeReddit()
+        self.replies = []
+        self.bot.queue_message = lambda recipient, subject, text, coalesce_key=None: \
+            self.replies.append((recipient, coalesce_key))
+        self.bot.scan_new_comments()  # the first scan only sets the cursor
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def post(self, *comments):
+        self.bot.r.comments.extend(comments)
+
+    def test_commands_in_new_comments_are_answered_once(self):
+        self.post(FakeComment("a", "!FAUbot buy 2"), FakeComment("b", "no command here"))
+        self.bot.scan_new_comments()
+        self.post(FakeComment("c", "!FAUbot sell 1", author="other"))
+        self.bot.scan_new_comments()
+        self.bot.scan_new_comments()
+        self.assertEqual(self.replies, [("student", "reply:a"), ("other", "reply:c")])
+
+    def test_scan_stops_at_cursor(self):
+        self.post(FakeComment("a", "first"), FakeComment("b", "second"))
+        self.bot.scan_new_comments()
+        self.post(FakeComment("c", "third"))
+        self.assertEqual([comment.id for comment in self.bot.get_new_comments()], ["c"])
+        self.assertEqual(self.bot.r.requests[-1][2], "b")
+
+    def test_seen_comments_are_skipped_when_cursor_is_deleted(self):
+        self.post(FakeComment("a", "!FAUbot buy 1"), FakeComment("b", "!FAUbot buy 2"))
+        self.bot.scan_new_comments()
+        self.bot.r.comments.remove(self.bot.r.comments[-1])
+        self.bot.scan_new_comments()
+        self.assertEqual([key for _, key in self.replies], ["reply:a", "reply:b"])
+
+    def test_own_comments_and_prefix_mismatches_are_ignored(self):
+        self.post(FakeComment("a", "!FAUbot buy 3", author="ticket_test_bot"),
+                  FakeComment("b", "!faubot buy 3"),
+                  FakeComment("c", "!FAUbot trade 3"))
+        self.bot.scan_new_comments()
+        self.assertEqual(self.replies, [])
+
+    def test_first_scan_skips_existing_comments(self):
+        with patch.object(store, 'DATA_DIRECTORY', self.directory.name):
+            bot = TicketBot("new_ticket_test_bot")
+        bot.r = self.bot.r
+        bot.queue_message = self.bot.queue_message
+        self.post(FakeComment("a", "!FAUbot buy 1"), FakeComment("b", "!FAUbot buy 2"))
+        self.assertEqual(bot.get_new_comments(), [])
+        self.post(FakeComment("c", "!FAUbot buy 3"))
+        bot.scan_new_comments()
+        self.assertEqual(self.replies, [("student", "reply:c")])
@@ -0,0 +1,99 @@
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import praw
+
+import bots
+import tokencache
+from tokencache import AccessTokenCache, TokenRefresher
+
+ACCOUNT = "token_test_bot"
+
+
+class FakeReddit(object):
+    """
+    Stands in for a praw.Reddit instance of an account whose refresh token is saved in praw.ini.
+    Reddit's side is kept by the test: the access tokens it accepts, and the refreshes it was asked for.
+    """
+    def __init__(self, test, refresh_token="refresh"):
+        self.test = test
+        self.refresh_token = refresh_token
+        self.access_token = None
+
+    def set_access_credentials(self, scope, access_token, refresh_token=None, update_user=True):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        if update_user and access_token not in self.test.valid_tokens:
+            raise praw.errors.OAuthInvalidToken("invalid_token", "https://oauth.reddit.com/api/v1/me")
+
+    def refresh_access_information(self, refresh_token=None, update_session=True):
+        self.test.refreshes.append(refresh_token or self.refresh_token)
+        access_token = "access{}".format(len(self.test.refreshes))
+        self.test.valid_tokens.add(access_token)
+        access_information = {'scope': {'identity'}, 'access_token': access_token,
+                              'refresh_token': refresh_token or self.refresh_token}
+        if update_session:
+            self.set_access_credentials(**access_information)
+        return access_information
+
+
+class TokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.cache = AccessTokenCache(directory=self.directory.name)
+        self.refresher = TokenRefresher(self.cache)  # never started, refreshes are done by the test
+        for patcher in [patch.object(tokencache, '_cache', self.cache),
+                        patch.object(tokencache, '_refresher', self.refresher)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.valid_tokens = set()
+        self.refreshes = []
+        self.refresh_token = "refresh"
+
+    def log_in(self):
+        bot = bots.ExampleBot1(ACCOUNT)
+        bot._create_reddit_instance = lambda: FakeReddit(self, self.refresh_token)
+        return bot.get_reddit_instance()
+
+    def test_cached_token_is_reused(self):
+        first = self.log_in()
+        second = self.log_in()
+        self.assertEqual(self.refreshes, ["refresh"])
+        self.assertEqual(second.access_token, first.access_token)
+        self.assertEqual(second.refresh_token, "refresh")  # praw can still refresh the token itself
+        self.assertNotIn("refresh", self.cache.store.get(ACCOUNT).values())  # only a hash of it is saved
+
+    def test_token_of_another_refresh_token_is_not_used(self):
+        self.log_in()
+        self.refresh_token = "new_refresh"
+        r = self.log_in()
+        self.assertEqual(self.refreshes, ["refresh", "new_refresh"])
+        self.assertEqual(r.access_token, "access2")
+        self.assertIsNone(self.cache.get(ACCOUNT, "refresh"))
+
+    def test_expiring_token_is_not_used(self):
+        self.cache.put(ACCOUNT, {'scope': {'identity'}, 'access_token': "old", 'refresh_token': "refresh"},
+                       lifetime=tokencache.REFRESH_MARGIN - 1)
+        self.valid_tokens.add("old")
+        self.assertTrue(self.cache.is_expiring(ACCOUNT))
+        self.assertEqual(self.log_in().access_token, "access1")
+        self.assertFalse(self.cache.is_expiring(ACCOUNT))
+
+    def test_revoked_token_is_replaced(self):
+        self.log_in()
+        self.valid_tokens.clear()  # the token was revoked
+        r = self.log_in()
+        self.assertEqual(len(self.refreshes), 2)
+        self.assertEqual(r.access_token, "access2")
+        self.assertEqual(self.cache.get(ACCOUNT, "refresh")['access_token'], "access2")
+
+    def test_refresher_does_not_use_the_bots_session(self):
+        r = self.log_in()
+        self.refresher.refresh(ACCOUNT)
+        self.assertEqual(r.access_token, "access1")  # the bot's session is only changed in the bot's thread
+        self.assertEqual(self.cache.get(ACCOUNT, "refresh")['access_token'], "access2")
+        self.cache.apply(ACCOUNT, r)
+        self.assertEqual((r.access_token, r.refresh_token), ("access2", "refresh"))
@@ -0,0 +1,123 @@
+import datetime
+import json
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import requests
+import tracing
+from eventbot import EventBot
+from eventsapi import EventsApiClient
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(404 if "missing" in self.path else 200)
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+def read_events(path):
+    """
+    Reads a trace file, adding the closing bracket that the exporter leaves out.
+    """
+    with open(path) as f:
+        return json.loads(f.read().rstrip().rstrip(",") + "]")
+
+
+class TracingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = "http://127.0.0.1:{}".format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "traces.json")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_spans_are_nested_across_threads(self):
+        with tracing.exporting(self.path, sample_rate=1.0):
+            with tracing.start_trace("Bot.work", bot="bot") as root:
+                with tracing.span("fetch") as fetch:
+                    requests.get(self.url + "/page")
+                    requests.get(self.url + "/missing")
+
+                @tracing.propagate
+                def operation(subreddit):
+                    with tracing.span("operation", subreddit=subreddit):
+                        pass
+
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    list(executor.map(operation, ["first", "second"]))
+        events = {(event['name'], event['args'].get('subreddit') or event['args'].get('status')): event
+                  for event in read_events(self.path)}
+        self.assertEqual(len(events), 6)
+        self.assertEqual(events[("Bot.work", None)]['args']['bot'], "bot")
+        self.assertEqual(events[("fetch", None)]['args']['parent_id'], root.span_id)
+        self.assertEqual(events[("http.GET", 200)]['args']['parent_id'], fetch.span_id)
+        self.assertEqual(events[("http.GET", 404)]['args']['url'], self.url + "/missing")
+        self.assertEqual(events[("operation", "second")]['args']['parent_id'], root.span_id)
+        for event in events.values():
+            self.assertEqual(event['ph'], 'X')
+            self.assertEqual(event['args']['trace_id'], root.trace.trace_id)
+
+    def test_unsampled_traces_are_not_written(self):
+        with tracing.exporting(self.path, sample_rate=0.0, slow_seconds=None) as exporter:
+            for _ in range(10):
+                with tracing.start_trace("Bot.work"):
+                    requests.get(self.url + "/page")
+        self.assertEqual(exporter.exported, 0)
+        self.assertEqual(read_events(self.path), [])
+
+    def test_slow_traces_are_always_written(self):
+        with tracing.exporting(self.path, sample_rate=0.0, slow_seconds=0) as exporter:
+            with tracing.start_trace("Bot.work"):
+                with tracing.span("child"):
+                    pass
+        self.assertEqual(exporter.exported, 1)
+        self.assertEqual(sorted(event['name'] for event in read_events(self.path)), ["Bot.work", "child"])
+
+    def test_errors_are_recorded(self):
+        with tracing.exporting(self.path, sample_rate=1.0):
+            with self.assertRaises(ValueError):
+                with tracing.start_trace("Bot.work"):
+                    raise ValueError("broken")
+        self.assertEqual(read_events(self.path)[0]['args']['error'], repr(ValueError("broken")))
+
+    def test_nothing_is_recorded_when_tracing_is_off(self):
+        with tracing.start_trace("Bot.work") as root:
+            with tracing.span("child") as child:
+                child.set_attribute('key', "value")
+        self.assertIs(root, tracing.NOOP_SPAN)
+        self.assertIs(child, tracing.NOOP_SPAN)
+        self.assertIsNone(tracing.get_current_span())
+
+    def test_event_table_spans(self):
+        start = datetime.datetime.now() + datetime.timedelta(days=1)
+        event = {'title': "Homecoming", 'url': "http://www.upressonline.com/event/homecoming/", 'excerpt': "<p>Game</p>",
+                 'start_date': start.strftime("%Y-%m-%d %H:%M:%S"),
+                 'end_date': (start + datetime.timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S")}
+        html = "<div data-tribejson='{}'></div>".format(json.dumps(EventsApiClient.to_tribe_json(event)))
+        with tracing.exporting(self.path, sample_rate=1.0):
+            with tracing.start_trace("EventBot.work"):
+                EventBot._make_reddit_table(html)
+        events = {event['name']: event for event in read_events(self.path)}
+        self.assertEqual(events["eventbot.parse"]['args']['events'], 1)
+        self.assertEqual(events["eventbot.render"]['args']['rows'], 1)
+        self.assertIn("eventbot.has_event_passed", events)
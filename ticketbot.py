@@ -1,35 +1,100 @@
 import re
+from config import bot_config
 from config import getLogger
 from bots import RedditBot
+from store import JsonStore
+import tracing
 
 logger = getLogger()
 
+SCAN_LIMIT = bot_config.get_ticket_scan_setting('comment_limit')
+REMEMBERED_COMMENTS = bot_config.get_ticket_scan_setting('remembered_comments')
+COMMAND_PREFIX = "!FAUbot"
+
 
 class TicketBot(RedditBot):
     def __init__(self, user_name, *args, **kwargs):
         super().__init__(user_name, *args, **kwargs)
-        self.COMMAND_PATTERN = "!FAUbot (buy|sell) (\d{1,2})"
+        self.COMMAND_PATTERN = COMMAND_PREFIX + r" (buy|sell) (\d{1,2})"
+        self.command_regex = re.compile(self.COMMAND_PATTERN)
+        self.scan_comments = bot_config.should_scan_comments()
+        self.comment_scan = JsonStore("ticketbot_comments_{}".format(self.USER_NAME))  # cursor and recent ids
 
     def work(self):
         logger.info("Getting unread messages")
         inbox = self.r.get_unread(unset_has_mail=True)
         for message in inbox:
-            command = re.search(self.COMMAND_PATTERN, message.body)
-            if command:
-                logger.info("Found message with a command")
-                operation = command.groups()[0]
-                number = command.groups()[1]
-                logger.info("Command: operation=[{}], number=[{}]".format(operation, number))
-                subject = "FAUbot received your command"
-                reply = """Hello! You have sent me a command. According to the message you sent me, you want to:
+            if self.handle_command(message):
+                message.mark_as_read()
+        if self.scan_comments:
+            self.scan_new_comments()
+
+    def handle_command(self, thing):
+        """
+        Replies to a command in a message or comment with a private message.
+        The cheap prefix check runs first, so most text never reaches the regular expression.
+        :param thing: A praw Message or Comment
+        :return: True if the text contained a command.
+        """
+        if COMMAND_PREFIX not in thing.body:
+            return False
+        command = self.command_regex.search(thing.body)
+        if not command:
+            return False
+        logger.info("Found a command: id=[%s]", thing.id)
+        operation = command.groups()[0]
+        number = command.groups()[1]
+        logger.info("Command: operation=[%s], number=[%s]", operation, number)
+        subject = "FAUbot received your command"
+        reply = """Hello! You have sent me a command. According to the message you sent me, you want to:
 
 `{} {}` ticket{}.
 
 Right now I'm just a prototype, so I will not process your request.""".format(operation, number, ('s' if int(number) > 1 else ''))
-                logger.info("Sending reply to: recipient=[{}]".format(message.author))
-                self.r.send_message(message.author, subject, reply)
-                logger.info("Message sent.")
-                message.mark_as_read()
+        logger.info("Queueing reply to: recipient=[%s]", thing.author)
+        self.queue_message(str(thing.author), subject, reply, coalesce_key="reply:{}".format(thing.id))
+        return True
+
+    def get_new_comments(self):
+        """
+        Reads the comments posted in the bot's subreddits since the last scan, with a single request for at most
+        SCAN_LIMIT comments that stops at the newest comment seen by the previous scan (the cursor).
+        Ids of recently seen comments are kept, so a comment is never returned twice, even if the cursor
+        comment was deleted and the listing no longer contains it.
+        The first scan only sets the cursor, so a newly deployed bot does not answer old commands.
+        :return: A list of praw Comments, oldest first.
+        """
+        cursor = self.comment_scan.get('cursor')
+        seen = self.comment_scan.get('seen')
+        first_scan = cursor is None and seen is None
+        seen = seen or []
+        seen_ids = set(seen)
+        with tracing.span("reddit.get_comments", subreddit="+".join(self.subreddits)) as span:
+            comments = list(self.r.get_comments("+".join(self.subreddits), limit=SCAN_LIMIT, place_holder=cursor))
+            span.set_attribute('comments', len(comments))
+        if cursor and all(comment.id != cursor for comment in comments):
+            logger.warning("Comment scan did not reach the cursor, comments may have been missed: cursor=[%s]", cursor)
+        new_comments = [comment for comment in comments if comment.id not in seen_ids]
+        if comments or first_scan:
+            seen = (seen + [comment.id for comment in reversed(new_comments)])[-REMEMBERED_COMMENTS:]
+            self.comment_scan.set('seen', seen)
+        if comments:
+            self.comment_scan.set('cursor', comments[0].id)
+        if first_scan:
+            logger.info("First comment scan, existing comments are skipped: subreddits=[%s], skipped=[%s]",
+                        "+".join(self.subreddits), len(comments))
+            return []
+        logger.info("Scanned comments: subreddits=[%s], read=[%s], new=[%s]",
+                    "+".join(self.subreddits), len(comments), len(new_comments))
+        return list(reversed(new_comments))
+
+    def scan_new_comments(self):
+        """
+        Replies to the commands in new comments. The bot's own comments are skipped.
+        """
+        for comment in self.get_new_comments():
+            if comment.author is not None and str(comment.author).lower() != self.USER_NAME.lower():
+                self.handle_command(comment)
 
 
 def main():
@@ -0,0 +1,182 @@
+import threading
+import time
+from hashlib import sha1
+
+from config import bot_config
+from config import getLogger
+from store import JsonStore
+
+logger = getLogger()
+
+TOKEN_LIFETIME = bot_config.get_auth_setting('token_lifetime')
+REFRESH_MARGIN = bot_config.get_auth_setting('refresh_margin')
+
+
+class AccessTokenCache(object):
+    """
+    Saves each account's OAuth access information with its expiry time, so a restarted program
+    can reuse a token that is still valid instead of asking Reddit for a new one.
+    The refresh token itself is not saved, only a hash of it: praw.ini stays the only place refresh tokens are
+    kept, and an entry is invalidated when the account's refresh token in praw.ini changes.
+    """
+    def __init__(self, store_name="access_tokens", directory=None):
+        self.store = JsonStore(store_name, directory)
+
+    @staticmethod
+    def _hash_refresh_token(refresh_token):
+        return sha1(refresh_token.encode('utf-8')).hexdigest()
+
+    def get(self, account, refresh_token):
+        """
+        :param account: The Reddit user name
+        :param refresh_token: The account's refresh token, as saved in praw.ini
+        :return: The account's access information (scope, access_token) if it was granted for the given refresh
+                 token and will not expire within the refresh margin, otherwise None.
+        """
+        entry = self.store.get(account)
+        if not entry or not refresh_token:
+            return None
+        if entry.get('refresh_token_hash') != self._hash_refresh_token(refresh_token):
+            logger.info("Cached access token was granted for another refresh token: account=[%s]", account)
+            self.delete(account)
+            return None
+        if self.is_expiring(account):
+            return None
+        return {key: entry[key] for key in ('scope', 'access_token')}
+
+    def get_expiry(self, account):
+        """
+        :return: The time (seconds since the epoch) when the account's access token expires, or None.
+        """
+        entry = self.store.get(account)
+        return entry['expires_at'] if entry else None
+
+    def is_expiring(self, account):
+        """
+        :return: True if the account has no cached access token, or it expires within the refresh margin.
+        """
+        expiry = self.get_expiry(account)
+        return expiry is None or expiry - REFRESH_MARGIN <= time.time()
+
+    def put(self, account, access_information, lifetime=TOKEN_LIFETIME):
+        """
+        Saves access information returned by praw.Reddit.refresh_access_information().
+        """
+        self.store.set(account, {'scope': sorted(access_information['scope']),
+                                 'access_token': access_information['access_token'],
+                                 'refresh_token_hash': self._hash_refresh_token(access_information['refresh_token']),
+                                 'expires_at': time.time() + lifetime})
+
+    def delete(self, account):
+        """
+        Forgets the account's access token, e.g. when Reddit rejected it.
+        """
+        self.store.delete(account)
+
+    def apply(self, account, reddit):
+        """
+        Switches a logged in praw.Reddit instance to the account's cached access token, if the cache has a newer
+        one than the instance. This must be called from the thread that uses the instance.
+        """
+        cached_access_info = self.get(account, reddit.refresh_token)
+        if cached_access_info and cached_access_info['access_token'] != reddit.access_token:
+            reddit.set_access_credentials(refresh_token=reddit.refresh_token, update_user=False,
+                                          **cached_access_info)
+
+
+class TokenRefresher(threading.Thread):
+    """
+    Refreshes every logged in account's access token shortly before it expires, so bots never have to
+    wait for a refresh in the middle of their work. One refresher serves the whole process.
+    The refresher asks Reddit for new tokens with its own praw.Reddit instances, and only saves them in the
+    cache: a praw.Reddit instance must not be used by two threads at once, so each bot switches to the new
+    token in its own thread, see AccessTokenCache.apply().
+    """
+    def __init__(self, cache):
+        super(TokenRefresher, self).__init__(daemon=True)
+        self.cache = cache
+        self.lock = threading.Lock()
+        self._connectors = {}  # account -> function that creates a praw.Reddit instance for the account
+        self._wake_event = threading.Event()
+
+    def register(self, account, connect):
+        """
+        Starts keeping an account's access token fresh.
+        :param account: The Reddit user name
+        :param connect: A function that creates a new praw.Reddit instance for the account. It does not need to
+                        be logged in, but must know the account's refresh token.
+        """
+        with self.lock:
+            self._connectors.setdefault(account, connect)
+        self._wake_event.set()
+
+    def unregister(self, account):
+        """
+        Stops keeping an account's access token fresh, e.g. when the account moves to another node.
+        """
+        with self.lock:
+            self._connectors.pop(account, None)
+        self._wake_event.set()
+
+    def refresh(self, account):
+        """
+        Gets new access information for an account, and saves it in the cache.
+        A new praw.Reddit instance is used every time, so a refresh token changed in praw.ini is picked up.
+        """
+        with self.lock:
+            connect = self._connectors.get(account)
+        if not connect:
+            return
+        logger.info("Refreshing access token: account=[%s]", account)
+        access_information = connect().refresh_access_information(update_session=False)
+        self.cache.put(account, access_information)
+
+    def _get_next_refresh_time(self):
+        with self.lock:
+            accounts = list(self._connectors)
+        expiries = [(self.cache.get_expiry(account) or 0) - REFRESH_MARGIN for account in accounts]
+        return min(expiries) if expiries else None
+
+    def run(self):
+        while True:
+            with self.lock:
+                accounts = list(self._connectors)
+            for account in accounts:
+                if self.cache.is_expiring(account):
+                    try:
+                        self.refresh(account)
+                    except Exception:
+                        logger.exception("Access token could not be refreshed: account=[%s]", account)
+            next_refresh = self._get_next_refresh_time()
+            timeout = None if next_refresh is None else max(next_refresh - time.time(), REFRESH_MARGIN / 10)
+            self._wake_event.wait(timeout)
+            self._wake_event.clear()
+
+
+_cache = None
+_refresher = None
+_lock = threading.Lock()
+
+
+def get_token_cache():
+    """
+    :return: The AccessTokenCache shared by every bot in the process.
+    """
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = AccessTokenCache()
+        return _cache
+
+
+def get_token_refresher():
+    """
+    :return: The process's running TokenRefresher, which is started the first time this is called.
+    """
+    global _refresher
+    cache = get_token_cache()
+    with _lock:
+        if _refresher is None:
+            _refresher = TokenRefresher(cache)
+            _refresher.start()
+        return _refresher
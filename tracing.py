@@ -0,0 +1,261 @@
+import itertools
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import requests
+
+from config import bot_config
+from config import data_directory
+from config import getLogger
+
+logger = getLogger()
+
+TRACE_PATH = os.path.join(data_directory, bot_config.get_tracing_setting('file'))
+SAMPLE_RATE = bot_config.get_tracing_setting('sample_rate')
+SLOW_TRACE_SECONDS = bot_config.get_tracing_setting('slow_trace_seconds')
+
+_local = threading.local()
+_ids = itertools.count(1)
+_exporter = None  # the TraceExporter, while tracing is on
+
+
+class Span(object):
+    """
+    A timed operation, e.g. one HTTP request. Spans started while another span is current become its children,
+    and every span of a trace is exported together when the trace's root span finishes.
+    """
+    def __init__(self, name, trace, parent_id=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = next(_ids)
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.thread_id = threading.get_ident()
+        self.start = time.time()
+        self.duration = None
+        self._started = time.perf_counter()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._started
+        self.trace.add(self)
+
+    def to_event(self, process_id):
+        """
+        :return: The span as a complete ('X') event of Chrome's trace event format. Times are in microseconds.
+        """
+        args = dict(self.attributes, trace_id=self.trace.trace_id, span_id=self.span_id, parent_id=self.parent_id)
+        return {'name': self.name, 'cat': self.trace.name, 'ph': 'X', 'ts': int(self.start * 1e6),
+                'dur': int(self.duration * 1e6), 'pid': process_id, 'tid': self.thread_id, 'args': args}
+
+
+class _NoopSpan(object):
+    """
+    Returned instead of a Span when nothing is being traced, so callers never have to check.
+    """
+    def set_attribute(self, key, value):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace(object):
+    """
+    The finished spans under one root span, e.g. one work() cycle.
+    """
+    def __init__(self, name, sampled):
+        self.name = name
+        self.trace_id = next(_ids)
+        self.sampled = sampled
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+
+class TraceExporter(object):
+    """
+    Appends traces to a file in Chrome's trace event format, which chrome://tracing and https://ui.perfetto.dev
+    open directly. The file is a JSON array whose closing bracket is left out, as the format allows, so traces can be
+    appended while the program runs and across runs.
+    Every trace is timed, but only a sample of them is written, along with every trace slower than slow_seconds.
+    """
+    def __init__(self, path, sample_rate=SAMPLE_RATE, slow_seconds=SLOW_TRACE_SECONDS):
+        """
+        :param path: Path of the trace file
+        :param sample_rate: Fraction of traces that are written, between 0 and 1
+        :param slow_seconds: Traces whose root span takes at least this many seconds are always written,
+                             or None to only write sampled traces
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self._lock = threading.Lock()
+        is_new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self._file = open(path, 'a')
+        if is_new:
+            self._file.write("[\n")
+        self.exported = 0
+
+    def is_sampled(self):
+        return random.random() < self.sample_rate
+
+    def export(self, trace, root):
+        """
+        Writes a finished trace, if it was sampled or its root span was slow.
+        """
+        if not trace.sampled and (self.slow_seconds is None or root.duration < self.slow_seconds):
+            return
+        process_id = os.getpid()
+        lines = "".join(json.dumps(span.to_event(process_id), default=str) + ",\n" for span in trace.spans)
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+            self.exported += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def get_current_span():
+    """
+    :return: The Span that is current in this thread, or None if nothing is being traced.
+    """
+    return getattr(_local, 'span', None)
+
+
+@contextmanager
+def _make_current(span):
+    previous = get_current_span()
+    _local.span = span
+    try:
+        yield span
+    finally:
+        _local.span = previous
+
+
+@contextmanager
+def start_trace(name, **attributes):
+    """
+    Starts a new trace with a root span, e.g. for one work() cycle. Spans started inside the context become its
+    children. Nothing is recorded unless tracing was turned on with exporting().
+    :param name: Name of the root span
+    :param attributes: Attributes of the root span, e.g. bot=...
+    :return: The root Span, or NOOP_SPAN
+    """
+    exporter = _exporter
+    if exporter is None:
+        yield NOOP_SPAN
+        return
+    root = Span(name, Trace(name, exporter.is_sampled()), attributes=attributes)
+    with _make_current(root):
+        try:
+            yield root
+        except BaseException as e:
+            root.set_attribute('error', repr(e))
+            raise
+        finally:
+            root.finish()
+            exporter.export(root.trace, root)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times an operation as a child of the current span. If no trace is active, nothing is recorded.
+    e.g. with span("reddit.search", subreddit=subreddit) as s:
+             ...
+             s.set_attribute('results', count)
+    :return: The new Span, or NOOP_SPAN
+    """
+    parent = get_current_span()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    child = Span(name, parent.trace, parent.span_id, attributes)
+    with _make_current(child):
+        try:
+            yield child
+        except BaseException as e:
+            child.set_attribute('error', repr(e))
+            raise
+        finally:
+            child.finish()
+
+
+def traced(name):
+    """
+    A decorator that runs every call of a function in a span.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if get_current_span() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(function):
+    """
+    Wraps a function that will be called on another thread, e.g. by a ThreadPoolExecutor, so the spans it starts
+    are children of the span that is current now.
+    """
+    parent = get_current_span()
+    if parent is None:
+        return function
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with _make_current(parent):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+_send = requests.Session.send  # the send method _traced_send wraps, replaced when tracing is turned on
+
+
+def _traced_send(session, request, **kwargs):
+    """
+    Records every HTTP request made through requests, by the praw.Reddit instances as well as the scrapers.
+    """
+    if get_current_span() is None:
+        return _send(session, request, **kwargs)
+    with span("http.{}".format(request.method), url=request.url) as s:
+        response = _send(session, request, **kwargs)
+        s.set_attribute('status', response.status_code)
+        return response
+
+
+@contextmanager
+def exporting(path=TRACE_PATH, sample_rate=SAMPLE_RATE, slow_seconds=SLOW_TRACE_SECONDS):
+    """
+    Turns tracing on while the context is active.
+    e.g. with exporting("data/traces.json"):
+             # run bots
+    :return: The TraceExporter
+    """
+    global _exporter, _send
+    exporter = TraceExporter(path, sample_rate, slow_seconds)
+    _exporter = exporter
+    _send = requests.Session.send
+    requests.Session.send = _traced_send
+    logger.info("Tracing: file=[%s], sampleRate=[%s], slowSeconds=[%s]", path, sample_rate, slow_seconds)
+    try:
+        yield exporter
+    finally:
+        requests.Session.send = _send
+        _exporter = None
+        exporter.close()